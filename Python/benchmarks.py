@@ -0,0 +1,198 @@
+"""
+Модуль замеров производительности бота
+Запуск: python benchmarks.py <название замера> [параметры] [<название замера> [параметры]]
+"""
+import os
+import sys
+import logging
+import pickle
+import subprocess
+import time
+import tracemalloc
+import config as cfg
+
+def build_school(departments: int = 5, classes: int = 20, weeks: int = 2, days: int = 6, hours: int = 7) -> tuple:
+    """
+    Построение тестового графа школы без обращения к сети
+    Возвращает (школа, список расписаний классов)
+    """
+    from schedule_parser import School, Department, SchoolClass
+    from week_pdf_parser import WeekSchedule, LessonIdent, Lesson, DayOfWeek
+    subjects = ["Математика", "Русский язык", "Литература", "Физика", "Химия", "История", "Английский язык", "Биология"]
+    teachers = ["Иванова И.И.", "Петров П.П.", "Сидорова С.С.", "Кузнецов К.К.", "Смирнова С.А.", "Попов А.Б."]
+    school = School(cfg.SCHEDULE_URL)
+    school.name = "ГБОУ Школа"
+    week_schedules = []
+    for i in range(departments):
+        department = Department(f"Корпус {i + 1}", school)
+        for j in range(classes):
+            class_name = f"{5 + j % 7}{'АБВГДЕЖ'[j // 7]}"
+            school_class = SchoolClass(class_name, f"files/rasp/{i}/{class_name}.pdf", department)
+            department.add_class(school_class)
+            week_schedule = WeekSchedule(school_class)
+            for week in range(1, weeks + 1):
+                for day in range(days):
+                    day_of_week = DayOfWeek.week_names[day][0]
+                    for hour in range(1, hours + 1):
+                        name = subjects[(i + j + day + hour) % len(subjects)]
+                        teacher = teachers[(j + hour) % len(teachers)]
+                        office = str(100 + (j * 7 + hour) % 60)
+                        # строки создаются заново как при разборе pdf
+                        row_data = "".join([name, "\n", office, " ", teacher])
+                        ident = LessonIdent(week, hour, "".join([day_of_week]), day)
+                        lesson = Lesson(ident, "".join([name]), "".join([office]), None, "".join([teacher]), "".join([class_name]), row_data)
+                        week_schedule.add_lesson(ident, lesson)
+            week_schedules.append(week_schedule)
+        school.add_department(department)
+    return school, week_schedules
+
+def benchmark_memory() -> None:
+    """
+    Память графа школы со всеми уроками и размер его pickle
+    """
+    # импорт модулей до начала замера
+    build_school(1, 1, 1, 1, 1)
+    tracemalloc.start()
+    start = tracemalloc.take_snapshot()
+    school, week_schedules = build_school()
+    end = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in end.compare_to(start, "filename"))
+    row_data = [lesson.row_data for week_schedule in week_schedules for week in week_schedule.week_list()
+                for day in week_schedule.day_of_week_list(week) for lesson in week_schedule.lesson_list(week, day)]
+    lessons = len(row_data)
+    data = pickle.dumps((school, week_schedules))
+    print(f"lessons: {lessons}")
+    print(f"row_data: {len(set(row_data))} unique")
+    print(f"memory: {size / 1024:.1f} KiB ({size / lessons:.0f} bytes per lesson)")
+    print(f"pickle: {len(data) / 1024:.1f} KiB")
+
+def benchmark_callback_data(count: int = 100000) -> None:
+    """
+    Стоимость упаковки/распаковки callback_data кнопок меню: старый строковый формат и struct + base64
+    """
+    from data import MenuData, DAY_OF_WEEK_OBJECT
+    menu_data = MenuData(3, 2 ** 62 + 12345, 2, 4)
+    legacy = menu_data.to_string(DAY_OF_WEEK_OBJECT)
+    encoded = menu_data.encode(DAY_OF_WEEK_OBJECT)
+    print(f"legacy: {len(legacy)} bytes, encoded: {len(encoded)} bytes")
+    for name, func in [
+        ("legacy encode", lambda: menu_data.to_string(DAY_OF_WEEK_OBJECT)),
+        ("legacy decode", lambda: MenuData.from_string(DAY_OF_WEEK_OBJECT, legacy)),
+        ("encode", lambda: menu_data.encode(DAY_OF_WEEK_OBJECT)),
+        ("decode", lambda: MenuData.decode(encoded))
+    ]:
+        start = time.perf_counter()
+        for _ in range(count):
+            func()
+        print(f"{name}: {(time.perf_counter() - start) / count * 1e6:.2f} us")
+
+def parse_school_page_bs4(data: str) -> tuple:
+    """
+    Прежний разбор страницы расписания школы полным деревом BeautifulSoup - для сравнения с parse_school_page
+    """
+    from bs4 import BeautifulSoup
+    xml_data = BeautifulSoup(data, 'lxml')
+    name = None
+    if xml_data.find("title"):
+        name = xml_data.find("title").text
+        position = name.find("ГБОУ")
+        if position > 0:
+            name = name[position:]
+    schedule_name = None
+    text_center = xml_data.find(['p'], attrs = {"style": "text-align: center;"})
+    if text_center:
+        schedule_name = text_center.text.strip().replace('\xa0', ' ').replace('\r\n', ' ')
+    department_list = []
+    for h3 in xml_data.find_all(['h3'], attrs = {"class": "toggle-heading", "style": "text-align: center;"}):
+        if '<h3 class="toggle-heading" style="text-align: center;"><span style="font-size' in str(h3):
+            class_list = []
+            for sibling in h3.next_siblings:
+                table = sibling.find('table')
+                if table != -1:
+                    for row in table.find('tbody').find_all('tr'):
+                        for col in row.find_all('td'):
+                            if col.text and col.text != '\xa0':
+                                class_list.append((col.text, None if col.a is None else col.a.get('href')))
+            department_list.append((h3.text, class_list))
+    return name, schedule_name, department_list
+
+def benchmark_school_html(path: str = None, count: int = 20) -> None:
+    """
+    Разбор сохраненной страницы расписания школы: lxml XPath и прежний разбор BeautifulSoup
+    Запуск: python benchmarks.py school_html <файл страницы>
+    """
+    from schedule_parser import parse_school_page
+    if path is None:
+        print("path to saved schedule page is required")
+        return
+    with open(path, encoding="utf-8") as file:
+        data = file.read()
+    results = {}
+    for name, func in [("lxml", parse_school_page), ("bs4", parse_school_page_bs4)]:
+        start = time.perf_counter()
+        for _ in range(count):
+            results[name] = func(data)
+        print(f"{name}: {(time.perf_counter() - start) / count * 1000:.1f} ms")
+    departments = results["lxml"][2]
+    print(f"page: {len(data) / 1024:.0f} KiB, {len(departments)} departments, "
+          f"{sum(len(class_list) for _, class_list in departments)} classes")
+    print(f"same result: {results['lxml'] == results['bs4']}")
+
+# Модули разбора pdf/html, которые не должны загружаться при запуске бота -
+# они импортируются внутри функций разбора и загружаются при первом разборе
+HEAVY_MODULES = ("PyPDF2", "pdfminer", "pdfplumber", "bs4", "lxml")
+
+def benchmark_importtime(module: str = "main", top: int = 15) -> None:
+    """
+    Время импорта модуля бота по отчету python -X importtime
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=False)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        # "import time:  self [us] | cumulative | imported package", вложенность - отступом названия
+        fields = line[len("import time:"):].split("|")
+        imports.append((int(fields[1]), int(fields[0]), fields[2][1:].rstrip()))
+    if result.returncode != 0:
+        print(f"import {module} failed:\n{result.stderr.splitlines()[-1] if result.stderr else ''}")
+    top_level = [item for item in imports if not item[2].startswith(" ")]
+    total = sum(item[0] for item in top_level)
+    print(f"import {module}: {total / 1000:.1f} ms, {len(imports)} modules")
+    for cumulative, self_time, name in sorted(top_level, reverse=True)[:top]:
+        print(f"{cumulative / 1000:9.1f} ms {self_time / 1000:9.1f} ms  {name.strip()}")
+    heavy = sorted({name.strip().split(".")[0] for _, _, name in imports if name.strip().split(".")[0] in HEAVY_MODULES})
+    print(f"heavy modules loaded at import: {', '.join(heavy) if heavy else 'none'}")
+
+# Список замеров
+BENCHMARKS = {
+    "memory": benchmark_memory,
+    "callback_data": benchmark_callback_data,
+    "importtime": benchmark_importtime,
+    "school_html": benchmark_school_html
+}
+
+def main():
+    """
+    Запуск замеров
+    """
+    if not logging.getLogger().hasHandlers():
+        logging.basicConfig(stream=sys.stdout, level=logging.WARNING)
+    logging.getLogger().setLevel(logging.WARNING)
+    # название замера и следующие за ним параметры
+    runs = []
+    for arg in sys.argv[1:]:
+        if arg in BENCHMARKS or len(runs) == 0:
+            runs.append((arg, []))
+        else:
+            runs[-1][1].append(arg)
+    for name, args in runs or [(name, []) for name in BENCHMARKS]:
+        print(f"------------------{name}--------------------------")
+        start = time.perf_counter()
+        BENCHMARKS[name](*args)
+        print(f"time: {time.perf_counter() - start:.3f} s")
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,8 @@
 """
 Модуль кеширования
 """
+import sys
+from hashlib import blake2b
 from functools import lru_cache, wraps
 from datetime import datetime, timedelta
 
@@ -26,25 +28,31 @@ def timed_lru_cache(seconds: int, maxsize: int = 128):
 
     return wrapper_cache
 
-def hash_string_to_byte(s: str) -> int:
+def stable_id(s: str) -> int:
     """
-    Хеширование строки в байт
+    Стабильный 63-битный идентификатор строки (blake2b) - помещается в INTEGER SQLite и знаковое 64-битное целое
     """
-    byte_array = bytes(s, encoding='utf-8')
-    result: int = 5381
-    for byte in byte_array:
-        result = (((result << 5) + result) + byte) & 0xFFFF
-    return result
+    digest = blake2b(s.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") & 0x7FFFFFFFFFFFFFFF
 
-def hash_string(s: str) -> int:
+def intern_str(s: str) -> str:
     """
-    Хеширование строки в два байта
+    Интернирование строки - одинаковые строки разных объектов хранятся в памяти один раз
     """
-    byte_array = bytes(s, encoding='utf-8')
-    result: int = 5381
-    for byte in byte_array:
-        result = (((result << 5) + result) + byte) & 0xFFFFFFFF
-    return result
+    if s is None:
+        return None
+    return sys.intern(s)
+
+def restore_slots(obj, state) -> None:
+    """
+    Восстановление из pickle объекта с __slots__
+    state: (None, словарь слотов) или словарь __dict__ объекта, сохраненного до перехода на __slots__
+    """
+    if isinstance(state, tuple):
+        state = state[1]
+    if state:
+        for key, value in state.items():
+            object.__setattr__(obj, key, value)
 
 def main():
     raise SystemError("This file cannot be operable")
@@ -0,0 +1,179 @@
+"""
+Модуль разбора учебного календаря
+"""
+import sys
+import io
+import re
+import logging
+from datetime import date, datetime, timedelta
+from hashlib import md5
+import requests
+from week_pdf_parser import download
+from database import init_db, save_calendar_to_db, load_calendar_from_db
+import config as cfg
+
+# Период дат "01.09.2023 - 08.09.2023" или "01.09-08.09"
+DATE_RANGE = re.compile(R"(\d{1,2})\.(\d{1,2})(?:\.(\d{2,4}))?\s*[-–—]\s*(\d{1,2})\.(\d{1,2})(?:\.(\d{2,4}))?")
+# Номер недели "1 неделя", "2-я неделя", "неделя 1"
+WEEK_NUMBER = re.compile(R"(\d)\s*-?\s*(?:я|ая)?\s*недел|недел\S*\s*(\d)", re.IGNORECASE)
+
+class AcademicCalendar:
+    """
+    Учебный календарь - чередование недель по датам
+    """
+    def __init__(self, url: str):
+        """
+        Конструктор класса
+        url: ссылка на pdf файл учебного календаря
+        """
+        self.__url: str = url
+        self.__hash: str = ""
+        # дата -> чередование по неделям
+        self.__week_dict: dict = {}
+        self.__last_parse_info: str = None
+
+    def __start_year(self) -> int:
+        """
+        Год начала учебного года - из названия файла "2023_2024" или по текущей дате
+        """
+        match = re.search(R"(\d{4})_(\d{4})", self.__url)
+        if match:
+            return int(match.group(1))
+        today = date.today()
+        return today.year if today.month >= 8 else today.year - 1
+
+    def __to_date(self, day: str, month: str, year: str) -> date:
+        """
+        Дата по строкам дня/месяца/года, год по умолчанию определяется учебным годом
+        """
+        if year:
+            year = int(year)
+            if year < 100:
+                year += 2000
+        else:
+            year = self.__start_year()
+            if int(month) < 8:
+                year += 1
+        return date(year, int(month), int(day))
+
+    def parse_tables(self, tables: list) -> dict:
+        """
+        Разбор таблиц учебного календаря - строки с периодом дат и номером недели
+        Возвращает словарь date -> week
+        """
+        week_dict = {}
+        for table in tables:
+            for row in table:
+                text = " ".join(cell.replace("\n", " ") for cell in row if cell)
+                week_match = WEEK_NUMBER.search(text)
+                if week_match is None:
+                    continue
+                week = int(week_match.group(1) or week_match.group(2))
+                for match in DATE_RANGE.finditer(text):
+                    try:
+                        start = self.__to_date(match.group(1), match.group(2), match.group(3))
+                        end = self.__to_date(match.group(4), match.group(5), match.group(6))
+                    except ValueError:
+                        continue
+                    day = start
+                    while day <= end:
+                        week_dict[day] = week
+                        day += timedelta(days=1)
+        return week_dict
+
+    def load_pdf_from_url(self, response: requests.models.Response) -> dict:
+        """
+        Разбор pdf учебного календаря
+        """
+        import pdfplumber
+        tables = []
+        with pdfplumber.open(io.BytesIO(response.content)) as pdf:
+            for table_page in pdf.pages:
+                tables.extend(table_page.extract_tables())
+        return self.parse_tables(tables)
+
+    def load_cached(self) -> bool:
+        """
+        Загрузка последнего сохраненного календаря из базы без обращения к сети
+        Возвращает False если в базе календаря нет
+        """
+        if len(self.__week_dict) == 0:
+            self.__hash, self.__week_dict = load_calendar_from_db(self.__url)
+        return len(self.__week_dict) > 0
+
+    def load(self) -> bool:
+        """
+        Процедура загрузки учебного календаря по сети
+        Выполняется при запуске и заданием бота в пуле потоков - обработчики только читают загруженный календарь
+        """
+        try:
+            response = download(self.__url)
+            if response.status_code != 200:
+                raise requests.exceptions.RequestException(f"error code {response.status_code}")
+        except requests.exceptions.RequestException as e:
+            self.__last_parse_info = f"Error {type(e)} {e}.\nTry get data from database"
+            logging.error(self.__last_parse_info)
+            if len(self.__week_dict) == 0:
+                self.__hash, self.__week_dict = load_calendar_from_db(self.__url)
+            return len(self.__week_dict) > 0
+
+        new_hash = md5(response.content).hexdigest()
+        if self.__hash == new_hash:
+            self.__last_parse_info = "Hash not changed - used saved data"
+            return len(self.__week_dict) > 0
+        saved_hash, week_dict = load_calendar_from_db(self.__url, new_hash)
+        if len(week_dict) > 0:
+            self.__last_parse_info = "Calendar successful loaded from Db"
+        else:
+            week_dict = self.load_pdf_from_url(response)
+            if len(week_dict) == 0:
+                # pdf не разобран (изменился формат) - оставляем предыдущий календарь, hash не запоминаем для повторного разбора
+                self.__last_parse_info = "Calendar pdf has no weeks - used saved data"
+                logging.warning(self.__last_parse_info)
+                if len(self.__week_dict) == 0:
+                    self.__hash, self.__week_dict = load_calendar_from_db(self.__url)
+                return len(self.__week_dict) > 0
+            self.__last_parse_info = f"Calendar successful loaded from url: {len(week_dict)} days"
+            save_calendar_to_db(self.__url, new_hash, week_dict)
+        logging.info(self.__last_parse_info)
+        self.__hash = new_hash
+        self.__week_dict = week_dict
+        return len(self.__week_dict) > 0
+
+    def current_week(self, day: date = None) -> int:
+        """
+        Чередование по неделям на дату day (по умолчанию - сегодня)
+        Календарь не загружается - используется загруженный при запуске или заданием бота
+        Возвращает None если дата в календаре не найдена
+        """
+        if day is None:
+            day = datetime.now(cfg.TIMEZONE).date()
+        return self.__week_dict.get(day)
+
+    @property
+    def url(self) -> str:
+        """ url pdf файла учебного календаря """
+        return self.__url
+
+    @property
+    def last_parse_info(self) -> str:
+        """ Результат последней загрузки """
+        return self.__last_parse_info
+
+# Учебный календарь школы
+academic_calendar = AcademicCalendar(cfg.CALENDAR_URL)
+
+def main():
+    """
+    Разбор учебного календаря
+    """
+    if not logging.getLogger().hasHandlers():
+        logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+    cfg.disable_logger(["pdfminer.psparser", "pdfminer.pdfparser", "pdfminer.pdfinterp", "pdfminer.cmapdb", "pdfminer.pdfdocument", "pdfminer.pdfpage"])
+    init_db()
+    academic_calendar.load()
+    print(academic_calendar.last_parse_info)
+    print(f"current week {academic_calendar.current_week()}")
+
+if __name__ == "__main__":
+    main()
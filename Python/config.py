@@ -4,6 +4,8 @@
 import os
 import sys
 import logging
+import datetime
+import pytz
 
 # Запуск логирования
 if not logging.getLogger().hasHandlers():
@@ -15,6 +17,102 @@ else:
     logging.info("BOT_TOKEN is not None")
 BASE_URL = "https://1502.mskobr.ru"
 SCHEDULE_URL = f"{BASE_URL}/uchashimsya/raspisanie-kanikuly"
+# Интервал обновления расписания школы по умолчанию (секунд)
+SCHOOL_REFRESH_INTERVAL = 60*60*6
+
+def parse_schools(value: str) -> list:
+    """
+    Список школ (url, интервал обновления) из строки "url[@секунд],url[@секунд]"
+    """
+    school_list = []
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        url, _, interval = item.rpartition("@")
+        if url and interval.isdigit():
+            school_list.append((url, int(interval)))
+        else:
+            school_list.append((item, SCHOOL_REFRESH_INTERVAL))
+    return school_list
+
+# Школы бота, первая - школа по умолчанию для меню
+SCHOOLS = parse_schools(os.getenv("SCHOOLS", SCHEDULE_URL))
+# Количество школ, одновременно хранящихся в памяти - неактивные дольше всех вытесняются
+SCHOOL_CACHE_SIZE = int(os.getenv("SCHOOL_CACHE_SIZE", 3))
+# Интервал проверки необходимости обновления школ (секунд)
+SCHOOL_REFRESH_CHECK = 60
+# Количество школ, обновляемых за одну проверку
+SCHOOL_REFRESH_BATCH = 1
+# Количество потоков загрузки и разбора расписаний школ и классов
+FETCH_WORKERS = int(os.getenv("FETCH_WORKERS", 4))
+# Учебный календарь с чередованием недель
+CALENDAR_URL = os.getenv("CALENDAR_URL", f"{BASE_URL}/files/rasp/alpha/ucheb_graf_2023_2024_alpha.pdf")
+# Интервал обновления учебного календаря по сети (секунд)
+CALENDAR_REFRESH_INTERVAL = 60*60*24
+# Интервал проверки изменений расписаний для рассылки уведомлений (секунд)
+NOTIFY_INTERVAL = int(os.getenv("NOTIFY_INTERVAL", 60*10))
+# Часовой пояс школы
+TIMEZONE = pytz.timezone(os.getenv("TIMEZONE", "Europe/Moscow"))
+# Время утренней рассылки расписания на день (ЧЧ:ММ)
+DIGEST_TIME = datetime.datetime.strptime(os.getenv("DIGEST_TIME", "07:00"), "%H:%M").time().replace(tzinfo=TIMEZONE)
+# Интервал обновления хранилища расписаний всех классов (секунд)
+STORE_INTERVAL = 60
+# Количество расписаний классов, загружаемых за одно обновление хранилища
+STORE_LOAD_BATCH = 5
+# Запуск по данным из базы без обращения к сети, проверка расписаний в фоне
+LAZY_STARTUP = os.getenv("LAZY_STARTUP", "1") != "0"
+# Интервал фоновой проверки расписаний, загруженных из базы при запуске (секунд)
+REVALIDATE_INTERVAL = 30
+# Количество расписаний классов, проверяемых за одну фоновую проверку
+REVALIDATE_BATCH = 3
+# Администраторы бота - идентификаторы пользователей telegram через запятую
+ADMIN_IDS = {int(user_id) for user_id in os.getenv("ADMIN_IDS", "").split(",") if user_id.strip()}
+# Количество последних замеров каждой метрики для вычисления квантилей
+METRICS_WINDOW = 1000
+# Адрес и порт локального http сервера метрик Prometheus (0 - сервер не запускается)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9108))
+# Интервал записи в базу накопленных данных (секунд)
+FLUSH_INTERVAL = 60
+# Хранилище общего состояния реплик бота: пустая строка - в памяти процесса, redis://host:port/db - Redis
+STATE_BACKEND_URL = os.getenv("STATE_BACKEND_URL", "")
+# Время ожидания ответа хранилища (секунд) - запросы выполняются в цикле событий бота и задерживают все обработчики
+STATE_BACKEND_TIMEOUT = float(os.getenv("STATE_BACKEND_TIMEOUT", 1.0))
+# Время жизни блокировки лидера реплик и интервал ее продления (секунд)
+LEADER_LOCK_TTL = 60
+LEADER_LOCK_RENEW = 20
+# Интервал проверки репликами-последователями расписаний, опубликованных лидером (секунд)
+SHARED_SYNC_INTERVAL = 60
+# Время хранения готовых сообщений с расписанием (секунд)
+RENDER_CACHE_TTL = 60*60
+# Минимальный интервал повторного запроса пользователем того же объекта (секунд)
+THROTTLE_SECONDS = 4
+# Интервал записи в базу выбранных пользователями классов (секунд)
+USER_FLUSH_INTERVAL = 5
+# Время хранения выбранного пользователем класса в хранилище общего состояния (секунд)
+USER_CACHE_TTL = 60*60*24
+# Срок хранения записей о разборе расписаний (дней)
+PARSE_RECORDS_DAYS = 30
+# Время кеширования telegram результатов inline запросов (секунд)
+INLINE_CACHE_TIME = 60*5
+# Расписание звонков: номер урока -> (начало, окончание)
+LESSON_TIMES = {
+    1: ("08:30", "09:15"),
+    2: ("09:25", "10:10"),
+    3: ("10:25", "11:10"),
+    4: ("11:25", "12:10"),
+    5: ("12:25", "13:10"),
+    6: ("13:25", "14:10"),
+    7: ("14:20", "15:05"),
+    8: ("15:15", "16:00"),
+    9: ("16:10", "16:55"),
+    10: ("17:05", "17:50")
+}
+# Продолжительность урока (минут)
+LESSON_DURATION = 45
+# Дни утренней рассылки (0 - воскресенье, 6 - суббота)
+DIGEST_DAYS = (1, 2, 3, 4, 5, 6)
 
 def disable_logger(log_list: list) -> None:
     """
@@ -2,12 +2,25 @@
 Модуль данных сессии бота
 """
 import logging
+import struct
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from binascii import Error as Base64Error
 from datetime import datetime
+from telegram import InlineQueryResultArticle, InputTextMessageContent
 from telegram.ext import ContextTypes
+from telegram.constants import ParseMode
 from schedule_parser import School, Department, SchoolClass
-from week_pdf_parser import WeekSchedule
+from week_pdf_parser import WeekSchedule, Lesson
+from school_registry import school_registry
+from fetch_pool import fetch_pool
+from state_backend import state_backend
+from database import get_user_class
+from calendar_parser import academic_calendar
+from cache_func import timed_lru_cache
 import config as cfg
+from metrics import metrics
 
+SCHOOL_OBJECT = "SCHOOL"
 DEPARTMENT_OBJECT = "DEPARTMENT"
 CLASS_OBJECT = "CLASS"
 WEEK_SCHEDULE_OBJECT = "WEEK_SCHEDULE"
@@ -19,19 +32,23 @@ class BotData:
     """
     Данные сессии бота
     """
-    def __init__(self):
-        """
-        Конструктор класса
-        """
-        self.__school: School = None
+    def __getstate__(self) -> dict:
+        """ Школы не сохраняются в PicklePersistence - они хранятся в реестре школ """
+        return {}
+
+    def __setstate__(self, state) -> None:
+        """ Восстановление из pickle - школа, сохраненная до появления реестра школ, передается в реестр """
+        school: School = state.get("_BotData__school")
+        if school is not None:
+            school_registry.put(school)
 
     @property
     def school(self) -> School:
-        """ Свойство возвращающее объект школа """
-        if self.__school is None:
-            self.__school = School(cfg.SCHEDULE_URL)
-        self.__school.load()
-        return self.__school
+        """
+        Свойство возвращающее объект школа по умолчанию
+        Школа загружается в цикле событий - используется только при запуске бота, обработчики используют get_school
+        """
+        return school_registry.default
 
 class UserData:
     """
@@ -89,20 +106,12 @@ def create_context_data(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> Non
             user_data.user_id = user_id
             context.user_data["UserData"] = user_data
 
-def get_school(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> School:
+async def get_school(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> School:
     """
-    Получить данные школы
+    Получить данные школы по умолчанию - школа, которой нет в памяти, загружается в пуле потоков
     """
     create_context_data(context, user_id)
-    if context.bot_data is not None and "BotData" in context.bot_data:
-        logging.info("Get school from bot_data")
-        return context.bot_data["BotData"].school
-    elif context.user_data is not None and "BotData" in context.user_data:
-        logging.info("Get school from user_data")
-        return context.user_data["BotData"].school
-    else:
-        logging.info("Context bot_data and user_data is none")
-        return BotData().school
+    return await school_registry.get_async(school_registry.default_url)
 
 class MenuData:
     """
@@ -110,15 +119,35 @@ class MenuData:
     """
     item_delimiter: str = ';'
     value_delimiter: str = '='
+    # Версия формата callback_data
+    version: int = 2
+    # Тип кнопки -> байт типа в callback_data
+    object_types: dict = {
+        SCHOOL_OBJECT: 1,
+        DEPARTMENT_OBJECT: 2,
+        CLASS_OBJECT: 3,
+        WEEK_OBJECT: 4,
+        DAY_OF_WEEK_OBJECT: 5
+    }
+    # Байт типа -> тип кнопки
+    object_names: dict = {value: key for key, value in object_types.items()}
+    # Префиксы callback_data старого формата, длинные раньше коротких
+    legacy_prefixes: tuple = tuple(sorted(object_types.keys(), key=len, reverse=True))
+    # Версия, тип, маска пустых полей, корпус, класс, неделя, день недели, школа - 29 байт, 40 символов base64
+    layout: struct.Struct = struct.Struct(">BBBqqbbq")
+    # Формат версии 1 - без школы, кнопки разбираются для школы по умолчанию
+    layout_v1: struct.Struct = struct.Struct(">BBBqqbb")
 
-    def __init__(self, department: int = -1, class_: int = None, week: int = None, day_of_week: int = None):
+    def __init__(self, department: int = -1, class_: int = None, week: int = None, day_of_week: int = None, school: int = None):
         """
         Конструктор класса
+        school: идентификатор школы в меню (SchoolRegistry.key), None - школа корпуса или школа по умолчанию
         """
         self.dp_i: int = department
         self.c_i: int = class_
         self.w_i: int = week
         self.dw_i: int = day_of_week
+        self.s_i: int = school
 
     def to_string(self, prefix: str) -> str:
         """
@@ -148,6 +177,46 @@ class MenuData:
                     result.__dict__[key] = int(value)
         return result
 
+    def encode(self, object_type: str) -> str:
+        """
+        Упаковка в callback_data кнопки типа object_type
+        """
+        values = (self.dp_i, self.c_i, self.w_i, self.dw_i, self.s_i)
+        empty_mask = 0
+        for i, value in enumerate(values):
+            if value is None:
+                empty_mask |= 1 << i
+        data = self.layout.pack(self.version, self.object_types[object_type], empty_mask,
+                                *[value if value is not None else 0 for value in values])
+        return urlsafe_b64encode(data).decode("ascii")
+
+    @classmethod
+    def decode(cls, s: str) -> tuple:
+        """
+        Распаковка callback_data - возвращает (тип кнопки, MenuData)
+        callback_data старого формата "DEPARTMENTdp_i=..." разбирается через from_string
+        """
+        if s.startswith(cls.legacy_prefixes):
+            object_type = next(prefix for prefix in cls.legacy_prefixes if s.startswith(prefix))
+            return object_type, cls.from_string(object_type, s)
+        try:
+            data = urlsafe_b64decode(s)
+        except (Base64Error, ValueError) as e:
+            raise ValueError(f"Invalid callback data {s}") from e
+        if len(data) == cls.layout.size and data[0] == cls.version:
+            _, type_code, empty_mask, *values = cls.layout.unpack(data)
+        elif len(data) == cls.layout_v1.size and data[0] == 1:
+            _, type_code, empty_mask, *values = cls.layout_v1.unpack(data)
+            values.append(None)
+        else:
+            raise ValueError(f"Unsupported callback data {s}")
+        object_type = cls.object_names.get(type_code)
+        if object_type is None:
+            raise ValueError(f"Unknown callback type {type_code}")
+        if empty_mask:
+            values = [None if empty_mask & (1 << i) else value for i, value in enumerate(values)]
+        return object_type, MenuData(*values)
+
     @property
     def department(self) -> int:
         """ Корпус """
@@ -168,34 +237,69 @@ class MenuData:
         """ День недели """
         return self.dw_i
 
+    @property
+    def school(self) -> int:
+        """ Школа """
+        return self.s_i
+
+async def get_user_school(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> School:
+    """
+    Школа выбранного пользователем класса, если класс не выбран - школа по умолчанию
+    Школа класса загружается в пуле потоков
+    """
+    class_id = get_user_class(user_id)
+    school_class: SchoolClass = await school_registry.find_class(class_id) if class_id is not None else None
+    if school_class is not None:
+        return school_class.department.school
+    return await get_school(context, user_id)
+
+def get_menu_school(menu_data: MenuData, context: ContextTypes.DEFAULT_TYPE) -> School:
+    """
+    Школа кнопки меню: выбранная в меню школ, школа корпуса или школа по умолчанию
+    Школа не загружается - обработчик меню загружает ее заранее в load_menu_school
+    """
+    create_context_data(context, None)
+    if menu_data.school is not None:
+        return school_registry.loaded(school_registry.url_by_key(menu_data.school))
+    if menu_data.department not in (None, -1):
+        department: Department = school_registry.loaded_department(menu_data.department)
+        if department is not None:
+            return department.school
+    return school_registry.loaded(school_registry.default_url)
+
+async def load_menu_school(menu_data: MenuData) -> None:
+    """
+    Загрузка в пуле потоков школы кнопки меню и расписания класса кнопки, если их нет в памяти
+    """
+    department: Department = None
+    if menu_data.school is not None:
+        url = school_registry.url_by_key(menu_data.school)
+        if url is not None:
+            await school_registry.get_async(url)
+    elif menu_data.department not in (None, -1):
+        department = await school_registry.find_department(menu_data.department)
+    if menu_data.school is None and department is None:
+        await school_registry.get_async(school_registry.default_url)
+    if department is not None and menu_data.class_ not in (None, -1):
+        school_class: SchoolClass = department.get_class_by_id(menu_data.class_)
+        if school_class is not None and school_class.loaded_week_schedule is None:
+            await fetch_pool.load_week_schedule(school_class)
+
 def get_school_object(class_name: str, menu_data: MenuData, context: ContextTypes.DEFAULT_TYPE) -> any:
     """
     Получить объект типа class_name
     """
-    school: School = get_school(context, None)
+    school: School = get_menu_school(menu_data, context)
     if school is None:
         return None, "Расписание не загружено"
     if context.user_data is not None and "UserData" in context.user_data:
         user_data: UserData = context.user_data["UserData"]
-        if user_data.last_class_name is None:
-            user_data.last_class_name = class_name
-            user_data.last_datetime = datetime.now()
-        elif user_data.last_class_name == class_name and user_data.last_datetime is not None:
-            time_now = datetime.now()
-            time_diff = time_now - user_data.last_datetime
-            user_data.seconds = time_diff.total_seconds()
-            logging.debug(f"Same class_name. Time diff {user_data.seconds}")
-            logging.debug(f"Last usage {user_data.last_datetime.strftime('%d/%m/%y %H:%M')}")
-            logging.debug(f"New usage {time_now.strftime('%d/%m/%y %H:%M')}")
-            if user_data.seconds < 4:
-                logging.warning("Interval is too small")
-                raise IntervalError("Interval is too small")
-            else:
-                user_data.last_datetime = datetime.now()
-        else:
-            user_data.last_datetime = datetime.now()
-            user_data.last_class_name = class_name
-            user_data.seconds = None
+        # время последнего запроса хранится в общем хранилище - следующий запрос может обработать другая реплика
+        if not state_backend.throttle(f"throttle:{user_data.user_id}", class_name, cfg.THROTTLE_SECONDS):
+            logging.warning("Interval is too small")
+            raise IntervalError("Interval is too small")
+        user_data.last_class_name = class_name
+        user_data.last_datetime = datetime.now()
         context.user_data["UserData"] = user_data
 
     if class_name == DEPARTMENT_OBJECT:
@@ -213,8 +317,8 @@ def get_school_object(class_name: str, menu_data: MenuData, context: ContextType
     if school_class is None:
         return None, "Идентификатор класса не корректен"
 
-    # Разбор pdf файла недельного расписания
-    week_schedule: WeekSchedule = school_class.week_schedule
+    # Расписание загружено в load_menu_school - обработчик не обращается к сети
+    week_schedule: WeekSchedule = school_class.loaded_week_schedule
     if week_schedule is None:
         return None, "Список недель не определен"
     if not week_schedule.last_parse_result:
@@ -240,6 +344,90 @@ def get_school_object(class_name: str, menu_data: MenuData, context: ContextType
 
     return None, "Не известный тип объекта"
 
+def get_current_week(week_list: list) -> int:
+    """
+    Текущее чередование по неделям по учебному календарю
+    Возвращает None если неделю определить не удалось
+    """
+    if len(week_list) == 1:
+        return week_list[0]
+    week = academic_calendar.current_week()
+    if week in week_list:
+        return week
+    return None
+
+def lessons_message(week_schedule: WeekSchedule, week: int, day_of_week: str) -> str:
+    """
+    Текст расписания класса на день в формате HTML
+    Готовые сообщения хранятся в общем хранилище до изменения hash расписания
+    """
+    key = f"lessons:{week_schedule.school_class.id}:{week_schedule.hash}:{week}:{day_of_week}"
+    message = state_backend.get_object(key)
+    if message is None:
+        message = render_lessons_message(week_schedule, week, day_of_week)
+        state_backend.set_object(key, message, cfg.RENDER_CACHE_TTL)
+    return message
+
+@metrics.timed("render")
+def render_lessons_message(week_schedule: WeekSchedule, week: int, day_of_week: str) -> str:
+    """
+    Формирование текста расписания класса на день в формате HTML
+    """
+    school_class: SchoolClass = week_schedule.school_class
+    message = f"Расписание для класса {school_class.name}/{school_class.department.name}\n{school_class.link}\n"
+    message = f"{message}\n{day_of_week}:\n"
+    lesson: Lesson
+    for lesson in week_schedule.lesson_list(week, day_of_week):
+        lesson_string = lesson.to_str(parse_mode = ParseMode.HTML)
+        message += f"{lesson_string}\n"
+    return message
+
+def get_inline_results(school: School, query: str) -> list:
+    """
+    Результаты inline запроса "класс [день недели]"
+    Используются только уже загруженные расписания классов - inline запрос не обращается к сети
+    Пустой результат не кешируется - расписания найденных классов могут быть еще не загружены
+    """
+    max_classes = 5
+    class_list, day_number = school_registry.school_index(school).parse_query(query)
+    class_hashes = tuple((school_class.id, school_class.loaded_week_schedule.hash) for school_class in class_list[:max_classes]
+                         if school_class.loaded_week_schedule is not None and school_class.loaded_week_schedule.last_parse_result)
+    if len(class_hashes) == 0:
+        return []
+    return build_inline_results(school, class_hashes, day_number)
+
+@timed_lru_cache(60*60, maxsize=1024)
+def build_inline_results(school: School, class_hashes: tuple, day_number: int) -> list:
+    """
+    Результаты inline запроса по найденным классам
+    class_hashes: (id класса, hash расписания класса) - при изменении расписания любого класса или загрузке
+    еще не загруженного расписания кеш не используется
+    """
+    results = []
+    for class_id, _ in class_hashes:
+        school_class: SchoolClass = school.get_class_by_id(class_id)
+        week_schedule: WeekSchedule = None if school_class is None else school_class.loaded_week_schedule
+        if week_schedule is None or not week_schedule.last_parse_result:
+            continue
+        week_list = week_schedule.week_list()
+        for week in week_list:
+            for day_of_week in week_schedule.day_of_week_list(week):
+                lesson_list = week_schedule.lesson_list(week, day_of_week)
+                number = lesson_list[0].ident.day_of_week_number
+                if day_number is not None and number != day_number:
+                    continue
+                title = f"{school_class.name}/{school_class.department.name} {day_of_week}"
+                if len(week_list) > 1:
+                    title = f"{title} неделя {week}"
+                message = lessons_message(week_schedule, week, day_of_week)
+                results.append(InlineQueryResultArticle(
+                    id=f"{school_class.id}_{week}_{number}",
+                    title=title,
+                    description=", ".join(lesson.name for lesson in lesson_list),
+                    input_message_content=InputTextMessageContent(message, parse_mode=ParseMode.HTML)
+                ))
+    return results[:50]
+
 def main():
     raise SystemError("This file cannot be operable")
 
@@ -5,23 +5,28 @@ import datetime
 from hashlib import md5
 import logging
 import traceback
+import threading
 import sqlalchemy as db_sql
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy import exc
-from config import get_data_path
+from config import get_data_path, SCHEDULE_URL, USER_CACHE_TTL
+from metrics import metrics
+from state_backend import state_backend
 
 # Место расположения Базы данных
 db_path = get_data_path()
 file_path = f"{db_path}/data.db"
 engine = db_sql.create_engine(f"sqlite:///{file_path}")
 meta = db_sql.MetaData()
-session = Session(engine)
+# Сессия своя для каждого потока - расписания загружаются в пуле потоков
+session = scoped_session(sessionmaker(engine))
 
 # Список школ
 schools = db_sql.Table(
     "schools", meta,
     db_sql.Column("id", db_sql.Integer, primary_key = True),        # Ключ
     db_sql.Column("name", db_sql.String, nullable = False),         # Название
+    db_sql.Column("url", db_sql.String),                            # url страницы расписания
     db_sql.Column("deleted", db_sql.DateTime)                       # дата удаления
 )
 
@@ -82,11 +87,6 @@ lessons_ident = db_sql.Table(
     db_sql.Column("day_number", db_sql.Integer)				        # номер дня недели
 )
 
-connection = engine.connect()
-lesson_data = connection.execute(db_sql.text("select * from lessons where id=-1"))
-if "is_group" not in lesson_data.keys():
-    connection.execute(db_sql.text("alter table lessons add is_group BOOLEAN"))
-
 # Список уроков
 lessons = db_sql.Table(
     "lessons", meta,
@@ -104,12 +104,6 @@ lessons = db_sql.Table(
     db_sql.Column("is_group", db_sql.Boolean)                       # Признак группы
 )
 
-user_data = connection.execute(db_sql.text("select * from users where id=-1"))
-if "name" not in user_data.keys():
-    connection.execute(db_sql.text("alter table users add name VARCHAR"))
-if "updated" not in user_data.keys():
-    connection.execute(db_sql.text("alter table users add updated DATETIME"))
-
 # Список пользователей
 users = db_sql.Table(
     "users", meta,
@@ -117,14 +111,10 @@ users = db_sql.Table(
     db_sql.Column("class_id", db_sql.Integer, db_sql.ForeignKey("classes.id"), nullable = False),
                                                                     # Класс к которому последний раз делался запрос пользователем
     db_sql.Column("name", db_sql.String),                           # Имя пользователя
-    db_sql.Column("updated", db_sql.DateTime)                       # дата обновления
+    db_sql.Column("updated", db_sql.DateTime),                      # дата обновления
+    db_sql.Column("digest", db_sql.Boolean)                         # Подписка на утреннюю рассылку
 )
 
-error_data = connection.execute(db_sql.text("select * from errors where created=0"))
-if "trace_hash" not in error_data.keys():
-    connection.execute(db_sql.text("alter table errors add trace_hash VARCHAR"))
-if "error_count" not in error_data.keys():
-    connection.execute(db_sql.text("alter table errors add error_count INTEGER"))
 # ошибки бота
 errors = db_sql.Table(
     "errors", meta,
@@ -138,7 +128,139 @@ errors = db_sql.Table(
     db_sql.Column("error_count", db_sql.Integer)                    # Количество повторений
 )
 
-meta.create_all(engine)
+# Изменения в расписаниях классов
+schedule_changes = db_sql.Table(
+    "schedule_changes", meta,
+    db_sql.Column("id", db_sql.Integer, primary_key = True, autoincrement = True),
+                                                                    # Ключ
+    db_sql.Column("class_id", db_sql.Integer, db_sql.ForeignKey("classes.id"), nullable = False),
+                                                                    # Ссылка на класс
+    db_sql.Column("old_hash", db_sql.String),                       # hash старого pdf расписания
+    db_sql.Column("new_hash", db_sql.String, nullable = False),     # hash нового pdf расписания
+    db_sql.Column("kind", db_sql.String, nullable = False),         # тип изменения
+    db_sql.Column("week", db_sql.Integer),                          # чередование по неделям
+    db_sql.Column("hour_start", db_sql.String),                     # начало урока
+    db_sql.Column("day_of_week", db_sql.String),                    # день недели
+    db_sql.Column("day_number", db_sql.Integer),                    # номер дня недели
+    db_sql.Column("old_value", db_sql.String),                      # урок в старом расписании
+    db_sql.Column("new_value", db_sql.String),                      # урок в новом расписании
+    db_sql.Column("created", db_sql.DateTime),                      # дата создания
+    db_sql.Column("notified", db_sql.DateTime)                      # дата отправки уведомлений
+)
+
+# Очередь исходящих сообщений бота
+send_queue = db_sql.Table(
+    "send_queue", meta,
+    db_sql.Column("id", db_sql.Integer, primary_key = True, autoincrement = True),
+                                                                    # Ключ
+    db_sql.Column("chat_id", db_sql.Integer, nullable = False),     # чат получателя
+    db_sql.Column("text", db_sql.String, nullable = False),         # текст сообщения
+    db_sql.Column("parse_mode", db_sql.String),                     # формат сообщения
+    db_sql.Column("priority", db_sql.Integer, nullable = False),    # приоритет
+    db_sql.Column("created", db_sql.DateTime)                       # дата создания
+)
+
+# Учебный календарь - чередование недель по датам
+calendar_weeks = db_sql.Table(
+    "calendar_weeks", meta,
+    db_sql.Column("url", db_sql.String, primary_key = True),        # url pdf файла учебного календаря
+    db_sql.Column("date", db_sql.Date, primary_key = True),         # дата
+    db_sql.Column("hash", db_sql.String, nullable = False),         # hash pdf файла
+    db_sql.Column("week", db_sql.Integer, nullable = False)         # чередование по неделям
+)
+
+# Записи о разборе расписаний классов
+parse_records = db_sql.Table(
+    "parse_records", meta,
+    db_sql.Column("id", db_sql.Integer, primary_key = True, autoincrement = True),
+                                                                    # Ключ
+    db_sql.Column("class_id", db_sql.Integer),                      # Ссылка на класс
+    db_sql.Column("url", db_sql.String),                            # url pdf файла
+    db_sql.Column("hash", db_sql.String),                           # hash pdf файла
+    db_sql.Column("source", db_sql.String, nullable = False),       # источник: memory/db/url
+    db_sql.Column("outcome", db_sql.String, nullable = False),      # результат разбора
+    db_sql.Column("download_bytes", db_sql.Integer),                # размер загруженного pdf
+    db_sql.Column("download_ms", db_sql.Float),                     # время загрузки pdf
+    db_sql.Column("db_ms", db_sql.Float),                           # время загрузки из базы
+    db_sql.Column("fast_ms", db_sql.Float),                         # время быстрого разбора pdf
+    db_sql.Column("full_ms", db_sql.Float),                         # время полного разбора pdf
+    db_sql.Column("save_ms", db_sql.Float),                         # время сохранения в базу
+    db_sql.Column("lesson_count", db_sql.Integer),                  # количество уроков
+    db_sql.Column("parse_path", db_sql.String),                     # способ разбора pdf
+    db_sql.Column("created", db_sql.DateTime)                       # дата разбора
+)
+
+# Соединение с базой данных, создается в init_db
+connection = None
+
+# Версия схемы идентификаторов (PRAGMA user_version): 1 - 63-битные идентификаторы stable_id,
+# 2 - идентификаторы корпусов и классов включают url школы
+ID_SCHEME_VERSION = 2
+
+def migrate_ids() -> None:
+    """
+    Пересчет идентификаторов школ, корпусов, классов и уроков по текущей схеме stable_id
+    Выполняется один раз для версии схемы - версия хранится в PRAGMA user_version
+    """
+    from cache_func import stable_id
+    version = session.execute(db_sql.text("PRAGMA user_version")).scalar()
+    if version >= ID_SCHEME_VERSION:
+        return
+    logging.info(f"Migrate ids from version {version} to {ID_SCHEME_VERSION}")
+    try:
+        school_rows = session.query(schools).all()
+        school_map = {row.id: stable_id(row.name) for row in school_rows}
+        school_urls = {row.id: row.url or "" for row in school_rows}
+        # название корпуса и url школы - идентификатор корпуса и часть идентификатора класса
+        department_keys = {row.id: row.name + school_urls.get(row.school_id, "") for row in session.query(departments)}
+        department_map = {department_id: stable_id(key) for department_id, key in department_keys.items()}
+        class_map = {row.id: stable_id(row.name + department_keys.get(row.department_id, ""))
+                     for row in session.query(classes)}
+        ident_map = {row.id: stable_id(f"{row.week}_{row.hour_start}_{row.day_of_week}")
+                     for row in session.query(lessons_ident)}
+        sql = "select l.id, l.name, l.office, l.group_name, l.teacher, i.week, i.hour_start, i.day_of_week, c.name as class_name " + \
+            "from lessons l join lessons_ident i on l.ident_id=i.id " + \
+            "join week_schedules w on l.week_schedule_hash=w.hash join classes c on w.class_id=c.id"
+        lesson_map = {row.id: stable_id(f"{row.name}_{row.week}_{row.hour_start}_{row.day_of_week}_{row.office}_{row.group_name}_{row.teacher}_{row.class_name}")
+                      for row in session.execute(db_sql.text(sql))}
+        # разные записи не должны получить один идентификатор - иначе миграция не выполняется,
+        # версия схемы не меняется и записи остаются со старыми идентификаторами
+        for name, id_map in (("schools", school_map), ("departments", department_map), ("classes", class_map),
+                             ("lessons_ident", ident_map), ("lessons", lesson_map)):
+            if len(set(id_map.values())) != len(id_map):
+                raise ValueError(f"Duplicate ids in {name}: migration to version {ID_SCHEME_VERSION} is not possible")
+
+        def remap(table: db_sql.Table, column_name: str, id_map: dict) -> None:
+            """ Замена значений колонки по словарю старый идентификатор -> новый """
+            params = [{"old_id": old_id, "new_id": new_id} for old_id, new_id in id_map.items() if old_id != new_id]
+            if len(params) == 0:
+                return
+            column = table.c[column_name]
+            stmt = table.update().where(column == db_sql.bindparam("old_id")).values({column_name: db_sql.bindparam("new_id")})
+            session.execute(stmt, params)
+
+        remap(schools, "id", school_map)
+        remap(departments, "school_id", school_map)
+        remap(schedules, "school_id", school_map)
+        remap(departments, "id", department_map)
+        remap(classes, "department_id", department_map)
+        remap(classes, "id", class_map)
+        remap(week_schedules, "class_id", class_map)
+        remap(users, "class_id", class_map)
+        remap(schedule_changes, "class_id", class_map)
+        remap(parse_records, "class_id", class_map)
+        remap(lessons_ident, "id", ident_map)
+        remap(lessons, "ident_id", ident_map)
+        remap(lessons, "id", lesson_map)
+        session.execute(db_sql.text(f"PRAGMA user_version = {ID_SCHEME_VERSION}"))
+        session.commit()
+        logging.info(f"Migrated ids: {len(school_map)} schools, {len(department_map)} departments, {len(class_map)} classes, "
+                     f"{len(ident_map)} lesson idents, {len(lesson_map)} lessons")
+    except (exc.SQLAlchemyError, ValueError) as e:
+        if session.is_active:
+            session.rollback()
+        logging.error(f"Migrate ids error {e}")
+        log_error(e)
 
 def log_error(e) -> None:
     """
@@ -150,6 +272,50 @@ def log_error(e) -> None:
     if "database is locked" not in str(e):
         save_error(0, tb_string, "", "", "")
 
+def init_db() -> None:
+    """
+    Подключение к базе данных - создание таблиц, добавление новых колонок в существующие таблицы, миграции
+    Выполняется один раз при запуске, а не при импорте модуля
+    """
+    global connection
+    if connection is not None:
+        return
+    meta.create_all(engine)
+    connection = engine.connect()
+    lesson_data = connection.execute(db_sql.text("select * from lessons where id=-1"))
+    if "is_group" not in lesson_data.keys():
+        connection.execute(db_sql.text("alter table lessons add is_group BOOLEAN"))
+    user_data = connection.execute(db_sql.text("select * from users where id=-1"))
+    if "name" not in user_data.keys():
+        connection.execute(db_sql.text("alter table users add name VARCHAR"))
+    if "updated" not in user_data.keys():
+        connection.execute(db_sql.text("alter table users add updated DATETIME"))
+    if "digest" not in user_data.keys():
+        connection.execute(db_sql.text("alter table users add digest BOOLEAN"))
+    error_data = connection.execute(db_sql.text("select * from errors where created=0"))
+    if "trace_hash" not in error_data.keys():
+        connection.execute(db_sql.text("alter table errors add trace_hash VARCHAR"))
+    if "error_count" not in error_data.keys():
+        connection.execute(db_sql.text("alter table errors add error_count INTEGER"))
+    school_data = connection.execute(db_sql.text("select * from schools where id=-1"))
+    if "url" not in school_data.keys():
+        connection.execute(db_sql.text("alter table schools add url VARCHAR"))
+        # до поддержки нескольких школ в базе была только школа SCHEDULE_URL
+        session.execute(schools.update().where(schools.c.url == None).values(url = SCHEDULE_URL))
+        session.commit()
+    migrate_ids()
+
+def close_db() -> None:
+    """
+    Закрытие соединений с базой данных при остановке бота
+    """
+    global connection
+    session.remove()
+    if connection is not None:
+        connection.close()
+        connection = None
+    engine.dispose()
+
 def delete_old_schedule(school_hash: str) -> None:
     """"
     Удаление старых расписаний и уроков
@@ -164,15 +330,15 @@ def delete_old_schedule(school_hash: str) -> None:
             # удалить lessons - уроки
             sql = "from lessons where week_schedule_hash in " + \
                 "(select hash from week_schedules where schedule_hash = '" + schedule_hash + "')"
-            lessons_data = connection.execute(db_sql.text("select * " + sql))
+            lessons_data = session.execute(db_sql.text("select * " + sql))
             if lessons_data and len(lessons_data.all()) > 0:
-                connection.execute(db_sql.text("delete " + sql))
+                session.execute(db_sql.text("delete " + sql))
                 session.commit()
             # удалить week_schedules - расписания на неделю
             sql = "from week_schedules where schedule_hash = '" + schedule_hash + "'"
-            schedule_data = connection.execute(db_sql.text("select * " + sql))
+            schedule_data = session.execute(db_sql.text("select * " + sql))
             if schedule_data and len(schedule_data.all()) > 0:
-                connection.execute(db_sql.text("delete " + sql))
+                session.execute(db_sql.text("delete " + sql))
                 session.commit()
         except exc.SQLAlchemyError as e:
             if session.is_active:
@@ -186,11 +352,12 @@ def save_to_db(school) -> None:
     try:
         # Добавление/изменение школы
         if session.query(schools).filter_by(id = school.id).first() is not None:
-            stmt = schools.update().where(schools.c.id == school.id).where(schools.c.name != school.name).values(name = school.name)
+            stmt = schools.update().where(schools.c.id == school.id).values(name = school.name, url = school.url)
         else:
             stmt = schools.insert().values(
                 id = school.id,
-                name = school.name
+                name = school.name,
+                url = school.url
             )
         session.execute(stmt)
 
@@ -338,6 +505,61 @@ def load_from_db(school, new_hash: str) -> bool:
     school.hash = new_hash
     return True
 
+def get_last_schedule_hash(url: str) -> str:
+    """
+    hash действующего расписания школы с страницей url, сохраненного в базе
+    """
+    schedule_data = session.query(schedules) \
+        .join(schools, schools.c.id == schedules.c.school_id) \
+        .filter(schools.c.url == url) \
+        .filter(schedules.c.deleted == None) \
+        .first()
+    if schedule_data is None:
+        return None
+    return schedule_data.hash
+
+def get_class_school_url(class_id: int) -> str:
+    """
+    url страницы школы, к которой относится класс class_id
+    """
+    school_data = session.query(schools.c.url) \
+        .join(departments, departments.c.school_id == schools.c.id) \
+        .join(classes, classes.c.department_id == departments.c.id) \
+        .filter(classes.c.id == class_id) \
+        .first()
+    return None if school_data is None else school_data.url
+
+def get_department_school_url(department_id: int) -> str:
+    """
+    url страницы школы, к которой относится корпус department_id
+    """
+    school_data = session.query(schools.c.url) \
+        .join(departments, departments.c.school_id == schools.c.id) \
+        .filter(departments.c.id == department_id) \
+        .first()
+    return None if school_data is None else school_data.url
+
+def get_school_names() -> dict:
+    """
+    Названия школ, сохраненных в базе: url -> название
+    """
+    return {school_data.url: school_data.name for school_data in session.query(schools.c.url, schools.c.name)
+            .filter(schools.c.deleted == None)}
+
+def get_last_week_schedule_hash(class_id: int, schedule_hash: str) -> str:
+    """
+    hash последнего успешно разобранного расписания класса для расписания школы schedule_hash
+    """
+    schedule_data = session.query(week_schedules) \
+        .filter(week_schedules.c.class_id == class_id) \
+        .filter(week_schedules.c.schedule_hash == schedule_hash) \
+        .filter(week_schedules.c.parse_result == True) \
+        .order_by(week_schedules.c.created.desc()) \
+        .first()
+    if schedule_data is None:
+        return None
+    return schedule_data.hash
+
 def save_pdf_to_db(week_schedule) -> bool:
     """
     Процедура сохранения pdf расписания в базе данных
@@ -474,7 +696,7 @@ def load_pdf_from_db(week_schedule, new_hash: str) -> bool:
     sql = "select l.*, i.week, i.hour_start, i.day_of_week, i.day_number from lessons l join lessons_ident i on l.ident_id=i.id " + \
         "where l.week_schedule_hash = '" + schedule_data.hash + "' " + \
         "order by i.week, i.day_number, i.hour_start, l.hour_end, l.is_group"
-    lessons_data = connection.execute(db_sql.text(sql))
+    lessons_data = session.execute(db_sql.text(sql))
     has_lesson = False
     for lesson_data in lessons_data:
         lesson_ident = LessonIdent(lesson_data.week, lesson_data.hour_start, lesson_data.day_of_week, lesson_data.day_number)
@@ -496,47 +718,119 @@ def load_pdf_from_db(week_schedule, new_hash: str) -> bool:
 
     return has_lesson
 
+# Данные пользователей хранятся в хранилище общего состояния по ключу user_class:{user_id} с временем жизни
+# USER_CACHE_TTL - {"class_id", "name", "updated"}, {"class_id": None} - пользователя нет в базе
+# Изменения пользователей, еще не записанные в базу: user_id -> данные пользователя
+_dirty_users: dict = {}
+
+def _user_key(user_id: int) -> str:
+    """ Ключ данных пользователя в хранилище общего состояния """
+    return f"user_class:{user_id}"
+
 def save_user_class(user_id: int, class_id: int, user_name: str) -> None:
     """
     Сохранение данных о последнем запрошенном пользователем классе
+    Данные записываются в хранилище общего состояния - их видят все реплики бота,
+    а в базу записываются пакетом в flush_user_classes
+    """
+    user_data = {"class_id": class_id, "name": user_name, "updated": datetime.datetime.now()}
+    state_backend.set_object(_user_key(user_id), user_data, USER_CACHE_TTL)
+    _dirty_users[user_id] = user_data
+
+@metrics.timed("db")
+def get_user_class(user_id) -> int:
+    """"
+    Получение информации о последнем запрошенном пользователем классе
+    """
+    user_data = state_backend.get_object(_user_key(user_id))
+    if user_data is None:
+        # хранилище недоступно или данные устарели - изменение, еще не записанное в базу, новее данных базы
+        user_data = _dirty_users.get(user_id)
+    if user_data is None:
+        users_data = session.query(users.c.class_id, users.c.name, users.c.updated) \
+            .filter(users.c.id == user_id).first()
+        user_data = {"class_id": None} if users_data is None else \
+            {"class_id": users_data.class_id, "name": users_data.name, "updated": users_data.updated}
+        # данные, записанные другой репликой за время запроса, не заменяются
+        state_backend.set_object(_user_key(user_id), user_data, USER_CACHE_TTL, only_new=True)
+    return user_data["class_id"]
+
+def load_user_cache() -> int:
+    """
+    Загрузка в хранилище общего состояния данных пользователей, выбиравших класс за время USER_CACHE_TTL,
+    при запуске бота - уже сохраненные в хранилище данные не заменяются
+    Возвращает количество загруженных пользователей
+    """
+    count = 0
+    updated = datetime.datetime.now() - datetime.timedelta(seconds=USER_CACHE_TTL)
+    for users_data in session.query(users.c.id, users.c.class_id, users.c.name, users.c.updated) \
+            .filter(users.c.updated >= updated):
+        if users_data.id not in _dirty_users:
+            user_data = {"class_id": users_data.class_id, "name": users_data.name, "updated": users_data.updated}
+            if state_backend.set_object(_user_key(users_data.id), user_data, USER_CACHE_TTL, only_new=True):
+                count += 1
+    return count
+
+@metrics.timed("db")
+def flush_user_classes() -> int:
+    """
+    Запись измененных данных пользователей в базу одним пакетом
+    Запись базы не заменяется более старыми данными - пользователь мог выбрать класс на другой реплике
+    Возвращает количество записанных пользователей
     """
-    users_data = session.query(users).filter(users.c.id == user_id).first()
+    global _dirty_users
+    if len(_dirty_users) == 0:
+        return 0
+    dirty_users = _dirty_users
+    _dirty_users = {}
     try:
-        if users_data is not None:
+        saved_ids = {user_data.id for user_data in session.query(users.c.id).filter(users.c.id.in_(list(dirty_users)))}
+        update_list = []
+        insert_list = []
+        for user_id, user_data in dirty_users.items():
+            if user_id in saved_ids:
+                update_list.append({
+                    "b_id": user_id,
+                    "b_class_id": user_data["class_id"],
+                    "b_name": user_data["name"],
+                    "b_updated": user_data["updated"]
+                })
+            else:
+                insert_list.append({"id": user_id, **user_data})
+        if len(update_list) > 0:
             stmt = users.update() \
-                .where(users.c.id == user_id) \
+                .where(users.c.id == db_sql.bindparam("b_id")) \
+                .where(db_sql.or_(users.c.updated == None, users.c.updated <= db_sql.bindparam("b_updated"))) \
                 .values(
-                    class_id = class_id,
-                    name = user_name,
-                    updated = datetime.datetime.now()
+                    class_id = db_sql.bindparam("b_class_id"),
+                    name = db_sql.bindparam("b_name"),
+                    updated = db_sql.bindparam("b_updated")
                 )
-        else:
-            stmt = users.insert().values(
-                id = user_id,
-                class_id = class_id,
-                name = user_name,
-                updated = datetime.datetime.now()
-            )
-        session.execute(stmt)
+            session.execute(stmt, update_list)
+        if len(insert_list) > 0:
+            session.execute(users.insert(), insert_list)
         session.commit()
     except exc.SQLAlchemyError as e:
         if session.is_active:
             session.rollback()
         log_error(e)
+        # данные не потеряны - запись повторится при следующем вызове, более новые изменения сохраняются
+        for user_id, user_data in dirty_users.items():
+            _dirty_users.setdefault(user_id, user_data)
+        return 0
+    return len(dirty_users)
 
-def get_user_class(user_id) -> int:
-    """"
-    Получение информации о последнем запрошенном пользователем классе
-    """
-    users_data = session.query(users).filter(users.c.id == user_id).first()
-    if users_data is None:
-        return None
-    else:
-        return users_data.class_id
+# Ошибки, ожидающие записи в базу: trace_hash -> данные последнего повторения и количество повторений
+_error_buffer: dict = {}
+# Блокировка буфера ошибок - ошибки сохраняются и из потоков пула загрузки расписаний
+_error_lock = threading.Lock()
+# Максимальное количество разных ошибок в буфере
+ERROR_BUFFER_SIZE = 1000
 
 def save_error(user_id: int, traceback: str, update: str, context_chat: str, context_user: str) -> None:
     """"
-    Сохранение информации об ошибка
+    Сохранение информации об ошибке - повторения одной ошибки накапливаются в памяти
+    и записываются в базу пакетом в flush_errors
     """
     def escape_sql_text(text: str) -> str:
         return text.replace("\\", "\\\\").replace("_", "\\_").replace("'", "''")
@@ -544,34 +838,373 @@ def save_error(user_id: int, traceback: str, update: str, context_chat: str, con
     traceback = escape_sql_text(traceback)
     data_for_hash = traceback.encode('utf-8', errors='ignore')
     trace_hash = md5(data_for_hash).hexdigest()
-    error_data = session.query(errors).filter(errors.c.trace_hash == trace_hash).first()
-    if error_data is not None:
-        stmt = errors.update() \
-            .where(errors.c.trace_hash == trace_hash) \
-            .values(
-                {
-                    errors.c.created: datetime.datetime.now(),
-                    errors.c.user_id: user_id,
-                    errors.c.update_data: escape_sql_text(update),
-                    errors.c.context_chat: escape_sql_text(context_chat),
-                    errors.c.context_user: escape_sql_text(context_user),
-                    errors.c.error_count: error_data.error_count + 1
-                }
+    update = escape_sql_text(update)
+    context_chat = escape_sql_text(context_chat)
+    context_user = escape_sql_text(context_user)
+    with _error_lock:
+        error = _error_buffer.get(trace_hash)
+        if error is None:
+            if len(_error_buffer) >= ERROR_BUFFER_SIZE:
+                logging.warning(f"Error buffer is full. Error {trace_hash} is not saved")
+                return
+            error = {"traceback": traceback, "trace_hash": trace_hash, "error_count": 0}
+            _error_buffer[trace_hash] = error
+        error["created"] = datetime.datetime.now()
+        error["user_id"] = user_id
+        error["update_data"] = update
+        error["context_chat"] = context_chat
+        error["context_user"] = context_user
+        error["error_count"] += 1
+
+def flush_errors() -> int:
+    """
+    Запись накопленных ошибок в базу одним пакетом - повторения добавляются к количеству уже записанной ошибки
+    Возвращает количество записанных разных ошибок
+    """
+    global _error_buffer
+    # буфер заменяется новым под блокировкой - ошибки, сохраненные во время записи, попадут в новый буфер
+    with _error_lock:
+        if len(_error_buffer) == 0:
+            return 0
+        error_list = list(_error_buffer.values())
+        _error_buffer = {}
+    try:
+        saved_counts = {}
+        for error_data in session.query(errors.c.trace_hash, errors.c.error_count) \
+                .filter(errors.c.trace_hash.in_([error["trace_hash"] for error in error_list])):
+            saved_counts[error_data.trace_hash] = error_data.error_count or 0
+        update_list = []
+        insert_list = []
+        for error in error_list:
+            if error["trace_hash"] in saved_counts:
+                update_list.append({
+                    "b_trace_hash": error["trace_hash"],
+                    "b_created": error["created"],
+                    "b_user_id": error["user_id"],
+                    "b_update_data": error["update_data"],
+                    "b_context_chat": error["context_chat"],
+                    "b_context_user": error["context_user"],
+                    "b_error_count": saved_counts[error["trace_hash"]] + error["error_count"]
+                })
+            else:
+                insert_list.append(error)
+        if len(update_list) > 0:
+            stmt = errors.update() \
+                .where(errors.c.trace_hash == db_sql.bindparam("b_trace_hash")) \
+                .values(
+                    created = db_sql.bindparam("b_created"),
+                    user_id = db_sql.bindparam("b_user_id"),
+                    update_data = db_sql.bindparam("b_update_data"),
+                    context_chat = db_sql.bindparam("b_context_chat"),
+                    context_user = db_sql.bindparam("b_context_user"),
+                    error_count = db_sql.bindparam("b_error_count")
+                )
+            session.execute(stmt, update_list)
+        if len(insert_list) > 0:
+            session.execute(errors.insert(), insert_list)
+        session.commit()
+    except exc.SQLAlchemyError as e:
+        if session.is_active:
+            session.rollback()
+        logging.error(f"Error save errors {e}")
+        # ошибки не потеряны - возвращаем в буфер, повторения после чтения буфера складываются
+        with _error_lock:
+            for error in error_list:
+                newer = _error_buffer.get(error["trace_hash"])
+                if newer is None:
+                    _error_buffer[error["trace_hash"]] = error
+                else:
+                    newer["error_count"] += error["error_count"]
+        return 0
+    return len(error_list)
+
+def save_schedule_changes(class_id: int, old_hash: str, new_hash: str, changes: list) -> None:
+    """
+    Сохранение списка изменений расписания класса
+    """
+    if len(changes) == 0:
+        return
+    created = datetime.datetime.now()
+    try:
+        for change in changes:
+            stmt = schedule_changes.insert().values(
+                class_id = class_id,
+                old_hash = old_hash,
+                new_hash = new_hash,
+                kind = change.kind,
+                week = change.week,
+                hour_start = None if change.hour_start is None else str(change.hour_start),
+                day_of_week = change.day_of_week,
+                day_number = change.day_of_week_number,
+                old_value = change.old_value,
+                new_value = change.new_value,
+                created = created
             )
-    else:
-        stmt = errors.insert().values(
-            created = datetime.datetime.now(),
-            user_id = user_id,
-            traceback = traceback,
-            update_data = escape_sql_text(update),
-            context_chat = escape_sql_text(context_chat),
-            context_user = escape_sql_text(context_user),
-            trace_hash = trace_hash,
-            error_count = 1
-        )
+            session.execute(stmt)
+        session.commit()
+    except exc.SQLAlchemyError as e:
+        if session.is_active:
+            session.rollback()
+        log_error(e)
+
+def get_pending_changes() -> dict:
+    """
+    Получение не отправленных пользователям изменений расписаний
+    Возвращает словарь class_id -> список изменений
+    """
+    from schedule_diff import LessonChange
+    result = {}
+    changes_data = session.query(schedule_changes) \
+        .filter(schedule_changes.c.notified == None) \
+        .order_by(schedule_changes.c.class_id, schedule_changes.c.id)
+    for change_data in changes_data:
+        change = LessonChange(
+            change_data.kind,
+            change_data.week,
+            change_data.hour_start,
+            change_data.day_of_week,
+            change_data.day_number,
+            change_data.old_value,
+            change_data.new_value)
+        if change_data.class_id not in result:
+            result[change_data.class_id] = []
+        result[change_data.class_id].append(change)
+    return result
+
+def set_changes_notified(class_id: int) -> None:
+    """
+    Отметка об отправке уведомлений об изменениях расписания класса
+    """
     try:
+        stmt = schedule_changes.update() \
+            .where(schedule_changes.c.class_id == class_id) \
+            .where(schedule_changes.c.notified == None) \
+            .values(notified = datetime.datetime.now())
         session.execute(stmt)
         session.commit()
-    except exc.SQLAlchemyError:
+    except exc.SQLAlchemyError as e:
+        if session.is_active:
+            session.rollback()
+        log_error(e)
+
+def get_class_users(class_id: int) -> list:
+    """
+    Получение списка пользователей, последний раз запрашивавших класс class_id
+    """
+    flush_user_classes()
+    users_data = session.query(users.c.id).filter(users.c.class_id == class_id)
+    return [user_data.id for user_data in users_data]
+
+def save_pending_messages(message_list: list) -> list:
+    """
+    Сохранение сообщений очереди отправки (chat_id, text, parse_mode, priority)
+    Возвращает список идентификаторов сообщений
+    """
+    ids = []
+    created = datetime.datetime.now()
+    try:
+        for chat_id, text, parse_mode, priority in message_list:
+            stmt = send_queue.insert().values(
+                chat_id = chat_id,
+                text = text,
+                parse_mode = parse_mode,
+                priority = priority,
+                created = created
+            )
+            ids.append(session.execute(stmt).inserted_primary_key[0])
+        session.commit()
+    except exc.SQLAlchemyError as e:
+        if session.is_active:
+            session.rollback()
+        log_error(e)
+        ids = [None] * len(message_list)
+    return ids
+
+def delete_pending_messages(ids: list) -> None:
+    """
+    Удаление отправленных сообщений из очереди отправки
+    """
+    try:
+        session.execute(send_queue.delete().where(send_queue.c.id.in_(ids)))
+        session.commit()
+    except exc.SQLAlchemyError as e:
+        if session.is_active:
+            session.rollback()
+        log_error(e)
+
+def load_pending_messages() -> list:
+    """
+    Загрузка не отправленных сообщений очереди отправки
+    """
+    return session.query(send_queue).order_by(send_queue.c.priority, send_queue.c.id).all()
+
+def set_user_digest(user_id: int, digest: bool) -> bool:
+    """
+    Подписка/отписка пользователя от утренней рассылки
+    Возвращает False если пользователь еще не выбирал класс
+    """
+    flush_user_classes()
+    try:
+        result = session.execute(users.update().where(users.c.id == user_id).values(digest = digest))
+        session.commit()
+        return result.rowcount > 0
+    except exc.SQLAlchemyError as e:
+        if session.is_active:
+            session.rollback()
+        log_error(e)
+        return False
+
+def get_user_digest(user_id: int) -> bool:
+    """
+    Подписан ли пользователь на утреннюю рассылку
+    """
+    users_data = session.query(users.c.digest).filter(users.c.id == user_id).first()
+    return users_data is not None and bool(users_data.digest)
+
+def get_digest_users() -> dict:
+    """
+    Получение подписанных на утреннюю рассылку пользователей
+    Возвращает словарь class_id -> список пользователей
+    """
+    flush_user_classes()
+    result = {}
+    users_data = session.query(users.c.id, users.c.class_id).filter(users.c.digest == True)
+    for user_data in users_data:
+        if user_data.class_id not in result:
+            result[user_data.class_id] = []
+        result[user_data.class_id].append(user_data.id)
+    return result
+
+def save_calendar_to_db(url: str, calendar_hash: str, week_dict: dict) -> None:
+    """
+    Сохранение учебного календаря date -> week
+    Пустой календарь не сохраняется - сохраненный ранее календарь не удаляется
+    """
+    if len(week_dict) == 0:
+        return
+    try:
+        session.execute(calendar_weeks.delete().where(calendar_weeks.c.url == url))
+        session.execute(calendar_weeks.insert(), [
+            {"url": url, "date": date, "hash": calendar_hash, "week": week} for date, week in week_dict.items()
+        ])
+        session.commit()
+    except exc.SQLAlchemyError as e:
+        if session.is_active:
+            session.rollback()
+        log_error(e)
+
+def load_calendar_from_db(url: str, calendar_hash: str = None) -> tuple:
+    """
+    Загрузка учебного календаря
+    calendar_hash: hash pdf файла, если None - загружается последний сохраненный календарь
+    Возвращает (hash, словарь date -> week)
+    """
+    query = session.query(calendar_weeks).filter(calendar_weeks.c.url == url)
+    if calendar_hash is not None:
+        query = query.filter(calendar_weeks.c.hash == calendar_hash)
+    week_dict = {}
+    saved_hash = None
+    for calendar_data in query:
+        saved_hash = calendar_data.hash
+        week_dict[calendar_data.date] = calendar_data.week
+    return saved_hash, week_dict
+
+# Записи о разборе расписаний, ожидающие записи в базу
+_parse_record_buffer: list = []
+# Блокировка буфера записей о разборе - записи добавляются из потоков пула загрузки расписаний
+_parse_record_lock = threading.Lock()
+
+def add_parse_record(record) -> None:
+    """
+    Добавление записи о разборе расписания - в базу записывается пакетом в flush_parse_records
+    """
+    with _parse_record_lock:
+        _parse_record_buffer.append(record)
+
+def flush_parse_records() -> int:
+    """
+    Запись накопленных записей о разборе расписаний одним пакетом
+    Возвращает количество записанных записей
+    """
+    global _parse_record_buffer
+    with _parse_record_lock:
+        if len(_parse_record_buffer) == 0:
+            return 0
+        record_list = _parse_record_buffer
+        _parse_record_buffer = []
+    try:
+        session.execute(parse_records.insert(), [
+            {
+                "class_id": record.class_id,
+                "url": record.url,
+                "hash": record.hash,
+                "source": record.source.value,
+                "outcome": record.outcome.value,
+                "download_bytes": record.download_bytes,
+                "download_ms": record.download_ms,
+                "db_ms": record.stage_ms.get("db"),
+                "fast_ms": record.stage_ms.get("fast"),
+                "full_ms": record.stage_ms.get("full"),
+                "save_ms": record.stage_ms.get("save"),
+                "lesson_count": record.lesson_count,
+                "parse_path": record.parse_path,
+                "created": record.created
+            } for record in record_list])
+        session.commit()
+    except exc.SQLAlchemyError as e:
+        if session.is_active:
+            session.rollback()
+        log_error(e)
+        return 0
+    return len(record_list)
+
+def get_parse_rollup(days: int = 7) -> list:
+    """
+    Сводка разборов расписаний за days дней по источнику и результату:
+    список (источник, результат, количество, среднее время загрузки, среднее время разбора, максимальное время)
+    """
+    total_ms = db_sql.func.coalesce(parse_records.c.download_ms, 0) + db_sql.func.coalesce(parse_records.c.db_ms, 0) + \
+        db_sql.func.coalesce(parse_records.c.fast_ms, 0) + db_sql.func.coalesce(parse_records.c.full_ms, 0) + \
+        db_sql.func.coalesce(parse_records.c.save_ms, 0)
+    parse_ms = db_sql.func.coalesce(parse_records.c.fast_ms, 0) + db_sql.func.coalesce(parse_records.c.full_ms, 0)
+    rows = session.query(
+            parse_records.c.source,
+            parse_records.c.outcome,
+            db_sql.func.count(),
+            db_sql.func.avg(parse_records.c.download_ms),
+            db_sql.func.avg(parse_ms),
+            db_sql.func.max(total_ms)) \
+        .filter(parse_records.c.created >= datetime.datetime.now() - datetime.timedelta(days = days)) \
+        .group_by(parse_records.c.source, parse_records.c.outcome) \
+        .order_by(parse_records.c.source, parse_records.c.outcome)
+    return [tuple(row) for row in rows]
+
+def get_slowest_parses(days: int = 7, limit: int = 10) -> list:
+    """
+    Самые медленные разборы pdf за days дней: список (url, время загрузки, время разбора, размер, способ разбора)
+    """
+    parse_ms = db_sql.func.coalesce(parse_records.c.fast_ms, 0) + db_sql.func.coalesce(parse_records.c.full_ms, 0)
+    rows = session.query(
+            parse_records.c.url,
+            parse_records.c.download_ms,
+            parse_ms,
+            parse_records.c.download_bytes,
+            parse_records.c.parse_path) \
+        .filter(parse_records.c.created >= datetime.datetime.now() - datetime.timedelta(days = days)) \
+        .filter(parse_records.c.source == "url") \
+        .order_by(parse_ms.desc()) \
+        .limit(limit)
+    return [tuple(row) for row in rows]
+
+def delete_old_parse_records(days: int) -> None:
+    """
+    Удаление записей о разборе расписаний старше days дней
+    """
+    try:
+        session.execute(parse_records.delete().where(
+            parse_records.c.created < datetime.datetime.now() - datetime.timedelta(days = days)))
+        session.commit()
+    except exc.SQLAlchemyError as e:
         if session.is_active:
             session.rollback()
+        log_error(e)
@@ -0,0 +1,145 @@
+"""
+Модуль локального RESP сервера - проверка RespBackend и блокировки лидера без Redis
+Сервер поддерживает только команды, которые использует RespBackend
+"""
+import sys
+import time
+import logging
+import threading
+import socketserver
+from state_backend import MemoryBackend, LeaderLock, create_backend, COMPARE_EXPIRE_SCRIPT, COMPARE_DELETE_SCRIPT
+
+class FakeRespServer(socketserver.ThreadingTCPServer):
+    """
+    Локальный RESP сервер, данные хранятся в MemoryBackend
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address: tuple = ("127.0.0.1", 0)):
+        """
+        Конструктор класса
+        """
+        self.backend = MemoryBackend()
+        super().__init__(address, FakeRespHandler)
+
+class FakeRespHandler(socketserver.StreamRequestHandler):
+    """
+    Обработка команд клиента тестового сервера
+    """
+    def read_command(self) -> list:
+        """ Чтение команды - массива строк байт """
+        line = self.rfile.readline()
+        if not line.startswith(b"*"):
+            return None
+        args = []
+        for _ in range(int(line[1:-2])):
+            length = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def eval(self, script: str, args: list) -> bytes:
+        """ Выполнение скриптов блокировки лидера - других скриптов сервер не поддерживает """
+        backend: MemoryBackend = self.server.backend
+        key = args[1].decode("utf-8")
+        if script == COMPARE_EXPIRE_SCRIPT:
+            return b":%d\r\n" % backend.compare_expire(key, args[2], int(args[3]) / 1000)
+        if script == COMPARE_DELETE_SCRIPT:
+            return b":%d\r\n" % backend.compare_delete(key, args[2])
+        return b"-ERR unknown script\r\n"
+
+    def handle(self) -> None:
+        backend: MemoryBackend = self.server.backend
+        while True:
+            args = self.read_command()
+            if args is None:
+                return
+            command, args = args[0].upper().decode("utf-8"), args[1:]
+            key = args[0].decode("utf-8") if args else None
+            if command in ("PING", "SELECT", "AUTH"):
+                reply = b"+OK\r\n"
+            elif command == "GET":
+                reply = self.bulk(backend.get(key))
+            elif command == "SET":
+                options = [arg.upper() for arg in args[2:]]
+                ttl = int(options[options.index(b"PX") + 1]) / 1000 if b"PX" in options else None
+                reply = b"+OK\r\n" if backend.set(key, args[1], ttl, b"NX" in options) else b"$-1\r\n"
+            elif command == "PEXPIRE":
+                reply = b":%d\r\n" % backend.expire(key, int(args[1]) / 1000)
+            elif command == "DEL":
+                backend.delete(key)
+                reply = b":1\r\n"
+            elif command == "HSET":
+                backend.hset(key, args[1], args[2])
+                reply = b":1\r\n"
+            elif command == "HGET":
+                reply = self.bulk(backend.hget(key, args[1]))
+            elif command == "HDEL":
+                backend.hdel(key, args[1])
+                reply = b":1\r\n"
+            elif command == "HGETALL":
+                items = [value for item in backend.hgetall(key).items() for value in item]
+                reply = b"*%d\r\n" % len(items) + b"".join(self.bulk(item) for item in items)
+            elif command == "EVAL":
+                reply = self.eval(key, args[1:])
+            else:
+                reply = b"-ERR unknown command '%s'\r\n" % command.encode("utf-8")
+            self.wfile.write(reply)
+
+    @staticmethod
+    def bulk(value: bytes) -> bytes:
+        """ Строка байт в формате RESP """
+        return b"$-1\r\n" if value is None else b"$%d\r\n%s\r\n" % (len(value), value)
+
+def check(condition: bool, message: str) -> None:
+    """ Проверка условия - при ошибке проверка прерывается """
+    if not condition:
+        raise RuntimeError(f"Check failed: {message}")
+
+def main():
+    """
+    Проверка RespBackend и блокировки лидера на локальном тестовом сервере
+    """
+    if not logging.getLogger().hasHandlers():
+        logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    server = FakeRespServer()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+    backend = create_backend(f"redis://{host}:{port}/0")
+    try:
+        check(backend.get("missing") is None, "missing key")
+        check(backend.set("key", b"value\r\n", 0.2), "set with ttl")
+        check(backend.get("key") == b"value\r\n", "get binary value")
+        check(not backend.set("key", b"other", only_new=True), "set only new")
+        time.sleep(0.3)
+        check(backend.get("key") is None, "key expired")
+        backend.set_object("object", {"lessons": [1, 2, 3]})
+        check(backend.get_object("object") == {"lessons": [1, 2, 3]}, "pickled object")
+        check(backend.throttle("throttle:1", "CLASS", 0.2), "first request")
+        check(not backend.throttle("throttle:1", "CLASS", 0.2), "repeated request")
+        check(backend.throttle("throttle:1", "WEEK", 0.2), "other request")
+        backend.hset("user_data", b"1", b"0")
+        backend.hset("user_data", b"3", b"1")
+        backend.hdel("user_data", b"1")
+        check(backend.hgetall("user_data") == {b"3": b"1"}, "hash fields")
+        check(backend.hget("user_data", b"3") == b"1" and backend.hget("user_data", b"1") is None, "hash field")
+
+        first = LeaderLock(backend, "test", 0.3)
+        second = LeaderLock(create_backend(f"redis://{host}:{port}/0"), "test", 0.3)
+        check(first.acquire() and not second.acquire(), "lock acquired by first")
+        check(first.acquire() and not second.acquire(), "lock renewed by first")
+        time.sleep(0.4)
+        # блокировка не продлевалась - ее захватывает другая реплика, прежний владелец не может ее продлить или удалить
+        check(second.acquire() and not first.acquire(), "expired lock acquired by second")
+        check(not backend.compare_delete("lock:test", b"not owner"), "lock not deleted by not owner")
+        check(second.acquire(), "lock kept by second")
+        second.release()
+        check(first.acquire(), "lock acquired after release")
+        print("state backend: ok")
+    finally:
+        backend.close()
+        server.shutdown()
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
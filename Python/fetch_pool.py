@@ -0,0 +1,78 @@
+"""
+Модуль пула потоков загрузки расписаний - обращения к сети и разбор pdf выполняются вне цикла событий бота
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import config as cfg
+from schedule_parser import School, SchoolClass
+from week_pdf_parser import WeekSchedule
+
+class FetchPool:
+    """
+    Ограниченный пул потоков - одновременно выполняется не более workers загрузок,
+    остальные ожидают в очереди пула
+    """
+    def __init__(self, workers: int):
+        """
+        Конструктор класса
+        workers: количество потоков пула
+        """
+        self.__workers: int = max(1, workers)
+        # пул создается при первой загрузке
+        self.__executor: ThreadPoolExecutor = None
+
+    @property
+    def workers(self) -> int:
+        """ Количество потоков пула """
+        return self.__workers
+
+    async def run(self, func, *args) -> any:
+        """
+        Выполнение func(*args) в пуле потоков с ожиданием результата
+        """
+        if self.__executor is None:
+            self.__executor = ThreadPoolExecutor(max_workers=self.__workers, thread_name_prefix="fetch")
+        return await asyncio.get_running_loop().run_in_executor(self.__executor, func, *args)
+
+    async def refresh_school(self, school: School) -> bool:
+        """
+        Обновление расписания школы по сети
+        """
+        return await self.run(school.refresh)
+
+    async def load_week_schedule(self, school_class: SchoolClass, revalidate: bool = False) -> WeekSchedule:
+        """
+        Загрузка расписания класса - загружается копия, обработчики читают прежнее расписание до его замены
+        revalidate: проверка по сети, иначе до фоновой проверки расписание загружается из базы
+        """
+        week_schedule = school_class.detached_week_schedule()
+        await self.run(week_schedule.parse if revalidate else week_schedule.load)
+        school_class.attach_week_schedule(week_schedule)
+        return week_schedule
+
+    async def load_shared_week_schedule(self, school_class: SchoolClass) -> WeekSchedule:
+        """
+        Загрузка расписания класса, опубликованного репликой-лидером - копия заменяет прежнее расписание,
+        только если лидер его уже опубликовал
+        """
+        week_schedule = school_class.detached_week_schedule()
+        if await self.run(week_schedule.load_shared):
+            school_class.attach_week_schedule(week_schedule)
+        return school_class.loaded_week_schedule
+
+    def shutdown(self, wait: bool = True) -> None:
+        """
+        Остановка пула - с ожиданием выполняемых загрузок
+        """
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=wait)
+            self.__executor = None
+
+# Пул загрузки расписаний бота
+fetch_pool = FetchPool(cfg.FETCH_WORKERS)
+
+def main():
+    raise SystemError("This file cannot be operable")
+
+if __name__ == "__main__":
+    main()
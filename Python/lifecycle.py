@@ -0,0 +1,112 @@
+"""
+Модуль управления жизненным циклом бота - действия при запуске и остановке
+"""
+import logging
+from telegram.ext import Application
+import config as cfg
+from metrics import metrics_exporter
+from data import BotData
+from database import load_user_cache, flush_user_classes, flush_errors, flush_parse_records, close_db
+from week_pdf_parser import close_http_session
+from school_registry import school_registry
+from send_queue import send_queue
+from fetch_pool import fetch_pool
+from calendar_parser import academic_calendar
+from state_backend import state_backend, leader_lock
+
+class Lifecycle:
+    """
+    Запуск и остановка бота
+    Порядок остановки в run_polling:
+    stop (обработка обновлений и задания job_queue завершаются с ожиданием выполняемых) -> post_stop ->
+    shutdown (запись PicklePersistence) -> post_shutdown
+    """
+    def __init__(self):
+        """
+        Конструктор класса
+        """
+        self.__started: bool = False
+        self.__stopped: bool = False
+
+    @property
+    def started(self) -> bool:
+        """ Бот запущен и кеши загружены """
+        return self.__started
+
+    @property
+    def stopped(self) -> bool:
+        """ Бот остановлен """
+        return self.__stopped
+
+    @staticmethod
+    def warm_caches(application: Application) -> None:
+        """
+        Загрузка кешей в памяти из базы до начала обработки обновлений
+        """
+        users_count = load_user_cache()
+        # учебный календарь при отложенном запуске загружается из базы, по сети его обновит задание calendar_job
+        if not (cfg.LAZY_STARTUP and academic_calendar.load_cached()):
+            academic_calendar.load()
+        if "BotData" not in application.bot_data:
+            application.bot_data["BotData"] = BotData()
+        school = application.bot_data["BotData"].school
+        # расписания классов загружаются только из базы, без обращения к сети -
+        # классы, которых нет в базе, загрузит задание store_job
+        loaded_count = 0
+        for department in school.departments:
+            for school_class in department.class_list:
+                if school_class.loaded_week_schedule is not None:
+                    continue
+                week_schedule = school_class.detached_week_schedule()
+                if week_schedule.load_cached():
+                    school_class.attach_week_schedule(week_schedule)
+                    loaded_count += 1
+        classes_count = school_registry.update_indexes(school)
+        school_registry.school_index(school)
+        logging.info(f"Caches warmed: {users_count} users, {loaded_count} class schedules loaded from Db, {classes_count} classes indexed")
+
+    async def post_init(self, application: Application) -> None:
+        """
+        Действия после инициализации бота, до начала обработки обновлений
+        """
+        leader_lock.acquire()
+        self.warm_caches(application)
+        send_queue.start(application.bot)
+        if cfg.METRICS_PORT:
+            await metrics_exporter.start()
+        self.__started = True
+
+    async def post_stop(self, application: Application) -> None:
+        """
+        Действия после остановки обработки обновлений и заданий, пока бот еще может отправлять сообщения
+        """
+        await send_queue.stop()
+        await metrics_exporter.stop()
+        # задания остановлены - дожидаемся загрузок, начатых ими в пуле потоков
+        fetch_pool.shutdown()
+
+    async def post_shutdown(self, application: Application) -> None:
+        """
+        Действия после остановки бота - запись накопленных данных, закрытие соединений
+        """
+        if self.__stopped:
+            return
+        self.__stopped = True
+        users_count = flush_user_classes()
+        errors_count = flush_errors()
+        records_count = flush_parse_records()
+        logging.info(f"Flushed {users_count} users, {errors_count} errors, {records_count} parse records")
+        leader_lock.release()
+        state_backend.close()
+        close_http_session()
+        close_db()
+        logging.info("Bot stopped")
+
+# Жизненный цикл бота
+lifecycle = Lifecycle()
+
+def main():
+    raise SystemError("This file cannot be operable")
+
+if __name__ == "__main__":
+    main()
@@ -3,56 +3,92 @@
 python-telegram-bot
 """
 import sys
+import asyncio
 import logging
 import traceback
-from warnings import filterwarnings
 from datetime import datetime
-from telegram.ext import Application, ContextTypes, CommandHandler, MessageHandler, filters, CallbackQueryHandler, ConversationHandler, PicklePersistence
+from telegram.ext import Application, ContextTypes, CommandHandler, MessageHandler, filters, CallbackQueryHandler, PicklePersistence, InlineQueryHandler
 from telegram import User, Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import ParseMode
-from telegram.warnings import PTBUserWarning
 import config as cfg
+from metrics import metrics
 from schedule_parser import School, Department, SchoolClass
-from week_pdf_parser import Lesson, WeekSchedule
-from data import MenuData, create_context_data, get_school_object, get_school, IntervalError
-from data import DEPARTMENT_OBJECT, CLASS_OBJECT, WEEK_SCHEDULE_OBJECT, WEEK_OBJECT, DAY_OF_WEEK_OBJECT, LESSONS_OBJECT
-from database import save_user_class, get_user_class, save_error
+from week_pdf_parser import Lesson, WeekSchedule, DayOfWeek
+from data import MenuData, create_context_data, get_school_object, get_school, get_user_school, load_menu_school, lessons_message, get_inline_results, get_current_week, IntervalError
+from data import SCHOOL_OBJECT, DEPARTMENT_OBJECT, CLASS_OBJECT, WEEK_SCHEDULE_OBJECT, WEEK_OBJECT, DAY_OF_WEEK_OBJECT, LESSONS_OBJECT
+from database import init_db, save_user_class, get_user_class, save_error, get_pending_changes, set_changes_notified, get_class_users
+from database import set_user_digest, get_digest_users
+from database import flush_errors, flush_parse_records, flush_user_classes, get_parse_rollup, get_slowest_parses, delete_old_parse_records
+from schedule_diff import changes_message
+from send_queue import send_queue, PRIORITY_LOW
+from time_index import ClassTimeIndex, get_time_index, current_lesson_number
+from schedule_store import unloaded_classes
+from school_registry import school_registry
+from fetch_pool import fetch_pool
+from calendar_parser import academic_calendar
+from lifecycle import lifecycle
+from state_backend import state_backend, leader_lock
+from state_persistence import BackendPersistence
 import messages
 
+# Значения, возвращаемые обработчиками меню - меню не хранит состояния диалога, значения не используются
 START_ROUTES, END_ROUTES = range(2)
 
-async def send_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+@metrics.timed("handler")
+async def send_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """
-    Отправка сообщения
+    Текстовое сообщение - поиск класса по названию "10а", "10 A", "10-А"
     """
-    await context.bot.send_message(chat_id=update.effective_chat.id, text=messages.HELLO_MESSAGE)
+    school: School = await get_school(context, update.effective_user.id)
+    class_list = school_registry.school_index(school).match_classes(update.message.text) if school is not None else []
+    if len(class_list) == 1:
+        # Класс найден - сразу показать выбор недели/дня недели
+        class_: SchoolClass = class_list[0]
+        menu_data = MenuData(class_.department.id, class_.id)
+        await load_menu_school(menu_data)
+        reply_markup, error_message = keyboard_button_week(menu_data, context)
+        if error_message:
+            await update.message.reply_text(error_message)
+            return START_ROUTES
+        await update.message.reply_text(f"{class_.name}/{class_.department.name}", reply_markup=reply_markup)
+        return START_ROUTES
+    if 1 < len(class_list) <= 20:
+        keyboard = []
+        for class_ in class_list:
+            button = [InlineKeyboardButton(f"{class_.name}/{class_.department.name}", callback_data=MenuData(class_.department.id, class_.id).encode(CLASS_OBJECT))]
+            keyboard.append(button)
+        await update.message.reply_text(messages.CHOICE_CLASS_MESSAGE, reply_markup=InlineKeyboardMarkup(keyboard))
+        return START_ROUTES
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=messages.HELLO_MESSAGE, reply_markup=await keyboard_button_school(update, context))
+    return START_ROUTES
 
-def keyboard_button_school(update: Update, context: ContextTypes.DEFAULT_TYPE) -> InlineKeyboardMarkup:
+async def keyboard_button_school(update: Update, context: ContextTypes.DEFAULT_TYPE) -> InlineKeyboardMarkup:
     """
     Добавление кнопки расписание школы
+    Школа выбранного пользователем класса загружается в пуле потоков
     """
     keyboard = [
-        [InlineKeyboardButton(messages.SCHEDULE_MESSAGE, callback_data="SCHOOL")],
+        [InlineKeyboardButton(messages.SCHEDULE_MESSAGE, callback_data=MenuData().encode(SCHOOL_OBJECT))],
     ]
 
     user_id = update.effective_user.id
     class_id = get_user_class(user_id)
     if class_id is not None:
-        school: School = get_school(context, user_id)
-        class_: SchoolClass = school.get_class_by_id(class_id)
+        class_: SchoolClass = await school_registry.find_class(class_id)
         if class_ is not None:
-            button = [InlineKeyboardButton(class_.name, callback_data=MenuData(class_.department.id, class_.id).to_string(CLASS_OBJECT))]
+            button = [InlineKeyboardButton(class_.name, callback_data=MenuData(class_.department.id, class_.id).encode(CLASS_OBJECT))]
             keyboard.append(button)
 
     return InlineKeyboardMarkup(keyboard)
 
+@metrics.timed("handler")
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """
     Отправить сообщение, когда выполнена команда /start.
     """
     user: User = update.effective_user
     logging.info(f"command start for {user.id}")
-    reply_markup: InlineKeyboardMarkup = keyboard_button_school(update, context)
+    reply_markup: InlineKeyboardMarkup = await keyboard_button_school(update, context)
     create_context_data(context, user.id)
 
     await update.message.reply_text(
@@ -61,28 +97,34 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     )
     return START_ROUTES
 
+@metrics.timed("handler")
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """
     Отправить сообщение, когда выполнена команда /help.
     """
     user: User = update.effective_user
     logging.info(f"command help for {user.id}")
-    reply_markup: InlineKeyboardMarkup = keyboard_button_school(update, context)
+    reply_markup: InlineKeyboardMarkup = await keyboard_button_school(update, context)
     create_context_data(context, user.id)
 
     await update.message.reply_text(
-        "/start - Начало работы бота\n/help - Список команд\n/about - Описание бота",
+        "/start - Начало работы бота\n/help - Список команд\n/about - Описание бота\n" \
+        "/today - Расписание на сегодня\n/now - Текущий и следующий урок\n" \
+        "/teacher - Расписание преподавателя на день\n" \
+        "/rooms - Свободные кабинеты корпуса\n" \
+        "/digest - Утренняя рассылка расписания на день (/digest off - отключить)",
         reply_markup=reply_markup,
     )
     return START_ROUTES
 
+@metrics.timed("handler")
 async def about(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """
     Отправить сообщение, когда выполнена команда /about.
     """
     user: User = update.effective_user
     logging.info(f"command about for {user.id}")
-    reply_markup: InlineKeyboardMarkup = keyboard_button_school(update, context)
+    reply_markup: InlineKeyboardMarkup = await keyboard_button_school(update, context)
     create_context_data(context, user.id)
 
     await update.message.reply_text(
@@ -91,6 +133,201 @@ async def about(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     )
     return START_ROUTES
 
+@metrics.timed("handler")
+async def digest_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Подписка на утреннюю рассылку, когда выполнена команда /digest [on|off]
+    """
+    user: User = update.effective_user
+    logging.info(f"command digest for {user.id}")
+    if context.args and context.args[0].lower() == "off":
+        set_user_digest(user.id, False)
+        await update.message.reply_text(messages.DIGEST_OFF_MESSAGE)
+    elif set_user_digest(user.id, True):
+        await update.message.reply_text(messages.DIGEST_ON_MESSAGE)
+    else:
+        await update.message.reply_text(messages.DIGEST_NO_CLASS_MESSAGE, reply_markup=await keyboard_button_school(update, context))
+
+async def get_user_week_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE) -> any:
+    """
+    Расписание последнего выбранного пользователем класса
+    Школа и расписание класса, которых нет в памяти, загружаются в пуле потоков
+    """
+    class_id = get_user_class(update.effective_user.id)
+    if class_id is None:
+        return None, messages.NO_CLASS_MESSAGE
+    class_: SchoolClass = await school_registry.find_class(class_id)
+    if class_ is None:
+        return None, messages.NO_CLASS_MESSAGE
+    week_schedule: WeekSchedule = class_.loaded_week_schedule
+    if week_schedule is None:
+        week_schedule = await fetch_pool.load_week_schedule(class_)
+    if not week_schedule.last_parse_result or len(week_schedule.week_list()) == 0:
+        return None, f"{week_schedule.last_parse_error}\n{class_.link}"
+    return week_schedule, None
+
+@metrics.timed("handler")
+async def today_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Расписание на сегодня, когда выполнена команда /today
+    """
+    logging.info(f"command today for {update.effective_user.id}")
+    week_schedule: WeekSchedule
+    week_schedule, error_message = await get_user_week_schedule(update, context)
+    if error_message:
+        await update.message.reply_text(error_message, reply_markup=await keyboard_button_school(update, context))
+        return
+    week_list = week_schedule.week_list()
+    week = get_current_week(week_list) or week_list[0]
+    time_index: ClassTimeIndex = get_time_index(week_schedule)
+    lesson_list = time_index.day_lessons(week, datetime.now(cfg.TIMEZONE).weekday())
+    if len(lesson_list) == 0:
+        await update.message.reply_text(messages.NO_LESSONS_MESSAGE)
+        return
+    school_class: SchoolClass = week_schedule.school_class
+    message = f"Расписание для класса {school_class.name}/{school_class.department.name}\n\n{lesson_list[0].ident.day_of_week}:\n"
+    lesson: Lesson
+    for lesson in lesson_list:
+        message += f"{lesson.to_str(parse_mode = ParseMode.HTML)}\n"
+    await update.message.reply_text(message, parse_mode=ParseMode.HTML)
+
+@metrics.timed("handler")
+async def now_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Текущий и следующий урок, когда выполнена команда /now
+    """
+    logging.info(f"command now for {update.effective_user.id}")
+    week_schedule: WeekSchedule
+    week_schedule, error_message = await get_user_week_schedule(update, context)
+    if error_message:
+        await update.message.reply_text(error_message, reply_markup=await keyboard_button_school(update, context))
+        return
+    week_list = week_schedule.week_list()
+    week = get_current_week(week_list) or week_list[0]
+    now = datetime.now(cfg.TIMEZONE)
+    time_index: ClassTimeIndex = get_time_index(week_schedule)
+    current, next_lesson = time_index.current_and_next(week, now.weekday(), now.hour * 60 + now.minute)
+    school_class: SchoolClass = week_schedule.school_class
+    message = f"Класс {school_class.name}/{school_class.department.name}\n"
+    if current is not None:
+        message += f"Сейчас: {current.to_str(parse_mode = ParseMode.HTML)}\n"
+    else:
+        message += "Сейчас урока нет\n"
+    if next_lesson is not None:
+        day = ""
+        if next_lesson.ident.day_of_week_number != now.weekday():
+            day = f"{next_lesson.ident.day_of_week} "
+        message += f"Далее: {day}{next_lesson.to_str(parse_mode = ParseMode.HTML)}\n"
+    await update.message.reply_text(message, parse_mode=ParseMode.HTML)
+
+@metrics.timed("handler")
+async def teacher_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Расписание преподавателя на день, когда выполнена команда /teacher Фамилия [день недели]
+    """
+    logging.info(f"command teacher for {update.effective_user.id}")
+    args = list(context.args or [])
+    if len(args) == 0:
+        await update.message.reply_text(messages.TEACHER_USAGE_MESSAGE)
+        return
+    now = datetime.now(cfg.TIMEZONE)
+    day_number = now.weekday()
+    # преподаватели ищутся в школе выбранного пользователем класса
+    school: School = await get_user_school(context, update.effective_user.id)
+    if len(args) > 1:
+        arg_day = school_registry.school_index(school).find_day(args[-1])
+        if arg_day is not None:
+            day_number = arg_day
+            args = args[:-1]
+    teacher_index = school_registry.indexes(school).teacher_index
+    teacher_list = teacher_index.find_teachers(" ".join(args))
+    if len(teacher_list) == 0:
+        await update.message.reply_text(messages.TEACHER_NOT_FOUND_MESSAGE)
+        return
+    if len(teacher_list) > 1:
+        await update.message.reply_text("Найдено несколько преподавателей:\n" + "\n".join(teacher_list[:20]))
+        return
+    teacher = teacher_list[0]
+    week = academic_calendar.current_week(now.date()) or 1
+    lesson_list = teacher_index.day_lessons(teacher, day_number, week)
+    message = f"Расписание преподавателя {teacher}:\n"
+    if len(lesson_list) == 0:
+        message += "Уроков нет"
+    for lesson in lesson_list:
+        message += f"{lesson.day_of_week} {lesson.to_str()}\n"
+    await update.message.reply_text(message)
+
+@metrics.timed("handler")
+async def rooms_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Свободные кабинеты корпуса выбранного класса, когда выполнена команда /rooms [день недели] [номер урока]
+    """
+    logging.info(f"command rooms for {update.effective_user.id}")
+    class_id = get_user_class(update.effective_user.id)
+    class_: SchoolClass = await school_registry.find_class(class_id) if class_id is not None else None
+    if class_ is None:
+        await update.message.reply_text(messages.NO_CLASS_MESSAGE, reply_markup=await keyboard_button_school(update, context))
+        return
+    school: School = class_.department.school
+    now = datetime.now(cfg.TIMEZONE)
+    day_number = now.weekday()
+    hour = current_lesson_number(now.hour * 60 + now.minute)
+    for arg in context.args or []:
+        if arg.isdigit():
+            hour = int(arg)
+        else:
+            arg_day = school_registry.school_index(school).find_day(arg)
+            if arg_day is None:
+                await update.message.reply_text(messages.ROOMS_USAGE_MESSAGE)
+                return
+            day_number = arg_day
+    if hour is None:
+        await update.message.reply_text(messages.ROOMS_USAGE_MESSAGE)
+        return
+    week = academic_calendar.current_week(now.date()) or 1
+    office_occupancy = school_registry.indexes(school).office_occupancy
+    office_list = office_occupancy.free_offices(class_.department.id, week, day_number, hour)
+    if len(office_list) == 0:
+        await update.message.reply_text(messages.ROOMS_NOT_FOUND_MESSAGE)
+        return
+    day_name = DayOfWeek.week_names[day_number][1].lower()
+    message = f"Свободные кабинеты {class_.department.name}, {day_name}, {hour} урок:\n" + ", ".join(office_list)
+    await update.message.reply_text(message)
+
+def parse_stats_message() -> str:
+    """
+    Сводка разборов расписаний за неделю и самые медленные pdf
+    """
+    message = "Разбор расписаний за 7 дней:\n"
+    for source, outcome, count, download_ms, parse_ms, max_ms in get_parse_rollup():
+        message += f"{source}/{outcome}: n={count} download={download_ms or 0:.0f} parse={parse_ms or 0:.0f} max={max_ms or 0:.0f} ms\n"
+    message += "Самые медленные pdf:\n"
+    for url, download_ms, parse_ms, download_bytes, parse_path in get_slowest_parses(limit=5):
+        message += f"{url} {parse_path} {download_bytes} bytes download={download_ms or 0:.0f} parse={parse_ms:.0f} ms\n"
+    return message
+
+@metrics.timed("handler")
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Метрики бота для администраторов, когда выполнена команда /stats
+    """
+    logging.info(f"command stats for {update.effective_user.id}")
+    if update.effective_user.id not in cfg.ADMIN_IDS:
+        return
+    await update.message.reply_text(metrics.summary()[-2000:])
+    await update.message.reply_text(parse_stats_message()[-4000:])
+
+def keyboard_button_schools() -> InlineKeyboardMarkup:
+    """
+    Добавление кнопок школ
+    """
+    keyboard = []
+    for url, name in school_registry.school_names().items():
+        button = [InlineKeyboardButton(name, callback_data=MenuData(school=school_registry.key(url)).encode(SCHOOL_OBJECT))]
+        keyboard.append(button)
+    keyboard.append([InlineKeyboardButton(messages.BACK_MESSAGE, callback_data=MenuData().encode(DEPARTMENT_OBJECT))])
+    return InlineKeyboardMarkup(keyboard)
+
 def keyboard_button_departments(menu_data: MenuData, context: ContextTypes.DEFAULT_TYPE) -> any:
     """
     Добавление кнопок корпусов
@@ -102,20 +339,24 @@ def keyboard_button_departments(menu_data: MenuData, context: ContextTypes.DEFAU
     keyboard = []
     department: Department
     for department in school.departments:
-        button = [InlineKeyboardButton(department.name, callback_data=MenuData(department.id).to_string(DEPARTMENT_OBJECT))]
+        button = [InlineKeyboardButton(department.name, callback_data=MenuData(department.id).encode(DEPARTMENT_OBJECT))]
         keyboard.append(button)
-    keyboard.append([InlineKeyboardButton(messages.BACK_MESSAGE, callback_data=MenuData().to_string(DEPARTMENT_OBJECT))])
+    keyboard.append([InlineKeyboardButton(messages.BACK_MESSAGE, callback_data=MenuData().encode(DEPARTMENT_OBJECT))])
     return InlineKeyboardMarkup(keyboard), None
 
-async def school_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+@metrics.timed("handler")
+async def school_button(update: Update, context: ContextTypes.DEFAULT_TYPE, menu_data: MenuData) -> int:
     """
     Нажата кнопка получения расписания школы
     """
     logging.info("command school")
     query = update.callback_query
     await query.answer()
+    if menu_data.school is None and len(school_registry.urls) > 1:
+        # Несколько школ - сначала выбор школы
+        await query.edit_message_text(messages.CHOICE_SCHOOL_MESSAGE, reply_markup=keyboard_button_schools())
+        return START_ROUTES
 
-    menu_data: MenuData = MenuData.from_string(DEPARTMENT_OBJECT, query.data)
     reply_markup, error_message = keyboard_button_departments(menu_data, context)
     if error_message:
         await query.edit_message_text(error_message)
@@ -135,22 +376,22 @@ def keyboard_button_classes(menu_data: MenuData, context: ContextTypes.DEFAULT_T
     keyboard = []
     class_: SchoolClass
     for class_ in department.class_list:
-        button = [InlineKeyboardButton(class_.name, callback_data=MenuData(menu_data.department, class_.id).to_string(CLASS_OBJECT))]
+        button = [InlineKeyboardButton(class_.name, callback_data=MenuData(menu_data.department, class_.id).encode(CLASS_OBJECT))]
         keyboard.append(button)
-    keyboard.append([InlineKeyboardButton(messages.BACK_MESSAGE, callback_data=MenuData().to_string(CLASS_OBJECT))])
+    keyboard.append([InlineKeyboardButton(messages.BACK_MESSAGE, callback_data=MenuData().encode(CLASS_OBJECT))])
     return InlineKeyboardMarkup(keyboard), None
 
-async def department_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+@metrics.timed("handler")
+async def department_button(update: Update, context: ContextTypes.DEFAULT_TYPE, menu_data: MenuData) -> int:
     """
     Нажата кнопка выбора корпуса
     """
     logging.info("command department")
     query = update.callback_query
     await query.answer()
-    menu_data: MenuData = MenuData.from_string(DEPARTMENT_OBJECT, query.data)
     if menu_data.department == -1:
         # Нажата кнопка возврата
-        reply_markup = keyboard_button_school(update, context)
+        reply_markup = await keyboard_button_school(update, context)
         await query.edit_message_text(messages.HELLO_MESSAGE, reply_markup=reply_markup)
         return START_ROUTES
     else:
@@ -176,16 +417,17 @@ def keyboard_button_day_of_week(menu_data: MenuData, context: ContextTypes.DEFAU
 
     keyboard = []
     for index, week_day in enumerate(day_of_week_list):
-        button = [InlineKeyboardButton(week_day, callback_data=MenuData(menu_data.department, menu_data.class_, menu_data.week, index).to_string(DAY_OF_WEEK_OBJECT))]
+        button = [InlineKeyboardButton(week_day, callback_data=MenuData(menu_data.department, menu_data.class_, menu_data.week, index).encode(DAY_OF_WEEK_OBJECT))]
         keyboard.append(button)
     if len(week_list) > 1:
-        keyboard.append([InlineKeyboardButton(f"{messages.BACK_MESSAGE} к N недели", callback_data=MenuData(menu_data.department, menu_data.class_, -2).to_string(DAY_OF_WEEK_OBJECT))])
-    keyboard.append([InlineKeyboardButton(f"{messages.BACK_MESSAGE} к классам", callback_data=MenuData(menu_data.department, menu_data.class_, -1).to_string(DAY_OF_WEEK_OBJECT))])
+        keyboard.append([InlineKeyboardButton(f"{messages.BACK_MESSAGE} к N недели", callback_data=MenuData(menu_data.department, menu_data.class_, -2).encode(DAY_OF_WEEK_OBJECT))])
+    keyboard.append([InlineKeyboardButton(f"{messages.BACK_MESSAGE} к классам", callback_data=MenuData(menu_data.department, menu_data.class_, -1).encode(DAY_OF_WEEK_OBJECT))])
     return InlineKeyboardMarkup(keyboard), None
 
-def keyboard_button_week(menu_data: MenuData, context: ContextTypes.DEFAULT_TYPE) -> InlineKeyboardMarkup:
+def keyboard_button_week(menu_data: MenuData, context: ContextTypes.DEFAULT_TYPE, use_calendar: bool = True) -> InlineKeyboardMarkup:
     """
     Получение списка недель месяца для MenuData
+    use_calendar: если текущая неделя определена по учебному календарю - сразу показать дни недели
     """
     week_list: list
     week_list, error_message = get_school_object(WEEK_OBJECT, menu_data, context)
@@ -194,24 +436,27 @@ def keyboard_button_week(menu_data: MenuData, context: ContextTypes.DEFAULT_TYPE
 
     if len(week_list) == 1:
         return keyboard_button_day_of_week(MenuData(menu_data.department, menu_data.class_, 1), context)
+    current_week = get_current_week(week_list) if use_calendar else None
+    if current_week is not None:
+        return keyboard_button_day_of_week(MenuData(menu_data.department, menu_data.class_, current_week), context)
     elif len(week_list) > 1:
         keyboard = []
         for week in week_list:
-            button = [InlineKeyboardButton(f"Неделя месяца {week}", callback_data=MenuData(menu_data.department, menu_data.class_, week).to_string(WEEK_OBJECT))]
+            button = [InlineKeyboardButton(f"Неделя месяца {week}", callback_data=MenuData(menu_data.department, menu_data.class_, week).encode(WEEK_OBJECT))]
             keyboard.append(button)
-        keyboard.append([InlineKeyboardButton(messages.BACK_MESSAGE, callback_data=MenuData(menu_data.department, -1).to_string(WEEK_OBJECT))])
+        keyboard.append([InlineKeyboardButton(messages.BACK_MESSAGE, callback_data=MenuData(menu_data.department, -1).encode(WEEK_OBJECT))])
         return InlineKeyboardMarkup(keyboard), None
     else:
         return "Ошибка получения списка недель", None
 
-async def class_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+@metrics.timed("handler")
+async def class_button(update: Update, context: ContextTypes.DEFAULT_TYPE, menu_data: MenuData) -> int:
     """
     Нажата кнопка выбора класса
     """
     logging.info("command class")
     query = update.callback_query
     await query.answer()
-    menu_data: MenuData = MenuData.from_string(CLASS_OBJECT, query.data)
     if menu_data.department == -1:
         # Нажата кнопка возврата
         reply_markup, error_message = keyboard_button_departments(menu_data, context)
@@ -229,14 +474,14 @@ async def class_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         await query.edit_message_text(messages.CHOICE_WEEK_MESSAGE, reply_markup=reply_markup)
         return START_ROUTES
 
-async def week_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+@metrics.timed("handler")
+async def week_button(update: Update, context: ContextTypes.DEFAULT_TYPE, menu_data: MenuData) -> int:
     """
     Нажата кнопка выбора недели месяца
     """
     logging.info("command week")
     query = update.callback_query
     await query.answer()
-    menu_data: MenuData = MenuData.from_string(WEEK_OBJECT, query.data)
     if menu_data.class_ == -1:
         # Нажата кнопка возврата к классам
         reply_markup, error_message = keyboard_button_classes(menu_data, context)
@@ -255,14 +500,14 @@ async def week_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
         return START_ROUTES
     return START_ROUTES
 
-async def day_of_week(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+@metrics.timed("handler")
+async def day_of_week(update: Update, context: ContextTypes.DEFAULT_TYPE, menu_data: MenuData) -> int:
     """
     Нажата кнопка выбора дня недели месяца
     """
     logging.info("command day of week")
     query = update.callback_query
     await query.answer()
-    menu_data: MenuData = MenuData.from_string(DAY_OF_WEEK_OBJECT, query.data)
     if menu_data.week == -1:
         # Нажата кнопка возврата к классам
         reply_markup, error_message = keyboard_button_classes(menu_data, context)
@@ -273,7 +518,7 @@ async def day_of_week(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
         return START_ROUTES
     elif menu_data.week == -2:
         # Нажата кнопка возврата к неделям месяца
-        reply_markup, error_message = keyboard_button_week(menu_data, context)
+        reply_markup, error_message = keyboard_button_week(menu_data, context, use_calendar=False)
         if error_message:
             await query.edit_message_text(error_message)
             return START_ROUTES
@@ -297,16 +542,49 @@ async def day_of_week(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
         user_name = update.effective_user.full_name
         save_user_class(user_id, class_id, user_name)
 
-        message = f"Расписание для класса {week_schedule.school_class.name}/{week_schedule.school_class.department.name}\n{week_schedule.school_class.link}\n"
         day_of_week_list = week_schedule.day_of_week_list(menu_data.week)
-        message = f"{message}\n{day_of_week_list[menu_data.day_of_week]}:\n"
-        lesson: Lesson
-        for lesson in lessons:
-            lesson_string = lesson.to_str(parse_mode = ParseMode.HTML)
-            message += f"{lesson_string}\n"
-        await query.edit_message_text(message, parse_mode=ParseMode.HTML)
+        message = lessons_message(week_schedule, menu_data.week, day_of_week_list[menu_data.day_of_week])
+        with metrics.span("telegram", method="edit_message_text"):
+            await query.edit_message_text(message, parse_mode=ParseMode.HTML)
         return START_ROUTES
 
+# Обработчики кнопок меню по типу кнопки
+MENU_HANDLERS: dict = {
+    SCHOOL_OBJECT: school_button,
+    DEPARTMENT_OBJECT: department_button,
+    CLASS_OBJECT: class_button,
+    WEEK_OBJECT: week_button,
+    DAY_OF_WEEK_OBJECT: day_of_week
+}
+
+async def menu_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Нажата кнопка меню - выбор обработчика по типу кнопки из callback_data
+    """
+    query = update.callback_query
+    try:
+        object_type, menu_data = MenuData.decode(query.data)
+    except ValueError as e:
+        logging.warning(e)
+        await query.answer()
+        return START_ROUTES
+    # школа кнопки могла быть вытеснена из памяти - загружаем ее в пуле потоков
+    await load_menu_school(menu_data)
+    return await MENU_HANDLERS[object_type](update, context, menu_data)
+
+@metrics.timed("handler")
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Inline запрос расписания "@bot 10А пн"
+    """
+    query = update.inline_query.query.strip()
+    logging.info(f"inline query {query}")
+    if not query:
+        return
+    school: School = await get_school(context, update.effective_user.id)
+    results = get_inline_results(school, query)
+    await update.inline_query.answer(results, cache_time=cfg.INLINE_CACHE_TIME)
+
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Обработка ошибок
@@ -338,9 +616,147 @@ async def job_handler(context: ContextTypes.DEFAULT_TYPE)-> None:
     now = datetime.now()
     current_time = now.strftime("%d/%m/%Y %H:%M:%S")
     logging.info(f"job_handler {current_time}")
-    school: School = get_school(context, 0)
+    school: School = await get_school(context, 0)
     parse_info = school.last_parse_info
     logging.info(f"last parse error: {parse_info}")
+    logging.info(f"metrics:\n{metrics.summary()}")
+    flush_errors()
+    flush_parse_records()
+    delete_old_parse_records(cfg.PARSE_RECORDS_DAYS)
+    logging.info(parse_stats_message())
+
+async def notify_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Рассылка уведомлений об изменениях расписаний пользователям классов
+    """
+    if not leader_lock.is_leader:
+        return
+    for class_id, changes in get_pending_changes().items():
+        class_: SchoolClass = await school_registry.find_class(class_id)
+        user_list = get_class_users(class_id)
+        if class_ is not None and len(user_list) > 0:
+            has_alternating_week = any(change.week != 1 for change in changes)
+            # Сообщение формируется один раз для всех пользователей класса
+            message = changes_message(f"{class_.name}/{class_.department.name}", changes, has_alternating_week)
+            logging.info(f"notify {len(user_list)} users about {len(changes)} changes of {class_.name}")
+            send_queue.put_many(user_list, message, ParseMode.HTML)
+        set_changes_notified(class_id)
+
+async def digest_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Утренняя рассылка расписания на день подписанным пользователям
+    """
+    if not leader_lock.is_leader:
+        return
+    day_of_week_number = datetime.now(cfg.TIMEZONE).weekday()
+    for class_id, user_list in get_digest_users().items():
+        class_: SchoolClass = await school_registry.find_class(class_id)
+        if class_ is None:
+            continue
+        week_schedule: WeekSchedule = class_.loaded_week_schedule
+        if week_schedule is None:
+            week_schedule = await fetch_pool.load_week_schedule(class_)
+        if not week_schedule.last_parse_result:
+            continue
+        week_list = week_schedule.week_list()
+        if len(week_list) == 0:
+            continue
+        week = get_current_week(week_list) or week_list[0]
+        day_of_week = week_schedule.day_of_week_by_number(week, day_of_week_number)
+        if day_of_week is None:
+            # У класса сегодня нет уроков
+            continue
+        # Расписание формируется один раз для всех пользователей класса
+        message = lessons_message(week_schedule, week, day_of_week)
+        logging.info(f"digest for {class_.name} to {len(user_list)} users")
+        send_queue.put_many(user_list, message, ParseMode.HTML, PRIORITY_LOW)
+
+async def store_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Обновление индексов расписаний всех классов загруженных школ
+    Не загруженные расписания классов загружаются небольшими порциями в пуле потоков
+    """
+    for school in school_registry.loaded_schools():
+        await asyncio.gather(*(fetch_pool.load_week_schedule(school_class)
+                               for school_class in unloaded_classes(school, cfg.STORE_LOAD_BATCH)))
+        updated = school_registry.update_indexes(school)
+        if updated > 0:
+            logging.info(f"schedule indexes of {school.name} updated {updated} classes")
+
+async def school_refresh_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Обновление расписаний школ по их интервалам обновления - за одну проверку обновляется не более
+    SCHOOL_REFRESH_BATCH школ, чтобы нагрузка не росла с количеством школ
+    """
+    if leader_lock.is_leader:
+        await school_registry.refresh_due(cfg.SCHOOL_REFRESH_BATCH)
+
+async def calendar_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Обновление учебного календаря по сети в пуле потоков
+    """
+    await fetch_pool.run(academic_calendar.load)
+
+async def leader_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Захват или продление блокировки лидера реплик бота
+    """
+    leader_lock.acquire()
+
+async def flush_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Запись в базу накопленных данных одним пакетом
+    """
+    flush_errors()
+    flush_parse_records()
+
+async def user_flush_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Запись в базу выбранных пользователями классов
+    """
+    flush_user_classes()
+
+async def revalidate_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Фоновая проверка по сети расписаний загруженных школ - загруженных из базы при запуске
+    и устаревших после обновления школы
+    Загрузка и разбор выполняются в пуле потоков, за одну проверку - не более REVALIDATE_BATCH расписаний классов
+    """
+    if not leader_lock.is_leader:
+        return
+    class_list = []
+    for school in school_registry.loaded_schools():
+        if not school.revalidated:
+            await fetch_pool.refresh_school(school)
+            continue
+        class_list.extend(school_class for department in school.departments for school_class in department.class_list
+                          if school_class.loaded_week_schedule is not None and not school_class.loaded_week_schedule.revalidated)
+    await asyncio.gather(*(fetch_pool.load_week_schedule(school_class, revalidate=True)
+                           for school_class in class_list[:cfg.REVALIDATE_BATCH]))
+
+async def shared_sync_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Загрузка школ и расписаний классов, опубликованных репликой-лидером - только на репликах-последователях
+    Лидер записывает hash каждой школы и расписания в общие словари версий, поэтому проверка - два запроса к хранилищу,
+    а загружаются только изменившиеся школы и расписания
+    """
+    if leader_lock.is_leader or not state_backend.shared:
+        return
+    updated = await school_registry.sync_shared()
+    if updated > 0:
+        logging.info(f"shared state updated {updated} schools")
+    versions = state_backend.get_versions(WeekSchedule.SHARED_VERSIONS)
+    if not versions:
+        return
+    class_list = []
+    for school in school_registry.loaded_schools():
+        for department in school.departments:
+            for school_class in department.class_list:
+                week_schedule = school_class.loaded_week_schedule
+                version = versions.get(str(school_class.id))
+                if week_schedule is not None and version is not None and version != week_schedule.hash:
+                    class_list.append(school_class)
+    await asyncio.gather(*(fetch_pool.load_shared_week_schedule(school_class) for school_class in class_list))
 
 def main() -> None:
     """
@@ -351,40 +767,50 @@ def main() -> None:
         logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
     cfg.disable_logger(["httpcore.connection", "httpcore.http11"])
     cfg.disable_logger(["pdfminer.psparser", "pdfminer.pdfparser", "pdfminer.pdfinterp", "pdfminer.cmapdb", "pdfminer.pdfdocument", "pdfminer.pdfpage"])
+    init_db()
     logging.info("Start bot")
     db_path = cfg.get_data_path()
     file_path = f"{db_path}/bot_persistence"
-    persistence = PicklePersistence(filepath=file_path, update_interval = 50)
+    if cfg.STATE_BACKEND_URL:
+        # данные пользователей и чатов общие для всех реплик
+        persistence = BackendPersistence(state_backend, update_interval = 50)
+    else:
+        persistence = PicklePersistence(filepath=file_path, update_interval = 50)
     application = Application.builder().token(cfg.BOT_TOKEN).persistence(persistence)   \
         .read_timeout(30)  \
         .write_timeout(30) \
+        .post_init(lifecycle.post_init) \
+        .post_stop(lifecycle.post_stop) \
+        .post_shutdown(lifecycle.post_shutdown) \
         .build()
 
-    filterwarnings(action="ignore", message=r".*CallbackQueryHandler", category=PTBUserWarning)
-
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, send_message))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("about", about))
-    conv_handler = ConversationHandler(
-        entry_points=[
-            CommandHandler("start", start)
-        ],
-        states={
-            START_ROUTES: [
-                CallbackQueryHandler(school_button, pattern="^SCHOOL"),
-                CallbackQueryHandler(department_button, pattern="^DEPARTMENT*"),
-                CallbackQueryHandler(class_button, pattern="^CLASS*"),
-                CallbackQueryHandler(week_button, pattern="^WEEK*"),
-                CallbackQueryHandler(day_of_week, pattern="^DAY_OF_WEEK*")
-            ]
-        },
-        fallbacks=[CommandHandler("start", start)],
-        name="bot_conversation",
-        persistent=True,
-    )
-    application.add_handler(conv_handler)
+    application.add_handler(CommandHandler("digest", digest_command))
+    application.add_handler(CommandHandler("today", today_command))
+    application.add_handler(CommandHandler("now", now_command))
+    application.add_handler(CommandHandler("teacher", teacher_command))
+    application.add_handler(CommandHandler("rooms", rooms_command))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(InlineQueryHandler(inline_query))
+    # Меню не хранит состояния диалога - все данные кнопки в callback_data,
+    # поэтому нажатие может обработать любая реплика бота
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CallbackQueryHandler(menu_button))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, send_message))
     job_queue = application.job_queue
     job_queue.run_repeating(job_handler, interval=60*60*12, first=10)
+    job_queue.run_repeating(notify_job, interval=cfg.NOTIFY_INTERVAL, first=60)
+    job_queue.run_repeating(store_job, interval=cfg.STORE_INTERVAL, first=30)
+    job_queue.run_repeating(calendar_job, interval=cfg.CALENDAR_REFRESH_INTERVAL,
+                            first=cfg.REVALIDATE_INTERVAL if cfg.LAZY_STARTUP else cfg.CALENDAR_REFRESH_INTERVAL)
+    job_queue.run_repeating(leader_job, interval=cfg.LEADER_LOCK_RENEW, first=cfg.LEADER_LOCK_RENEW)
+    job_queue.run_repeating(school_refresh_job, interval=cfg.SCHOOL_REFRESH_CHECK, first=cfg.SCHOOL_REFRESH_CHECK)
+    job_queue.run_repeating(flush_job, interval=cfg.FLUSH_INTERVAL, first=cfg.FLUSH_INTERVAL)
+    job_queue.run_repeating(user_flush_job, interval=cfg.USER_FLUSH_INTERVAL, first=cfg.USER_FLUSH_INTERVAL)
+    job_queue.run_repeating(shared_sync_job, interval=cfg.SHARED_SYNC_INTERVAL, first=cfg.SHARED_SYNC_INTERVAL)
+    job_queue.run_repeating(revalidate_job, interval=cfg.REVALIDATE_INTERVAL, first=cfg.REVALIDATE_INTERVAL)
+    job_queue.run_daily(digest_job, time=cfg.DIGEST_TIME, days=cfg.DIGEST_DAYS)
 
     # обработчик ошибок
     application.add_error_handler(error_handler)
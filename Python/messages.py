@@ -6,7 +6,17 @@ HELLO_MESSAGE = """Бот расписание предназначен для 
 Используй команду /start для начала работы /help для получения списка команд"""
 SCHEDULE_MESSAGE = "Расписание уроков:"
 BACK_MESSAGE = "<<Назад"
+CHOICE_SCHOOL_MESSAGE = "Выберите школу:"
 CHOICE_DEPARTMENT_MESSAGE = "Выберите корпус:"
 CHOICE_CLASS_MESSAGE = "Выберите класс:"
 CHOICE_WEEK_MESSAGE = "Выберите неделю в соответствии с учебным календарем:"
 CHOICE_DAY_MESSAGE = "Выберите день:"
+DIGEST_ON_MESSAGE = "Вы подписаны на утреннюю рассылку расписания на день. Для отказа используйте /digest off"
+DIGEST_OFF_MESSAGE = "Утренняя рассылка расписания отключена"
+DIGEST_NO_CLASS_MESSAGE = "Сначала выберите класс в меню <Расписание> - рассылка будет приходить для последнего выбранного класса"
+NO_CLASS_MESSAGE = "Сначала выберите класс в меню <Расписание>"
+NO_LESSONS_MESSAGE = "Сегодня уроков нет"
+TEACHER_USAGE_MESSAGE = "Используйте /teacher <Фамилия> [день недели], например /teacher Иванова вт"
+TEACHER_NOT_FOUND_MESSAGE = "Преподаватель не найден. Расписания классов загружаются постепенно - попробуйте позже"
+ROOMS_USAGE_MESSAGE = "Используйте /rooms [день недели] [номер урока], например /rooms вт 3"
+ROOMS_NOT_FOUND_MESSAGE = "Свободные кабинеты не найдены. Расписания классов загружаются постепенно - попробуйте позже"
@@ -0,0 +1,227 @@
+"""
+Модуль метрик бота - время выполнения этапов обработки запросов и счетчики
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+import config as cfg
+
+# Префикс названий метрик в формате Prometheus
+METRIC_PREFIX = "school_bot_"
+# Квантили времени выполнения
+QUANTILES = (0.5, 0.95, 0.99)
+
+class Histogram:
+    """
+    Распределение времени выполнения по последним window замерам
+    """
+    __slots__ = ("__samples", "__count", "__sum")
+
+    def __init__(self, window: int):
+        """
+        Конструктор класса
+        window: количество последних замеров для вычисления квантилей
+        """
+        self.__samples: deque = deque(maxlen=window)
+        self.__count: int = 0
+        self.__sum: float = 0.0
+
+    def observe(self, value: float) -> None:
+        """ Добавить замер """
+        self.__samples.append(value)
+        self.__count += 1
+        self.__sum += value
+
+    def quantiles(self, quantiles: tuple = QUANTILES) -> list:
+        """ Квантили по последним замерам """
+        samples = sorted(self.__samples)
+        if len(samples) == 0:
+            return [0.0 for _ in quantiles]
+        return [samples[min(len(samples) - 1, int(quantile * len(samples)))] for quantile in quantiles]
+
+    @property
+    def count(self) -> int:
+        """ Количество замеров с момента запуска """
+        return self.__count
+
+    @property
+    def sum(self) -> float:
+        """ Сумма замеров с момента запуска """
+        return self.__sum
+
+class Metrics:
+    """
+    Реестр метрик - распределения времени (мс) и счетчики с метками
+    """
+    def __init__(self, window: int = 1000):
+        """
+        Конструктор класса
+        window: количество последних замеров каждой метрики для вычисления квантилей
+        """
+        self.__window: int = window
+        # (название, метки) -> Histogram
+        self.__histograms: dict = {}
+        # (название, метки) -> значение
+        self.__counters: dict = {}
+
+    @staticmethod
+    def __key(name: str, labels: dict) -> tuple:
+        """ Ключ метрики - название и отсортированные метки """
+        return name, tuple(sorted(labels.items()))
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """ Добавить замер времени value (мс) в метрику name """
+        key = self.__key(name, labels)
+        histogram = self.__histograms.get(key)
+        if histogram is None:
+            histogram = Histogram(self.__window)
+            self.__histograms[key] = histogram
+        histogram.observe(value)
+
+    def inc(self, name: str, value: int = 1, **labels) -> None:
+        """ Увеличить счетчик name """
+        key = self.__key(name, labels)
+        self.__counters[key] = self.__counters.get(key, 0) + value
+
+    @contextmanager
+    def span(self, name: str, **labels):
+        """
+        Замер времени выполнения блока with, в том числе с await внутри
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, (time.perf_counter() - start) * 1000, **labels)
+
+    def timed(self, name: str):
+        """
+        Декоратор замера времени выполнения функции/корутины с меткой function
+        """
+        def decorator(func):
+            if asyncio.iscoroutinefunction(func):
+                @wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    with self.span(name, function=func.__name__):
+                        return await func(*args, **kwargs)
+                return async_wrapper
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name, function=func.__name__):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def __labels_str(labels: tuple, extra: str = None) -> str:
+        """ Метки в формате Prometheus """
+        items = []
+        for key, value in labels:
+            value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            items.append(f'{key}="{value}"')
+        if extra:
+            items.append(extra)
+        return "{" + ",".join(items) + "}" if items else ""
+
+    def summary(self) -> str:
+        """
+        Текстовая сводка метрик: количество и квантили p50/p95/p99 времени выполнения, счетчики
+        """
+        lines = []
+        for (name, labels), histogram in sorted(self.__histograms.items()):
+            p50, p95, p99 = histogram.quantiles()
+            label = " ".join(str(value) for _, value in labels)
+            lines.append(f"{name} {label}: n={histogram.count} p50={p50:.1f} p95={p95:.1f} p99={p99:.1f} ms")
+        for (name, labels), value in sorted(self.__counters.items()):
+            label = " ".join(str(value) for _, value in labels)
+            lines.append(f"{name} {label}: {value}")
+        return "\n".join(lines) if lines else "Нет данных"
+
+    def prometheus_text(self) -> str:
+        """
+        Метрики в текстовом формате Prometheus: время - summary, счетчики - counter
+        """
+        lines = []
+        last_name = None
+        for (name, labels), histogram in sorted(self.__histograms.items()):
+            metric = f"{METRIC_PREFIX}{name}"
+            if metric != last_name:
+                lines.append(f"# TYPE {metric} summary")
+                last_name = metric
+            for quantile, value in zip(QUANTILES, histogram.quantiles()):
+                quantile_label = f'quantile="{quantile}"'
+                lines.append(f"{metric}{self.__labels_str(labels, quantile_label)} {value:.3f}")
+            lines.append(f"{metric}_sum{self.__labels_str(labels)} {histogram.sum:.3f}")
+            lines.append(f"{metric}_count{self.__labels_str(labels)} {histogram.count}")
+        for (name, labels), value in sorted(self.__counters.items()):
+            metric = f"{METRIC_PREFIX}{name}_total"
+            if metric != last_name:
+                lines.append(f"# TYPE {metric} counter")
+                last_name = metric
+            lines.append(f"{metric}{self.__labels_str(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+class MetricsExporter:
+    """
+    Локальный http сервер метрик для Prometheus (GET /metrics)
+    """
+    def __init__(self, registry: Metrics, host: str, port: int):
+        """
+        Конструктор класса
+        """
+        self.__registry: Metrics = registry
+        self.__host: str = host
+        self.__port: int = port
+        self.__server = None
+
+    async def __handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """ Обработка http запроса """
+        try:
+            request_line = await reader.readline()
+            # заголовки запроса не используются
+            while (await reader.readline()).strip():
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1] == "/metrics":
+                status, body = "200 OK", self.__registry.prometheus_text()
+            else:
+                status, body = "404 Not Found", "not found\n"
+            data = body.encode("utf-8")
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                         f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode("latin-1") + data)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            logging.warning(f"Metrics request error {e}")
+        finally:
+            writer.close()
+
+    async def start(self) -> None:
+        """ Запуск сервера в цикле событий бота """
+        try:
+            self.__server = await asyncio.start_server(self.__handle, self.__host, self.__port)
+        except OSError as e:
+            logging.error(f"Metrics exporter not started {e}")
+            return
+        logging.info(f"Metrics exporter started on http://{self.__host}:{self.__port}/metrics")
+
+    async def stop(self) -> None:
+        """ Остановка сервера """
+        if self.__server is not None:
+            self.__server.close()
+            await self.__server.wait_closed()
+            self.__server = None
+
+# Метрики бота
+metrics = Metrics(cfg.METRICS_WINDOW)
+# Сервер метрик
+metrics_exporter = MetricsExporter(metrics, cfg.METRICS_HOST, cfg.METRICS_PORT)
+
+def main():
+    raise SystemError("This file cannot be operable")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Модуль сравнения расписаний класса
+"""
+import html
+
+class LessonChange:
+    """
+    Изменение урока между двумя версиями расписания
+    """
+    ADDED = "added"
+    REMOVED = "removed"
+    CHANGED = "changed"
+
+    def __init__(self, kind: str, week: int, hour_start: str, day_of_week: str, day_of_week_number: int, old_value: str, new_value: str):
+        """
+        Конструктор класса
+        kind: тип изменения ADDED/REMOVED/CHANGED
+        week: чередование по неделям
+        hour_start: начало урока/номер урока
+        day_of_week: день недели
+        old_value: урок в старом расписании
+        new_value: урок в новом расписании
+        """
+        self.__kind: str = kind
+        self.__week: int = week
+        self.__hour_start: str = hour_start
+        self.__day_of_week: str = day_of_week
+        self.__day_of_week_number: int = day_of_week_number
+        self.__old_value: str = old_value
+        self.__new_value: str = new_value
+
+    @property
+    def kind(self) -> str:
+        """ Тип изменения """
+        return self.__kind
+
+    @property
+    def week(self) -> int:
+        """ Чередование по неделям """
+        return self.__week
+
+    @property
+    def hour_start(self) -> str:
+        """ Начало урока/номер урока """
+        return self.__hour_start
+
+    @property
+    def day_of_week(self) -> str:
+        """ День недели """
+        return self.__day_of_week
+
+    @property
+    def day_of_week_number(self) -> int:
+        """ Номер дня недели """
+        return self.__day_of_week_number
+
+    @property
+    def old_value(self) -> str:
+        """ Урок в старом расписании """
+        return self.__old_value
+
+    @property
+    def new_value(self) -> str:
+        """ Урок в новом расписании """
+        return self.__new_value
+
+    def to_str(self) -> str:
+        """ Конвертация изменения в строку """
+        if self.__kind == self.ADDED:
+            return f"+ {self.__new_value}"
+        elif self.__kind == self.REMOVED:
+            return f"- {self.__old_value}"
+        return f"{self.__old_value} -> {self.__new_value}"
+
+def lesson_value(lesson) -> str:
+    """
+    Строковое представление урока, по которому сравниваются версии расписания
+    """
+    if lesson is None:
+        return None
+    return lesson.to_str()
+
+def diff_lessons(old_lessons: dict, new_lessons: dict) -> list:
+    """
+    Сравнение словарей уроков LessonIdent -> Lesson двух версий расписания
+    Возвращает список LessonChange отсортированный по неделе/дню/уроку
+    """
+    changes = []
+    for ident, new_lesson in new_lessons.items():
+        old_lesson = old_lessons.get(ident)
+        new_value = lesson_value(new_lesson)
+        if old_lesson is None:
+            kind = LessonChange.ADDED
+        elif lesson_value(old_lesson) != new_value:
+            kind = LessonChange.CHANGED
+        else:
+            continue
+        changes.append(LessonChange(kind, ident.week, ident.hour_start, ident.day_of_week, ident.day_of_week_number,
+                                    lesson_value(old_lesson), new_value))
+    for ident, old_lesson in old_lessons.items():
+        if ident not in new_lessons:
+            changes.append(LessonChange(LessonChange.REMOVED, ident.week, ident.hour_start, ident.day_of_week,
+                                        ident.day_of_week_number, lesson_value(old_lesson), None))
+    changes.sort(key=lambda change: (change.week, change.day_of_week_number or 0, str(change.hour_start)))
+    return changes
+
+def changes_message(class_name: str, changes: list, has_alternating_week: bool = False) -> str:
+    """
+    Текст уведомления об изменениях расписания класса в формате HTML
+    """
+    message = f"Изменилось расписание класса {html.escape(class_name)}:\n"
+    day_key = None
+    change: LessonChange
+    for change in changes:
+        if (change.week, change.day_of_week) != day_key:
+            day_key = (change.week, change.day_of_week)
+            week_name = f" (неделя {change.week})" if has_alternating_week else ""
+            message += f"\n<b>{html.escape(str(change.day_of_week))}{week_name}:</b>\n"
+        message += f"{html.escape(change.to_str())}\n"
+    return message
+
+def main():
+    raise SystemError("This file cannot be operable")
+
+if __name__ == "__main__":
+    main()
@@ -5,18 +5,21 @@ import sys
 import re
 import logging
 from hashlib import md5
-import random
 import requests
-from bs4 import BeautifulSoup
 import config as cfg
-from week_pdf_parser import WeekSchedule, Lesson
-from cache_func import timed_lru_cache, hash_string_to_byte
-from database import save_to_db, load_from_db
+from metrics import metrics
+from week_pdf_parser import WeekSchedule, Lesson, ParseRecord, ParseOutcome, download
+from cache_func import timed_lru_cache, stable_id, intern_str, restore_slots
+from database import init_db, get_last_schedule_hash, save_to_db, load_from_db
+from database import flush_errors, flush_parse_records, get_parse_rollup, get_slowest_parses
+from state_backend import state_backend, leader_lock
 
 class SchoolClass:
     """
     Школьный класс
     """
+    __slots__ = ("__name", "__number", "__link", "__department", "__week_schedule", "__id")
+
     def __init__(self, name: str, link: str, department):
         """
         Конструктор класса
@@ -24,7 +27,7 @@ class SchoolClass:
         link: ссылка на pdf файл, содержащий расписание
         """
         # название класса
-        self.__name: str = name
+        self.__name: str = intern_str(name)
         match = re.search(R"^\d{1,2}", name)
         # номер класса
         self.__number: int = None
@@ -40,7 +43,19 @@ class SchoolClass:
         # расписание на неделю
         self.__week_schedule: WeekSchedule = None
         # идентификатор
-        self.__id = hash(self)
+        self.__id: int = self.__make_id()
+
+    def __make_id(self) -> int:
+        """ Вычисление идентификатора - классы с одинаковыми названиями в разных школах различаются по url школы """
+        return stable_id(self.__name + self.__department.name + self.__department.school.url)
+
+    def __setstate__(self, state) -> None:
+        """
+        Восстановление из pickle - идентификатор мог быть сохранен старой схемой, он пересчитывается при первом обращении
+        (корпус в этот момент может быть еще не восстановлен)
+        """
+        restore_slots(self, state)
+        self.__id = None
 
     @property
     def name(self) -> str:
@@ -59,12 +74,30 @@ class SchoolClass:
 
     @property
     def week_schedule(self) -> WeekSchedule:
-        """" Свойство расписание на неделю """
+        """"
+        Свойство расписание на неделю
+        До фоновой проверки расписание загружается из базы без обращения к сети
+        """
         if self.__week_schedule is None:
             self.__week_schedule = WeekSchedule(self)
-        self.__week_schedule.parse()
+        self.__week_schedule.load()
+        return self.__week_schedule
+
+    @property
+    def loaded_week_schedule(self) -> WeekSchedule:
+        """ Расписание на неделю, если оно уже загружалось - без обращения к сети """
         return self.__week_schedule
 
+    def detached_week_schedule(self) -> WeekSchedule:
+        """ Расписание на неделю для загрузки в пуле потоков - копия текущего или новое """
+        if self.__week_schedule is None:
+            return WeekSchedule(self)
+        return self.__week_schedule.detach()
+
+    def attach_week_schedule(self, week_schedule: WeekSchedule) -> None:
+        """ Замена расписания на неделю загруженным в пуле потоков """
+        self.__week_schedule = week_schedule
+
     @property
     def department(self):
         """ корпус класса """
@@ -73,29 +106,45 @@ class SchoolClass:
     @property
     def id(self) -> int:
         """ уникальный идентификатор """
+        if self.__id is None:
+            self.__id = self.__make_id()
         return self.__id
 
     def __hash__(self) -> int:
         """ Вычисление хеша """
-        return hash_string_to_byte(self.__name + self.__department.name)
+        return self.id
 
 class Department:
     """
     Класс подразделение (корпус) школы
     """
+    __slots__ = ("__name", "__classes", "__school", "__id")
+
     def __init__(self, name: str, school):
         """
         Конструктор класса
         name: название территории расписания
         """
         # название
-        self.__name: str = name
+        self.__name: str = intern_str(name)
         # список классов
         self.__classes: list = []
         # ссылка на школу
         self.__school = school
         # идентификатор
-        self.__id = hash(self)
+        self.__id: int = self.__make_id()
+
+    def __make_id(self) -> int:
+        """ Вычисление идентификатора - корпуса с одинаковыми названиями в разных школах различаются по url школы """
+        return stable_id(self.__name + self.__school.url)
+
+    def __setstate__(self, state) -> None:
+        """
+        Восстановление из pickle - идентификатор мог быть сохранен старой схемой, он пересчитывается при первом обращении
+        (школа в этот момент может быть еще не восстановлена)
+        """
+        restore_slots(self, state)
+        self.__id = None
 
     def add_class(self, class_: SchoolClass):
         """ Метод добавление класса к списку классов """
@@ -114,6 +163,8 @@ class Department:
     @property
     def id(self) -> int:
         """ уникальный идентификатор """
+        if self.__id is None:
+            self.__id = self.__make_id()
         return self.__id
 
     @property
@@ -131,12 +182,66 @@ class Department:
 
     def __hash__(self) -> int:
         """ Вычисление хеша """
-        return hash_string_to_byte(self.__name)
+        return self.id
+
+def parse_school_page(data: str) -> tuple:
+    """
+    Разбор html страницы расписания школы
+    Из страницы выбираются только заголовки корпусов (h3.toggle-heading) и таблицы классов после них,
+    каждая таблица просматривается один раз
+    Возвращает (название школы, название расписания, список (название корпуса, список (название класса, url)))
+    """
+    from lxml import html
+    if not data.strip():
+        return None, None, []
+    root = html.document_fromstring(data.encode("utf-8"), parser=html.HTMLParser(encoding="utf-8"))
+    # Получение названия школы
+    name = None
+    title = root.find(".//title")
+    if title is not None:
+        name = title.text_content()
+        position = name.find("ГБОУ")
+        if position > 0:
+            name = name[position:]
+    # Получение текущего расписания
+    schedule_name = None
+    text_center = root.xpath('(//p[@style="text-align: center;"])[1]')
+    if text_center:
+        schedule_name = text_center[0].text_content().strip().replace('\xa0', ' ').replace('\r\n', ' ')
+    # Заголовки корпусов - <h3 class="toggle-heading" style="text-align: center;"><span style="font-size...
+    department_list = []
+    for h3 in root.xpath('//h3[@class="toggle-heading" and @style="text-align: center;"]'):
+        if h3.text or len(h3) == 0 or h3[0].tag != "span" or not h3[0].get("style", "").startswith("font-size"):
+            continue
+        class_list = []
+        # Таблица с расписаниями классов
+        for sibling in h3.itersiblings():
+            if not isinstance(sibling.tag, str):
+                continue
+            table = sibling.find(".//table")
+            if table is None:
+                continue
+            table_body = table.find(".//tbody")
+            for col in (table if table_body is None else table_body).iter("td"):
+                # Разбор данных о классе
+                class_name = col.text_content()
+                if class_name and class_name != '\xa0':
+                    link = col.find(".//a")
+                    class_list.append((class_name, None if link is None else link.get("href")))
+        department_list.append((h3.text_content(), class_list))
+    return name, schedule_name, department_list
 
 class School:
     """
     Класс школа
     """
+    # Словарь классов по идентификатору, строится при первом поиске
+    __class_dict: dict = None
+    # Расписание проверено по сети после запуска
+    __revalidated: bool = False
+    # Словарь версий школ в общем хранилище: url школы -> hash расписания, опубликованного лидером
+    SHARED_VERSIONS = "school_versions"
+
     def __init__(self, url: str):
         """
         Конструктор класса
@@ -158,42 +263,120 @@ class School:
         # Текст ошибки последнего разбора
         self.__last_parse_info: str = None
 
-    def get_hash(self, response: requests.models.Response) -> str:
+    def __make_id(self) -> int:
+        """ Вычисление идентификатора по названию школы, а если его нет - по url """
+        return stable_id(self.__name if self.__name else self.__url)
+
+    def __setstate__(self, state) -> None:
+        """ Восстановление из pickle - идентификатор пересчитывается, он мог быть сохранен старой схемой """
+        self.__dict__.update(state)
+        if self.__id is not None:
+            self.__id = self.__make_id()
+        self.__revalidated = False
+
+    def load_cached(self) -> bool:
         """
-        Получение хэша страницы
+        Загрузка расписания школы из базы без обращения к сети, пока оно не проверено в фоне
+        Возвращает False если расписание уже проверено или в базе его нет
         """
-        data = response.text
-        # Уберем уникальные строки для подсчета хэша
-        data_for_hash = re.sub(pattern = r"<link rel=\"stylesheet\" href=\"/css/app-project/app\.css.*/>", repl = "", string = data)
-        data_for_hash = re.sub(pattern = r"<script defer src=\"/js/app-project/app.*</script>", repl = "", string = data_for_hash)
-        data_for_hash = re.sub(pattern = r"<script async src=\"/js/app-project/build.*</script>", repl = "", string = data_for_hash)
-        data_for_hash = re.sub(pattern = r"<script type=\"text/javascript\" src=\"/js/jquery.functions.js\?v=.*></script>", repl = "", string = data_for_hash)
-        data_for_hash = data_for_hash.encode('utf-8', errors='ignore')
-        return md5(data_for_hash).hexdigest()
+        if self.__revalidated:
+            return False
+        if self.__hash == "":
+            schedule_hash = get_last_schedule_hash(self.__url)
+            if schedule_hash is None or not load_from_db(self, schedule_hash) or self.__reject_duplicates():
+                return False
+            self.__last_parse_result = True
+            self.__last_parse_info = "Loaded from Db without network"
+            logging.info(self.__last_parse_info)
+        return len(self.__departments) > 0
+
+    @property
+    def revalidated(self) -> bool:
+        """ Расписание проверено по сети после запуска """
+        return self.__revalidated
+
+    def check_ids(self, departments: list = None) -> list:
+        """
+        Проверка уникальности идентификаторов корпусов и классов
+        departments: проверяемый список корпусов, по умолчанию - корпуса школы
+        Возвращает список повторяющихся идентификаторов
+        """
+        id_dict = {}
+        for department in self.__departments if departments is None else departments:
+            id_dict[department.id] = id_dict.get(department.id, 0) + 1
+            for class_ in department.class_list:
+                id_dict[class_.id] = id_dict.get(class_.id, 0) + 1
+        duplicate_list = [key for key, value in id_dict.items() if value > 1]
+        for duplicate_id in duplicate_list:
+            logging.error(f"Duplicate id {duplicate_id} in school {self.__name}")
+        return duplicate_list
+
+    def __reject_duplicates(self) -> bool:
+        """
+        Школа, загруженная из базы, с повторяющимися идентификаторами не используется - она сбрасывается,
+        чтобы следующая загрузка построила ее заново
+        Возвращает True если школа сброшена
+        """
+        if len(self.check_ids()) == 0:
+            return False
+        self.__departments = []
+        self.__class_dict = None
+        self.__hash = ""
+        self.__last_parse_result = False
+        self.__last_parse_info = "Duplicate ids in Db data"
+        return True
+
+    @staticmethod
+    def get_hash(page: tuple) -> str:
+        """
+        Смысловой хэш расписания - по названиям школы, расписания, корпусов, классов и ссылкам на расписания классов
+        Изменения разметки страницы, не затрагивающие расписание, хэш не меняют
+        page: результат parse_school_page
+        """
+        name, schedule_name, department_list = page
+        digest = md5()
+
+        def update(*values) -> None:
+            # значения разделяются символами-разделителями, чтобы разные наборы строк не давали одинаковый поток
+            for value in values:
+                digest.update(("" if value is None else value).encode("utf-8", errors="ignore"))
+                digest.update(b"\x1f")
+            digest.update(b"\x1e")
+
+        update(name, schedule_name)
+        for department_name, class_list in department_list:
+            update("department", department_name)
+            for class_name, link in class_list:
+                update(class_name, link)
+        return digest.hexdigest()
 
     @timed_lru_cache(60*60*24)
     def load(self) -> bool:
         """
-        Процедура загрузки данных о школе/расписании/корпусах
+        Процедура загрузки данных о школе/расписании/корпусах, не чаще раза в сутки
+        """
+        return self.refresh()
+
+    def refresh(self) -> bool:
+        """
+        Загрузка данных о школе/расписании/корпусах без кеширования
+        Используется реестром школ, чтобы кеш load не удерживал вытесненные из памяти школы
         """
         new_hash = None
+        # попытка проверки по сети - даже неудачная, чтобы фоновая проверка не повторяла ее
+        self.__revalidated = True
         try:
             timeouts = (5, 10) # (conn_timeout, read_timeout)
-            user_agents = [
-                "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36",
-                "Mozilla/5.0 (Windows NT 10.0; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/56.0.2924.87 Safari/537.36 OPR/43.0.2442.991"
-                "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_13_2) AppleWebKit/604.4.7 (KHTML, like Gecko) Version/11.0.2 Safari/604.4.7"
-            ]
-            headers = {"User-Agent": random.choice(user_agents)}
-            logging.info(f"Get from {self.__url}. Use agent {headers}")
-            response: requests.models.Response = requests.get(self.__url, timeout = timeouts, headers=headers)
+            with metrics.span("download", source="school"):
+                response: requests.models.Response = download(self.__url, timeouts)
             if response.status_code != 200:
                 self.__last_parse_info = f"Error get {self.__url}. error code {response.status_code}"
                 logging.error(self.__last_parse_info)
                 self.__last_parse_result = False
                 return self.__last_parse_result
             logging.info(f"get {response.text[:25]}...\n")
-            new_hash = self.get_hash(response)
+            page = parse_school_page(response.text)
+            new_hash = self.get_hash(page)
             logging.info(f"hash {new_hash}")
         except requests.exceptions.RequestException as e:
             self.__last_parse_info = f"Error {type(e)} {e}.\nTry get data from database"
@@ -204,83 +387,89 @@ class School:
             self.__last_parse_info = "Hash not changed - used saved data"
             logging.info(self.__last_parse_info)
             self.__last_parse_result = True
+            self.__publish()
             return self.__last_parse_result
 
-        self.__last_parse_result = load_from_db(self, new_hash)
+        self.__last_parse_result = load_from_db(self, new_hash) and not self.__reject_duplicates()
         if self.__last_parse_result:
             # Данные успешно загружены из БД - Hash БД и Hash из Internet совпал
             self.__last_parse_info = "Hash in Database not changed"
+            self.__publish()
         elif not self.__last_parse_result and new_hash is not None:
             # Данных в базе данных нет - разбираем данные страницы
-            self.__last_parse_result = self.load_from_url(new_hash, response)
+            self.__last_parse_result = self.load_from_url(new_hash, page)
             if self.__last_parse_result:
                 self.__last_parse_info = "Successful parse data from url"
                 # записываем созданные объекты в базу
                 save_to_db(self)
+                self.__publish()
             else:
                 self.__last_parse_info = "Error parse data from url"
         return self.__last_parse_result
 
-    def load_from_url(self, new_hash: str, response: requests.models.Response) -> bool:
+    def __shared_key(self) -> str:
+        """ Ключ структуры школы в общем хранилище реплик """
+        return f"school:{self.__url}"
+
+    def __publish(self) -> None:
         """
-        Процедура разбора url расписания
+        Публикация структуры школы репликой-лидером - реплики-последователи строят школу по ней без обращения к сети
+        Структура записывается в виде результата parse_school_page, поэтому ее можно построить и из базы
         """
-        # Получение html из Web
-        data = response.text
-        self.__hash = new_hash
-        self.__departments = []
-        self.__name = None
-        self.__schedule_name: str = None
-        self.__id = None
-
-        xml_data = BeautifulSoup(data, 'lxml')
-        # Получение названия школы
-        if xml_data.find("title"):
-            self.__name = xml_data.find("title").text
-            position = self.__name.find("ГБОУ")
-            if position > 0:
-                self.__name = self.__name[position:]
-                self.__id = hash_string_to_byte(self.__name)
-        if self.__name is None:
-            self.__id = hash_string_to_byte(self.__url)
-        # Получение текущего расписания
-        text_center = xml_data.find(['p'], attrs = {"style": "text-align: center;"})
-        if text_center:
-            schedule_name = text_center.text
-            self.__schedule_name = schedule_name.strip().replace('\xa0', ' ').replace('\r\n', ' ')
-        # Разбор HTML по территориям
-        h3_list = xml_data.find_all(
-                ['h3'],
-                attrs = {"class": "toggle-heading", "style": "text-align: center;"}
-                #string='span style'
-        )
+        if not (state_backend.shared and leader_lock.is_leader) or not self.__departments:
+            return
+        page = (self.__name, self.__schedule_name,
+                [(department.name, [(class_.name, class_.link) for class_ in department.class_list])
+                 for department in self.__departments])
+        if state_backend.set_object(self.__shared_key(), (self.__hash, page)):
+            state_backend.set_version(self.SHARED_VERSIONS, self.__url, self.__hash)
+
+    def load_shared(self) -> bool:
+        """
+        Загрузка структуры школы, опубликованной репликой-лидером, без обращения к сети
+        Возвращает False если лидер еще не опубликовал школу
+        """
+        shared = state_backend.get_object(self.__shared_key())
+        if shared is None:
+            return False
+        shared_hash, page = shared
+        if shared_hash != self.__hash:
+            if not self.load_from_url(shared_hash, page):
+                return False
+            self.__last_parse_result = True
+            self.__last_parse_info = "Loaded from shared state"
+            logging.info(self.__last_parse_info)
+        return True
 
+    def load_from_url(self, new_hash: str, page: tuple) -> bool:
+        """
+        Процедура построения школы по разобранной странице расписания
+        page: результат parse_school_page
+        Возвращает False если страница без корпусов или идентификаторы корпусов и классов повторяются -
+        тогда школа не меняется
+        """
+        name, schedule_name, department_list = page
+        # список корпусов строится отдельно и заменяется целиком - школу могут читать обработчики,
+        # пока она обновляется в пуле потоков
+        departments = []
         # Цикл по территориям
-        for h3 in h3_list:
-            if '<h3 class="toggle-heading" style="text-align: center;"><span style="font-size' in str(h3):
-                logging.info(f"Department {h3.text}....")
-                department = Department(h3.text, self)
-
-                # Поиск таблицы с расписаниями классов
-                for sibling in h3.next_siblings:
-                    table = sibling.find('table')
-                    if table != -1:
-                        table_body = table.find('tbody')
-                        rows = table_body.find_all('tr')
-
-                        for row in rows:
-                            cols = row.find_all('td')
-                            for col in cols:
-                                # Разбор данных о классе
-                                if col.text and col.text != '\xa0':
-                                    url = None if col.a is None else col.a.get('href')
-                                    logging.info(f"Class {col.text} {url}")
-                                    class_ = SchoolClass(col.text, url, department)
-                                    if class_.number is not None or url is not None:
-                                        department.add_class(class_)
-
-                self.__departments.append(department)
-        return len(self.__departments) > 0
+        for department_name, class_list in department_list:
+            logging.info(f"Department {department_name}....")
+            department = Department(department_name, self)
+            for class_name, url in class_list:
+                logging.info(f"Class {class_name} {url}")
+                class_ = SchoolClass(class_name, url, department)
+                if class_.number is not None or url is not None:
+                    department.add_class(class_)
+            departments.append(department)
+        if len(departments) == 0 or len(self.check_ids(departments)) > 0:
+            return False
+        self.__hash = new_hash
+        self.__name, self.__schedule_name = name, schedule_name
+        self.__id = self.__make_id()
+        self.__departments = departments
+        self.__class_dict = None
+        return True
 
     @property
     def name(self) -> str:
@@ -330,6 +519,7 @@ class School:
         Добавляет подразделение
         """
         self.__departments.append(department)
+        self.__class_dict = None
 
     def get_department_by_id(self, department_id: int) -> Department:
         """ Поиск территории по идентификатору """
@@ -341,13 +531,15 @@ class School:
 
     def get_class_by_id(self, class_id: int) -> SchoolClass:
         """ Поиск класса по идентификатору """
-        department: Department
-        for department in self.__departments:
-            class_: SchoolClass
-            for class_ in department.class_list:
-                if class_.id == class_id:
-                    return class_
-        return None
+        if self.__class_dict is None:
+            class_dict = {}
+            department: Department
+            for department in self.__departments:
+                class_: SchoolClass
+                for class_ in department.class_list:
+                    class_dict.setdefault(class_.id, class_)
+            self.__class_dict = class_dict
+        return self.__class_dict.get(class_id)
 
     @property
     def hash(self) -> str:
@@ -377,6 +569,7 @@ def main():
         logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
     cfg.disable_logger(["httpcore.connection", "httpcore.http11"])
     cfg.disable_logger(["pdfminer.psparser", "pdfminer.pdfparser", "pdfminer.pdfinterp", "pdfminer.cmapdb", "pdfminer.pdfdocument", "pdfminer.pdfpage"])
+    init_db()
     school: School = School(cfg.SCHEDULE_URL)
     school.load()
     print("----------------------------------------------")
@@ -421,12 +614,12 @@ def main():
                             week_schedule_str += f"{lesson_string}\n"
                 ################################################################
                 # Создаем още один объект WeekSchedule для проверки
-                if week_schedule.last_parse_error == "Lessons successful loaded from url":
-                    use_db_cash = True
-                elif week_schedule.last_parse_error == "Lessons successful loaded from Db":
-                    use_db_cash = True
+                record: ParseRecord = week_schedule.last_parse_record
+                if record is None or record.outcome not in (ParseOutcome.PARSED, ParseOutcome.LOADED, ParseOutcome.UNCHANGED):
+                    print(f"Unexpected parse result {record}")
                 else:
-                    print(f"Unknown error {week_schedule.last_parse_error}")
+                    print(f"Parse record {record}")
+                use_db_cash = True
                 week_schedule = WeekSchedule(class_)
                 week_schedule.parse(use_db_cash = use_db_cash)
                 week_schedule_str2 = ""
@@ -449,6 +642,13 @@ def main():
     print("-----------------error parse--------------------------")
     for error in error_list:
         print(error)
+    flush_errors()
+    flush_parse_records()
+    print("-----------------parse records------------------------")
+    for row in get_parse_rollup():
+        print(row)
+    for row in get_slowest_parses():
+        print(row)
 
 if __name__ == "__main__":
     main()
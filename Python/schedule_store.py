@@ -0,0 +1,290 @@
+"""
+Модуль индексов расписаний всех классов школ - уроки преподавателей и занятость кабинетов
+"""
+from bisect import bisect_left
+from time_index import lesson_minutes, lesson_number
+
+class TeacherLesson:
+    """
+    Урок преподавателя в индексе преподавателей
+    """
+    __slots__ = ("class_name", "week", "alternating", "day_number", "day_of_week", "hour_start", "hour_end", "start", "office", "subject")
+
+    def __init__(self, class_name: str, alternating: bool, lesson):
+        """
+        Конструктор класса
+        class_name: название класса
+        alternating: у класса есть чередование по неделям
+        lesson: урок
+        """
+        self.class_name: str = class_name
+        self.week: int = lesson.ident.week
+        self.alternating: bool = alternating
+        self.day_number: int = lesson.ident.day_of_week_number
+        self.day_of_week: str = lesson.ident.day_of_week
+        self.hour_start = lesson.ident.hour_start
+        self.hour_end = lesson.hour_end
+        self.start: int = lesson_minutes(lesson.ident.hour_start, lesson.hour_end)[0]
+        self.office: str = lesson.office
+        self.subject: str = lesson.name
+
+    def to_str(self) -> str:
+        """ Конвертация урока в строку """
+        if self.hour_start == self.hour_end:
+            result = f"[{self.hour_start}]"
+        else:
+            result = f"[{self.hour_start}-{self.hour_end}]"
+        result = f"{result} {self.class_name} {self.subject}"
+        if self.office:
+            result = f"{result} каб.{self.office}"
+        return result
+
+class TeacherIndex:
+    """
+    Инвертированный индекс преподаватель -> уроки во всех классах
+    Обновляется по классам при изменении hash расписания класса
+    """
+    def __init__(self):
+        """
+        Конструктор класса
+        """
+        # class_id -> (hash расписания, список преподавателей класса)
+        self.__class_teachers: dict = {}
+        # преподаватель -> {class_id: список TeacherLesson}
+        self.__teachers: dict = {}
+        # отсортированный список ключей для поиска по префиксу
+        self.__keys: list = None
+
+    @staticmethod
+    def key(teacher: str) -> str:
+        """ Ключ поиска преподавателя """
+        return teacher.lower().replace("ё", "е").strip()
+
+    def class_hash(self, class_id: int) -> str:
+        """ hash расписания класса в индексе """
+        class_teachers = self.__class_teachers.get(class_id)
+        return None if class_teachers is None else class_teachers[0]
+
+    @property
+    def class_ids(self) -> list:
+        """ Идентификаторы классов в индексе """
+        return list(self.__class_teachers.keys())
+
+    def remove_class(self, class_id: int) -> None:
+        """ Удаление уроков класса из индекса """
+        class_teachers = self.__class_teachers.pop(class_id, None)
+        if class_teachers is None:
+            return
+        for teacher in class_teachers[1]:
+            lessons = self.__teachers.get(teacher)
+            if lessons is not None:
+                lessons.pop(class_id, None)
+                if len(lessons) == 0:
+                    del self.__teachers[teacher]
+                    self.__keys = None
+
+    def update_class(self, school_class, week_schedule) -> bool:
+        """
+        Замена уроков класса в индексе, если hash расписания изменился
+        """
+        if self.class_hash(school_class.id) == week_schedule.hash:
+            return False
+        self.remove_class(school_class.id)
+        week_list = week_schedule.week_list()
+        class_lessons = {}
+        for week in week_list:
+            for day_of_week in week_schedule.day_of_week_list(week):
+                for lesson in week_schedule.lesson_list(week, day_of_week):
+                    for item in [lesson] + lesson.groups:
+                        if item.teacher:
+                            class_lessons.setdefault(item.teacher, []).append(
+                                TeacherLesson(school_class.name, len(week_list) > 1, item))
+        for teacher, lessons in class_lessons.items():
+            if teacher not in self.__teachers:
+                self.__teachers[teacher] = {}
+                self.__keys = None
+            self.__teachers[teacher][school_class.id] = lessons
+        self.__class_teachers[school_class.id] = (week_schedule.hash, list(class_lessons.keys()))
+        return True
+
+    def find_teachers(self, text: str) -> list:
+        """ Список преподавателей, фамилия которых начинается с text """
+        if self.__keys is None:
+            self.__keys = sorted((self.key(teacher), teacher) for teacher in self.__teachers)
+        prefix = self.key(text)
+        result = []
+        for key, teacher in self.__keys[bisect_left(self.__keys, (prefix, "")):]:
+            if not key.startswith(prefix):
+                break
+            result.append(teacher)
+        return result
+
+    def day_lessons(self, teacher: str, day_number: int, week: int = 1) -> list:
+        """
+        Уроки преподавателя в день day_number недели week, отсортированные по времени
+        """
+        result = []
+        for lessons in self.__teachers.get(teacher, {}).values():
+            for lesson in lessons:
+                if lesson.day_number == day_number and (lesson.week == week or not lesson.alternating):
+                    result.append(lesson)
+        result.sort(key=lambda lesson: (lesson.start is None, lesson.start or 0, str(lesson.hour_start)))
+        return result
+
+class OfficeOccupancy:
+    """
+    Занятость кабинетов корпусов - битовые маски кабинетов по ячейкам (неделя, день, урок)
+    Неделя 0 - урок класса без чередования, идет каждую неделю
+    """
+    def __init__(self):
+        """
+        Конструктор класса
+        """
+        # department_id -> {кабинет: номер бита}
+        self.__offices: dict = {}
+        # department_id -> {(неделя, день, урок): маска занятых кабинетов}
+        self.__occupied: dict = {}
+        # class_id -> (hash расписания, department_id, {(неделя, день, урок): маска кабинетов класса})
+        self.__classes: dict = {}
+
+    @staticmethod
+    def split_offices(office: str) -> list:
+        """ Список кабинетов урока - сдвоенные кабинеты записаны через запятую """
+        if not office:
+            return []
+        return [item.strip() for item in office.split(",") if item.strip()]
+
+    def __office_bit(self, department_id: int, office: str) -> int:
+        """ Бит кабинета корпуса, новый кабинет получает следующий бит """
+        offices = self.__offices.setdefault(department_id, {})
+        bit = offices.get(office)
+        if bit is None:
+            bit = len(offices)
+            offices[office] = bit
+        return 1 << bit
+
+    def __rebuild_slots(self, department_id: int, slots) -> None:
+        """ Пересчет занятости корпуса в ячейках slots по всем его классам """
+        occupied = self.__occupied.setdefault(department_id, {})
+        class_slots = [value[2] for value in self.__classes.values() if value[1] == department_id]
+        for slot in slots:
+            mask = 0
+            for class_slot in class_slots:
+                mask |= class_slot.get(slot, 0)
+            if mask:
+                occupied[slot] = mask
+            else:
+                occupied.pop(slot, None)
+
+    @property
+    def class_ids(self) -> list:
+        """ Идентификаторы классов, занятость кабинетов которых учтена """
+        return list(self.__classes.keys())
+
+    def remove_class(self, class_id: int) -> None:
+        """ Удаление занятости кабинетов классом """
+        value = self.__classes.pop(class_id, None)
+        if value is not None:
+            self.__rebuild_slots(value[1], value[2].keys())
+
+    def update_class(self, school_class, week_schedule) -> bool:
+        """
+        Замена занятости кабинетов классом, если hash расписания изменился
+        """
+        old_value = self.__classes.get(school_class.id)
+        if old_value is not None and old_value[0] == week_schedule.hash:
+            return False
+        department_id = school_class.department.id
+        week_list = week_schedule.week_list()
+        slots = {}
+        for week in week_list:
+            slot_week = week if len(week_list) > 1 else 0
+            for day_of_week in week_schedule.day_of_week_list(week):
+                for lesson in week_schedule.lesson_list(week, day_of_week):
+                    for item in [lesson] + lesson.groups:
+                        first = lesson_number(item.ident.hour_start)
+                        last = lesson_number(item.hour_end) or first
+                        if first is None:
+                            continue
+                        mask = 0
+                        for office in self.split_offices(item.office):
+                            mask |= self.__office_bit(department_id, office)
+                        for hour in range(first, max(first, last) + 1):
+                            slot = (slot_week, item.ident.day_of_week_number, hour)
+                            slots[slot] = slots.get(slot, 0) | mask
+        self.__classes[school_class.id] = (week_schedule.hash, department_id, slots)
+        changed = set(slots.keys())
+        if old_value is not None:
+            changed.update(old_value[2].keys())
+            if old_value[1] != department_id:
+                self.__rebuild_slots(old_value[1], old_value[2].keys())
+        self.__rebuild_slots(department_id, changed)
+        return True
+
+    def free_offices(self, department_id: int, week: int, day_number: int, hour: int) -> list:
+        """
+        Свободные кабинеты корпуса на уроке hour дня day_number недели week
+        """
+        offices = self.__offices.get(department_id, {})
+        occupied = self.__occupied.get(department_id, {})
+        all_mask = (1 << len(offices)) - 1
+        free_mask = all_mask & ~(occupied.get((week, day_number, hour), 0) | occupied.get((0, day_number, hour), 0))
+        result = [office for office, bit in offices.items() if free_mask >> bit & 1]
+        return sorted(result, key=lambda office: (len(office), office))
+
+class ScheduleIndexes:
+    """
+    Индексы расписаний классов одной школы - хранятся в реестре школ вместе со школой
+    """
+    def __init__(self):
+        """
+        Конструктор класса
+        """
+        self.__teacher_index: TeacherIndex = TeacherIndex()
+        self.__office_occupancy: OfficeOccupancy = OfficeOccupancy()
+
+    @property
+    def teacher_index(self) -> TeacherIndex:
+        """ Индекс преподавателей школы """
+        return self.__teacher_index
+
+    @property
+    def office_occupancy(self) -> OfficeOccupancy:
+        """ Занятость кабинетов школы """
+        return self.__office_occupancy
+
+    def update(self, school) -> int:
+        """
+        Обновление индексов по уже загруженным расписаниям классов школы, без обращения к сети
+        Возвращает количество обновленных классов
+        """
+        updated = 0
+        class_ids = set()
+        for department in school.departments:
+            for school_class in department.class_list:
+                class_ids.add(school_class.id)
+                week_schedule = school_class.loaded_week_schedule
+                if week_schedule is not None and week_schedule.last_parse_result:
+                    teacher_updated = self.__teacher_index.update_class(school_class, week_schedule)
+                    office_updated = self.__office_occupancy.update_class(school_class, week_schedule)
+                    if teacher_updated or office_updated:
+                        updated += 1
+        # Классы, которых больше нет в расписании школы
+        for class_id in set(self.__teacher_index.class_ids).union(self.__office_occupancy.class_ids) - class_ids:
+            self.__teacher_index.remove_class(class_id)
+            self.__office_occupancy.remove_class(class_id)
+        return updated
+
+def unloaded_classes(school, limit: int) -> list:
+    """
+    Не более limit классов школы, расписания которых еще не загружались
+    """
+    class_list = [school_class for department in school.departments for school_class in department.class_list
+                  if school_class.loaded_week_schedule is None]
+    return class_list[:limit]
+
+def main():
+    raise SystemError("This file cannot be operable")
+
+if __name__ == "__main__":
+    main()
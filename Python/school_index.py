@@ -0,0 +1,162 @@
+"""
+Модуль индексов поиска по названиям классов и дней недели
+"""
+import re
+from week_pdf_parser import DayOfWeek
+
+# Латинские буквы, похожие на русские
+LATIN_TO_CYRILLIC = str.maketrans("ABCEHKMOPTXYabcehkmoptxy", "АВСЕНКМОРТХУАВСЕНКМОРТХУ")
+
+def normalize_name(name: str) -> str:
+    """
+    Нормализация названия для поиска - верхний регистр, русские буквы, без пробелов и разделителей
+    """
+    if name is None:
+        return ""
+    name = name.translate(LATIN_TO_CYRILLIC).upper()
+    return re.sub(R"[\s\-_./\\]+", "", name)
+
+class PrefixIndex:
+    """
+    Индекс поиска значений по префиксу ключа
+    """
+    def __init__(self):
+        """
+        Конструктор класса
+        """
+        self.__prefixes: dict = {}
+
+    def add(self, key: str, value) -> None:
+        """ Добавить значение для всех префиксов ключа """
+        for i in range(1, len(key) + 1):
+            values = self.__prefixes.setdefault(key[:i], [])
+            if value not in values:
+                values.append(value)
+
+    def find(self, prefix: str) -> list:
+        """ Список значений, ключ которых начинается с prefix """
+        return self.__prefixes.get(prefix, [])
+
+class TrigramIndex:
+    """
+    Индекс нечеткого поиска значений по триграммам ключа
+    """
+    def __init__(self):
+        """
+        Конструктор класса
+        """
+        # триграмма -> список номеров ключей
+        self.__trigrams: dict = {}
+        # список (количество триграмм ключа, значение)
+        self.__items: list = []
+
+    @staticmethod
+    def trigrams(key: str) -> set:
+        """ Множество триграмм ключа, дополненного по краям """
+        key = f"  {key} "
+        return {key[i:i + 3] for i in range(len(key) - 2)}
+
+    def add(self, key: str, value) -> None:
+        """ Добавить значение для всех триграмм ключа """
+        trigrams = self.trigrams(key)
+        number = len(self.__items)
+        self.__items.append((len(trigrams), value))
+        for trigram in trigrams:
+            self.__trigrams.setdefault(trigram, []).append(number)
+
+    def find(self, key: str, threshold: float = 0.4) -> list:
+        """
+        Список значений с наибольшей схожестью триграмм (коэффициент Жаккара не менее threshold)
+        """
+        trigrams = self.trigrams(key)
+        counts = {}
+        for trigram in trigrams:
+            for number in self.__trigrams.get(trigram, []):
+                counts[number] = counts.get(number, 0) + 1
+        best_score = threshold
+        result = []
+        for number, count in counts.items():
+            score = count / (len(trigrams) + self.__items[number][0] - count)
+            if score > best_score:
+                best_score = score
+                result = [self.__items[number][1]]
+            elif score == best_score:
+                result.append(self.__items[number][1])
+        return result
+
+class SchoolIndex:
+    """
+    Индекс поиска классов школы и дней недели
+    """
+    def __init__(self, school):
+        """
+        Конструктор класса
+        school: школа по классам которой строится индекс
+        """
+        self.__hash: str = school.hash
+        self.__classes: PrefixIndex = PrefixIndex()
+        self.__class_names: dict = {}
+        self.__class_trigrams: TrigramIndex = TrigramIndex()
+        self.__days: PrefixIndex = PrefixIndex()
+        for department in school.departments:
+            for class_ in department.class_list:
+                name = normalize_name(class_.name)
+                self.__classes.add(name, class_)
+                self.__class_names.setdefault(name, []).append(class_)
+                self.__class_trigrams.add(name, class_)
+        for number, names in DayOfWeek.week_names.items():
+            for name in names:
+                self.__days.add(normalize_name(name), number)
+
+    @property
+    def hash(self) -> str:
+        """ hash расписания школы, по которому построен индекс """
+        return self.__hash
+
+    def find_classes(self, text: str) -> list:
+        """ Поиск классов по началу названия """
+        text = normalize_name(text)
+        if text == "":
+            return []
+        return self.__classes.find(text)
+
+    def match_classes(self, text: str) -> list:
+        """
+        Поиск классов по произвольному тексту "10а", "10 A", "10-А":
+        точное совпадение названия, затем по началу названия, затем по схожести триграмм
+        """
+        text = normalize_name(text)
+        if text == "":
+            return []
+        if text in self.__class_names:
+            return self.__class_names[text]
+        classes = self.__classes.find(text)
+        if len(classes) > 0:
+            return classes
+        return self.__class_trigrams.find(text)
+
+    def find_day(self, text: str) -> int:
+        """ Поиск номера дня недели по началу названия (0 - понедельник) """
+        days = self.__days.find(normalize_name(text))
+        if len(days) != 1:
+            return None
+        return days[0]
+
+    def parse_query(self, query: str) -> tuple:
+        """
+        Разбор строки запроса "10А пн" - возвращает (список классов, номер дня недели)
+        """
+        words = query.split()
+        day_number = None
+        if len(words) > 1:
+            day_number = self.find_day(words[-1])
+            if day_number is not None:
+                words = words[:-1]
+        return self.find_classes("".join(words)), day_number
+
+# Индекс последнего загруженного расписания школы
+def main():
+    raise SystemError("This file cannot be operable")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+"""
+Модуль реестра школ - загруженные школы, их обновление по расписанию и вытеснение неактивных из памяти
+"""
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+import config as cfg
+from schedule_parser import School, Department, SchoolClass
+from cache_func import stable_id
+from database import get_class_school_url, get_department_school_url, get_school_names
+from schedule_store import ScheduleIndexes
+from school_index import SchoolIndex
+from fetch_pool import fetch_pool
+from state_backend import state_backend, leader_lock
+
+class SchoolEntry:
+    """
+    Школа в реестре
+    """
+    __slots__ = ("url", "refresh_interval", "school", "next_refresh", "indexes", "school_index")
+
+    def __init__(self, url: str, refresh_interval: int):
+        """
+        Конструктор класса
+        url: url страницы расписания школы
+        refresh_interval: интервал обновления расписания (секунд)
+        """
+        self.url: str = url
+        self.refresh_interval: int = refresh_interval
+        # загруженная школа, None - не загружалась или вытеснена из памяти
+        self.school: School = None
+        # время следующего обновления (time.monotonic)
+        self.next_refresh: float = 0.0
+        # индексы расписаний классов и индекс поиска классов загруженной школы
+        self.indexes: ScheduleIndexes = None
+        self.school_index: SchoolIndex = None
+
+class SchoolRegistry:
+    """
+    Реестр школ по url
+    Школы загружаются при первом обращении, в памяти хранится не более capacity школ -
+    при превышении вытесняется школа, к которой дольше всех не обращались
+    """
+    def __init__(self, school_list: list, capacity: int):
+        """
+        Конструктор класса
+        school_list: список (url, интервал обновления), первая школа - школа по умолчанию
+        capacity: количество школ, одновременно хранящихся в памяти
+        """
+        self.__capacity: int = max(1, capacity)
+        # url -> SchoolEntry в порядке последнего обращения
+        self.__entries: OrderedDict = OrderedDict()
+        self.__default_url: str = school_list[0][0] if school_list else cfg.SCHEDULE_URL
+        # url школ в порядке настройки - порядок кнопок меню школ
+        self.__urls: list = []
+        for url, refresh_interval in school_list:
+            self.register(url, refresh_interval)
+
+    @staticmethod
+    def key(url: str) -> int:
+        """ Идентификатор школы в меню бота - по url, известен до загрузки школы """
+        return stable_id(url)
+
+    def register(self, url: str, refresh_interval: int = cfg.SCHOOL_REFRESH_INTERVAL) -> None:
+        """
+        Добавление школы в реестр без загрузки
+        """
+        entry: SchoolEntry = self.__entries.get(url)
+        if entry is None:
+            self.__entries[url] = SchoolEntry(url, refresh_interval)
+            self.__urls.append(url)
+        else:
+            entry.refresh_interval = refresh_interval
+
+    @property
+    def default_url(self) -> str:
+        """ url школы по умолчанию """
+        return self.__default_url
+
+    @property
+    def default(self) -> School:
+        """ Школа по умолчанию - загружается в цикле событий, только при запуске бота """
+        return self.get(self.__default_url)
+
+    @property
+    def urls(self) -> list:
+        """ url всех школ реестра """
+        return list(self.__urls)
+
+    def url_by_key(self, key: int) -> str:
+        """ url школы по идентификатору в меню, None - школа не зарегистрирована """
+        return next((url for url in self.__urls if self.key(url) == key), None)
+
+    def school_names(self) -> dict:
+        """
+        Названия школ для меню: url -> название загруженной или сохраненной в базе школы, иначе url
+        """
+        saved_names = get_school_names()
+        names = {}
+        for url in self.__urls:
+            entry: SchoolEntry = self.__entries[url]
+            name = entry.school.name if entry.school is not None else None
+            names[url] = name or saved_names.get(url) or url
+        return names
+
+    def loaded(self, url: str) -> School:
+        """ Школа по url, если она в памяти - без загрузки """
+        entry: SchoolEntry = self.__entries.get(url)
+        if entry is None or entry.school is None:
+            return None
+        self.__entries.move_to_end(url)
+        return entry.school
+
+    def __entry(self, url: str) -> SchoolEntry:
+        """ Запись реестра, неизвестная школа регистрируется с интервалом обновления по умолчанию """
+        if url not in self.__entries:
+            self.register(url)
+        self.__entries.move_to_end(url)
+        return self.__entries[url]
+
+    @staticmethod
+    def __load(url: str) -> School:
+        """
+        Загрузка школы - до фоновой проверки из базы, если ее там нет - по сети
+        Реплика-последователь вместо сети берет школу, опубликованную лидером, если она есть
+        """
+        school = School(url)
+        if not (cfg.LAZY_STARTUP and school.load_cached()):
+            if leader_lock.is_leader or not state_backend.shared or not school.load_shared():
+                school.refresh()
+        return school
+
+    def get(self, url: str) -> School:
+        """
+        Школа по url - загружается, если ее нет в памяти
+        Загрузка блокирует цикл событий - только при запуске бота, обработчики используют get_async
+        """
+        entry = self.__entry(url)
+        if entry.school is None:
+            self.__attach(entry, self.__load(url))
+        return entry.school
+
+    async def get_async(self, url: str) -> School:
+        """
+        Школа по url - загружается в пуле потоков, если ее нет в памяти
+        """
+        entry = self.__entry(url)
+        if entry.school is None:
+            school = await fetch_pool.run(self.__load, url)
+            # школа могла быть загружена другим обращением, пока загружалась эта
+            if entry.school is None:
+                self.__attach(entry, school)
+        return entry.school
+
+    def put(self, school: School) -> None:
+        """
+        Добавление уже загруженной школы, например восстановленной из PicklePersistence
+        """
+        entry = self.__entry(school.url)
+        if entry.school is None:
+            self.__attach(entry, school)
+
+    def __attach(self, entry: SchoolEntry, school: School) -> None:
+        """ Запоминание загруженной школы и вытеснение неактивных школ """
+        entry.school = school
+        entry.next_refresh = time.monotonic() + entry.refresh_interval
+        self.__evict()
+
+    def __evict(self) -> None:
+        """ Вытеснение из памяти школ, к которым дольше всех не обращались """
+        loaded = [entry for entry in self.__entries.values() if entry.school is not None]
+        for entry in loaded[:max(0, len(loaded) - self.__capacity)]:
+            logging.info(f"Evict school {entry.url}")
+            entry.school = None
+            entry.indexes = None
+            entry.school_index = None
+
+    def loaded_schools(self) -> list:
+        """
+        Школы, хранящиеся в памяти
+        """
+        return [entry.school for entry in self.__entries.values() if entry.school is not None]
+
+    def __school_entry(self, school: School) -> SchoolEntry:
+        """ Запись реестра загруженной школы, None - школа вытеснена или загружена вне реестра """
+        entry: SchoolEntry = self.__entries.get(school.url)
+        return entry if entry is not None and entry.school is school else None
+
+    def indexes(self, school: School) -> ScheduleIndexes:
+        """
+        Индексы расписаний классов школы - пустые, пока их не обновит update_indexes
+        """
+        entry = self.__school_entry(school)
+        if entry is None:
+            return ScheduleIndexes()
+        if entry.indexes is None:
+            entry.indexes = ScheduleIndexes()
+        return entry.indexes
+
+    def update_indexes(self, school: School) -> int:
+        """
+        Обновление индексов расписаний классов школы по уже загруженным расписаниям
+        Возвращает количество обновленных классов
+        """
+        return self.indexes(school).update(school) if self.__school_entry(school) is not None else 0
+
+    def school_index(self, school: School) -> SchoolIndex:
+        """
+        Индекс поиска классов школы - строится один раз для hash расписания школы
+        """
+        entry = self.__school_entry(school)
+        if entry is None:
+            return SchoolIndex(school)
+        if entry.school_index is None or entry.school_index.hash != school.hash:
+            entry.school_index = SchoolIndex(school)
+        return entry.school_index
+
+    def loaded_class(self, class_id: int) -> SchoolClass:
+        """
+        Класс по идентификатору среди школ, хранящихся в памяти
+        """
+        for school in self.loaded_schools():
+            school_class = school.get_class_by_id(class_id)
+            if school_class is not None:
+                return school_class
+        return None
+
+    def loaded_department(self, department_id: int) -> Department:
+        """
+        Корпус по идентификатору среди школ, хранящихся в памяти
+        """
+        for school in self.loaded_schools():
+            department = school.get_department_by_id(department_id)
+            if department is not None:
+                return department
+        return None
+
+    async def find_department(self, department_id: int) -> Department:
+        """
+        Корпус по идентификатору среди всех школ - школа корпуса определяется по базе и загружается в пуле потоков
+        """
+        department = self.loaded_department(department_id)
+        if department is not None:
+            return department
+        url = get_department_school_url(department_id)
+        if url is None or (url in self.__entries and self.__entries[url].school is not None):
+            return None
+        school = await self.get_async(url)
+        return school.get_department_by_id(department_id)
+
+    async def find_class(self, class_id: int) -> SchoolClass:
+        """
+        Класс по идентификатору среди всех школ - школа класса определяется по базе и загружается в пуле потоков
+        """
+        school_class = self.loaded_class(class_id)
+        if school_class is not None:
+            return school_class
+        url = get_class_school_url(class_id)
+        if url is None or (url in self.__entries and self.__entries[url].school is not None):
+            return None
+        school = await self.get_async(url)
+        return school.get_class_by_id(class_id)
+
+    async def sync_shared(self) -> int:
+        """
+        Загрузка в пуле потоков структуры школ, опубликованной репликой-лидером - только для загруженных школ,
+        версия которых в общем хранилище отличается от hash школы
+        Возвращает количество обновленных школ
+        """
+        versions = state_backend.get_versions(School.SHARED_VERSIONS)
+        changed = [school for school in self.loaded_schools() if versions.get(school.url, school.hash) != school.hash]
+        results = await asyncio.gather(*(fetch_pool.run(school.load_shared) for school in changed))
+        return sum(1 for result in results if result)
+
+    async def refresh_due(self, limit: int) -> int:
+        """
+        Обновление по сети в пуле потоков не более limit загруженных школ, у которых наступило время обновления
+        Школы, вытесненные из памяти, не обновляются - они загрузятся при обращении
+        Возвращает количество обновленных школ
+        """
+        now = time.monotonic()
+        due = sorted((entry for entry in self.__entries.values() if entry.school is not None and entry.next_refresh <= now),
+                     key=lambda entry: entry.next_refresh)[:limit]
+        for entry in due:
+            entry.next_refresh = now + entry.refresh_interval
+            logging.info(f"Refresh school {entry.url}")
+        await asyncio.gather(*(fetch_pool.refresh_school(entry.school) for entry in due))
+        # расписания классов обновленных школ проверяются по сети фоновым заданием небольшими порциями
+        for entry in due:
+            if entry.school is None:
+                continue
+            for department in entry.school.departments:
+                for school_class in department.class_list:
+                    if school_class.loaded_week_schedule is not None:
+                        school_class.loaded_week_schedule.expire()
+        return len(due)
+
+# Реестр школ бота
+school_registry = SchoolRegistry(cfg.SCHOOLS, cfg.SCHOOL_CACHE_SIZE)
+
+def main():
+    raise SystemError("This file cannot be operable")
+
+if __name__ == "__main__":
+    main()
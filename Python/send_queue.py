@@ -0,0 +1,277 @@
+"""
+Модуль очереди отправки сообщений с ограничением частоты
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from telegram.error import RetryAfter, Forbidden, BadRequest, TelegramError
+from database import save_pending_messages, delete_pending_messages, load_pending_messages
+
+# Ограничения telegram: сообщений в секунду всего и в один чат
+GLOBAL_RATE = 30
+CHAT_RATE = 1
+# Приоритеты сообщений - меньшее значение отправляется раньше
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+# Количество попыток отправки при сетевых ошибках
+MAX_ATTEMPTS = 3
+
+class TokenBucket:
+    """
+    Ограничитель частоты "ведро токенов"
+    """
+    def __init__(self, rate: float, capacity: float):
+        """
+        Конструктор класса
+        rate: скорость пополнения токенов в секунду
+        capacity: максимальное количество токенов
+        """
+        self.__rate: float = rate
+        self.__capacity: float = capacity
+        self.__tokens: float = capacity
+        self.__updated: float = time.monotonic()
+
+    def __refill(self) -> None:
+        """ Пополнение токенов за прошедшее время """
+        now = time.monotonic()
+        self.__tokens = min(self.__capacity, self.__tokens + (now - self.__updated) * self.__rate)
+        self.__updated = now
+
+    def delay(self) -> float:
+        """ Время ожидания до появления токена (секунд) """
+        self.__refill()
+        if self.__tokens >= 1:
+            return 0
+        return (1 - self.__tokens) / self.__rate
+
+    def consume(self) -> None:
+        """ Использовать токен """
+        self.__refill()
+        self.__tokens -= 1
+
+    @property
+    def is_full(self) -> bool:
+        """ Ведро полное - ограничитель не хранит состояния """
+        self.__refill()
+        return self.__tokens >= self.__capacity
+
+class OutgoingMessage:
+    """
+    Сообщение ожидающее отправки
+    """
+    def __init__(self, chat_id: int, text: str, parse_mode: str = None, priority: int = PRIORITY_NORMAL, id: int = None):
+        """
+        Конструктор класса
+        """
+        self.id: int = id
+        self.chat_id: int = chat_id
+        self.text: str = text
+        self.parse_mode: str = parse_mode
+        self.priority: int = priority
+        self.attempts: int = 0
+
+class SendQueue:
+    """
+    Очередь исходящих сообщений с приоритетами
+    Ограничение частоты - общее и для каждого чата ведром токенов
+    Не отправленные сообщения хранятся в базе данных и отправляются после перезапуска
+    """
+    def __init__(self, global_rate: float = GLOBAL_RATE, chat_rate: float = CHAT_RATE):
+        """
+        Конструктор класса
+        global_rate: максимальное количество сообщений в секунду
+        chat_rate: максимальное количество сообщений в секунду в один чат
+        """
+        self.__global_rate: float = global_rate
+        self.__chat_rate: float = chat_rate
+        self.__global_bucket: TokenBucket = TokenBucket(global_rate, global_rate)
+        self.__chat_buckets: dict = {}
+        # Сообщения готовые к отправке (priority, seq, message)
+        self.__ready: list = []
+        # Отложенные сообщения (time, seq, message)
+        self.__delayed: list = []
+        self.__sequence = itertools.count()
+        self.__sent_ids: list = []
+        self.__paused_until: float = 0
+        self.__event: asyncio.Event = None
+        self.__task: asyncio.Task = None
+        self.__sent_count: int = 0
+
+    def start(self, bot) -> None:
+        """
+        Запуск обработчика очереди, загрузка не отправленных сообщений из базы данных
+        """
+        if self.__task is None:
+            self.__event = asyncio.Event()
+            pending = load_pending_messages()
+            for message_data in pending:
+                self.__push(OutgoingMessage(message_data.chat_id, message_data.text, message_data.parse_mode,
+                                            message_data.priority, message_data.id))
+            if len(pending) > 0:
+                logging.info(f"Send queue restored {len(pending)} messages")
+            self.__task = asyncio.get_event_loop().create_task(self.__worker(bot))
+
+    async def stop(self) -> None:
+        """
+        Остановка обработчика очереди
+        Не отправленные сообщения остаются в базе данных
+        """
+        if self.__task is not None:
+            self.__task.cancel()
+            try:
+                await self.__task
+            except asyncio.CancelledError:
+                pass
+            self.__task = None
+        self.__flush_sent()
+
+    def put(self, chat_id: int, text: str, parse_mode: str = None, priority: int = PRIORITY_NORMAL) -> None:
+        """
+        Добавить сообщение в очередь отправки
+        """
+        self.put_many([chat_id], text, parse_mode, priority)
+
+    def put_many(self, chat_ids: list, text: str, parse_mode: str = None, priority: int = PRIORITY_NORMAL) -> None:
+        """
+        Добавить одно сообщение для нескольких чатов - сохранение в базу данных одной транзакцией
+        """
+        if self.__task is None:
+            raise RuntimeError("Send queue is not started")
+        message_list = [OutgoingMessage(chat_id, text, parse_mode, priority) for chat_id in chat_ids]
+        ids = save_pending_messages([(message.chat_id, text, parse_mode, priority) for message in message_list])
+        for message, id in zip(message_list, ids):
+            message.id = id
+            self.__push(message)
+
+    @property
+    def size(self) -> int:
+        """ Количество сообщений ожидающих отправки """
+        return len(self.__ready) + len(self.__delayed)
+
+    @property
+    def sent_count(self) -> int:
+        """ Количество отправленных сообщений """
+        return self.__sent_count
+
+    def __push(self, message: OutgoingMessage, ready_time: float = None) -> None:
+        """
+        Поместить сообщение в очередь готовых или отложенных
+        """
+        if ready_time is None:
+            heapq.heappush(self.__ready, (message.priority, next(self.__sequence), message))
+        else:
+            heapq.heappush(self.__delayed, (ready_time, next(self.__sequence), message))
+        if self.__event is not None:
+            self.__event.set()
+
+    def __chat_bucket(self, chat_id: int) -> TokenBucket:
+        """
+        Ограничитель частоты чата
+        """
+        bucket = self.__chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.__chat_buckets) > 10000:
+                # Удаляем ограничители чатов, которые уже восстановились
+                self.__chat_buckets = {key: value for key, value in self.__chat_buckets.items() if not value.is_full}
+            bucket = TokenBucket(self.__chat_rate, 1)
+            self.__chat_buckets[chat_id] = bucket
+        return bucket
+
+    def __flush_sent(self) -> None:
+        """
+        Удаление из базы данных обработанных сообщений
+        """
+        if len(self.__sent_ids) > 0:
+            delete_pending_messages(self.__sent_ids)
+            self.__sent_ids = []
+
+    def __done(self, message: OutgoingMessage) -> None:
+        """
+        Сообщение обработано - удаляем его из базы данных пакетами
+        """
+        if message.id is not None:
+            self.__sent_ids.append(message.id)
+        if len(self.__sent_ids) >= 50 or self.size == 0:
+            self.__flush_sent()
+
+    async def __next_message(self) -> OutgoingMessage:
+        """
+        Ожидание следующего сообщения, которое можно отправить
+        """
+        while True:
+            now = time.monotonic()
+            while len(self.__delayed) > 0 and self.__delayed[0][0] <= now:
+                message: OutgoingMessage = heapq.heappop(self.__delayed)[2]
+                heapq.heappush(self.__ready, (message.priority, next(self.__sequence), message))
+            if len(self.__ready) > 0:
+                message: OutgoingMessage = heapq.heappop(self.__ready)[2]
+                chat_delay = self.__chat_bucket(message.chat_id).delay()
+                if chat_delay > 0:
+                    # Чат занят - откладываем, не задерживая сообщения в другие чаты
+                    heapq.heappush(self.__delayed, (now + chat_delay, next(self.__sequence), message))
+                    continue
+                return message
+            timeout = None
+            if len(self.__delayed) > 0:
+                timeout = self.__delayed[0][0] - now
+            self.__event.clear()
+            try:
+                await asyncio.wait_for(self.__event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def __worker(self, bot) -> None:
+        """
+        Обработчик очереди
+        """
+        while True:
+            message = await self.__next_message()
+            pause = self.__paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            global_delay = self.__global_bucket.delay()
+            if global_delay > 0:
+                await asyncio.sleep(global_delay)
+            self.__global_bucket.consume()
+            self.__chat_bucket(message.chat_id).consume()
+            message.attempts += 1
+            try:
+                await bot.send_message(chat_id=message.chat_id, text=message.text, parse_mode=message.parse_mode)
+                self.__sent_count += 1
+                self.__done(message)
+            except RetryAfter as e:
+                # Превышены ограничения telegram - приостанавливаем всю отправку
+                logging.warning(f"Send to {message.chat_id} flood control, retry after {e.retry_after}")
+                self.__paused_until = time.monotonic() + e.retry_after
+                message.attempts -= 1
+                self.__push(message)
+            except (Forbidden, BadRequest) as e:
+                # Пользователь заблокировал бота или сообщение некорректно - повтор бесполезен
+                logging.error(f"Error send message to {message.chat_id} {type(e)} {e}")
+                self.__done(message)
+            except TelegramError as e:
+                logging.error(f"Error send message to {message.chat_id} {type(e)} {e}. Attempt {message.attempts}")
+                if message.attempts < MAX_ATTEMPTS:
+                    self.__push(message, time.monotonic() + 2 ** message.attempts)
+                else:
+                    self.__done(message)
+            except Exception as e:
+                # Непредвиденная ошибка не должна останавливать обработчик - иначе очередь перестанет отправляться
+                logging.exception(f"Unexpected error send message to {message.chat_id} {type(e)} {e}. Attempt {message.attempts}")
+                if message.attempts < MAX_ATTEMPTS:
+                    self.__push(message, time.monotonic() + 2 ** message.attempts)
+                else:
+                    logging.error(f"Drop message to {message.chat_id} after {message.attempts} attempts")
+                    self.__done(message)
+
+# Общая очередь отправки сообщений бота
+send_queue = SendQueue()
+
+def main():
+    raise SystemError("This file cannot be operable")
+
+if __name__ == "__main__":
+    main()
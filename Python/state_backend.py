@@ -0,0 +1,438 @@
+"""
+Модуль хранилища общего состояния бота - в памяти процесса или в Redis-совместимом сервере (протокол RESP)
+Общее хранилище позволяет запускать несколько реплик бота: разобранные расписания, готовые сообщения,
+ограничение частоты запросов и данные пользователей хранятся в нем, а обновляет расписания
+только реплика, захватившая блокировку лидера
+"""
+import os
+import time
+import socket
+import pickle
+import logging
+import threading
+from urllib.parse import urlparse
+from uuid import uuid4
+import config as cfg
+
+class RespError(Exception):
+    """
+    Ошибка, возвращенная сервером RESP
+    """
+
+# Ошибки недоступности хранилища
+BACKEND_ERRORS = (OSError, ConnectionError, RespError)
+
+class StateBackend:
+    """
+    Хранилище состояния - строки байт по ключу со временем жизни и словари (hash)
+    """
+    # Хранилище доступно другим репликам бота
+    shared: bool = False
+
+    def get(self, key: str) -> bytes:
+        """ Значение ключа, None если его нет """
+        raise NotImplementedError
+
+    def set(self, key: str, value: bytes, ttl: float = None, only_new: bool = False) -> bool:
+        """
+        Запись значения ключа
+        ttl: время жизни (секунд), None - без ограничения
+        only_new: записать только если ключа нет
+        Возвращает False если значение не записано
+        """
+        raise NotImplementedError
+
+    def expire(self, key: str, ttl: float) -> bool:
+        """ Установка времени жизни ключа, False если ключа нет """
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        """ Удаление ключа """
+        raise NotImplementedError
+
+    def hset(self, name: str, field: bytes, value: bytes) -> None:
+        """ Запись поля словаря name """
+        raise NotImplementedError
+
+    def hget(self, name: str, field: bytes) -> bytes:
+        """ Значение поля словаря name, None если его нет """
+        raise NotImplementedError
+
+    def hdel(self, name: str, field: bytes) -> None:
+        """ Удаление поля словаря name """
+        raise NotImplementedError
+
+    def hgetall(self, name: str) -> dict:
+        """ Все поля словаря name """
+        raise NotImplementedError
+
+    def compare_expire(self, key: str, value: bytes, ttl: float) -> bool:
+        """ Атомарная установка времени жизни ключа, только если его значение равно value """
+        raise NotImplementedError
+
+    def compare_delete(self, key: str, value: bytes) -> bool:
+        """ Атомарное удаление ключа, только если его значение равно value """
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """ Закрытие соединения """
+
+    def get_object(self, key: str) -> any:
+        """ Объект, сохраненный set_object, None если его нет или хранилище недоступно """
+        try:
+            data = self.get(key)
+        except BACKEND_ERRORS as e:
+            logging.error(f"State backend get {key} error {e}")
+            return None
+        return None if data is None else pickle.loads(data)
+
+    def set_object(self, key: str, value: any, ttl: float = None, only_new: bool = False) -> bool:
+        """ Запись объекта в pickle, False если хранилище недоступно или ключ уже есть при only_new """
+        try:
+            return self.set(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), ttl, only_new)
+        except BACKEND_ERRORS as e:
+            logging.error(f"State backend set {key} error {e}")
+            return False
+
+    def set_version(self, name: str, key: str, version: str) -> None:
+        """ Запись версии (hash) объекта key в словарь версий name, ошибка хранилища только логируется """
+        try:
+            self.hset(name, key.encode("utf-8"), version.encode("utf-8"))
+        except BACKEND_ERRORS as e:
+            logging.error(f"State backend set version {name} {key} error {e}")
+
+    def get_versions(self, name: str) -> dict:
+        """ Словарь версий name: ключ объекта -> версия, пустой если хранилище недоступно """
+        try:
+            return {key.decode("utf-8"): value.decode("utf-8") for key, value in self.hgetall(name).items()}
+        except BACKEND_ERRORS as e:
+            logging.error(f"State backend get versions {name} error {e}")
+            return {}
+
+    def throttle(self, key: str, value: str, seconds: float) -> bool:
+        """
+        Ограничение частоты повторения значения value по ключу key
+        Возвращает False если то же значение уже было записано меньше seconds секунд назад
+        Если хранилище недоступно - запрос не ограничивается
+        """
+        data = value.encode("utf-8")
+        try:
+            if self.get(key) == data:
+                return False
+            self.set(key, data, seconds)
+        except BACKEND_ERRORS as e:
+            logging.error(f"State backend throttle {key} error {e}")
+        return True
+
+# Количество записей с временем жизни, после которого из памяти удаляются устаревшие ключи
+MEMORY_PURGE_WRITES = 1000
+
+class MemoryBackend(StateBackend):
+    """
+    Хранилище в памяти процесса - для запуска одной реплики
+    """
+    def __init__(self):
+        """
+        Конструктор класса
+        """
+        # ключ -> (значение, время окончания жизни time.monotonic или None)
+        self.__values: dict = {}
+        # название -> словарь
+        self.__hashes: dict = {}
+        self.__lock = threading.Lock()
+        # количество записей с временем жизни после последнего удаления устаревших ключей
+        self.__expiring_writes: int = 0
+
+    def __purge(self) -> None:
+        """ Удаление устаревших ключей, к которым больше не обращались """
+        now = time.monotonic()
+        for key in [key for key, item in self.__values.items() if item[1] is not None and item[1] <= now]:
+            del self.__values[key]
+        self.__expiring_writes = 0
+
+    def __alive(self, key: str) -> tuple:
+        """ Значение ключа с учетом времени жизни """
+        item = self.__values.get(key)
+        if item is not None and item[1] is not None and item[1] <= time.monotonic():
+            del self.__values[key]
+            return None
+        return item
+
+    def get(self, key: str) -> bytes:
+        with self.__lock:
+            item = self.__alive(key)
+            return None if item is None else item[0]
+
+    def set(self, key: str, value: bytes, ttl: float = None, only_new: bool = False) -> bool:
+        with self.__lock:
+            if only_new and self.__alive(key) is not None:
+                return False
+            self.__values[key] = (value, None if ttl is None else time.monotonic() + ttl)
+            if ttl is not None:
+                self.__expiring_writes += 1
+                if self.__expiring_writes >= MEMORY_PURGE_WRITES:
+                    self.__purge()
+            return True
+
+    def expire(self, key: str, ttl: float) -> bool:
+        with self.__lock:
+            item = self.__alive(key)
+            if item is None:
+                return False
+            self.__values[key] = (item[0], time.monotonic() + ttl)
+            return True
+
+    def delete(self, key: str) -> None:
+        with self.__lock:
+            self.__values.pop(key, None)
+            self.__hashes.pop(key, None)
+
+    def hset(self, name: str, field: bytes, value: bytes) -> None:
+        with self.__lock:
+            self.__hashes.setdefault(name, {})[field] = value
+
+    def hget(self, name: str, field: bytes) -> bytes:
+        with self.__lock:
+            return self.__hashes.get(name, {}).get(field)
+
+    def hdel(self, name: str, field: bytes) -> None:
+        with self.__lock:
+            self.__hashes.get(name, {}).pop(field, None)
+
+    def hgetall(self, name: str) -> dict:
+        with self.__lock:
+            return dict(self.__hashes.get(name, {}))
+
+    def compare_expire(self, key: str, value: bytes, ttl: float) -> bool:
+        with self.__lock:
+            item = self.__alive(key)
+            if item is None or item[0] != value:
+                return False
+            self.__values[key] = (value, time.monotonic() + ttl)
+            return True
+
+    def compare_delete(self, key: str, value: bytes) -> bool:
+        with self.__lock:
+            item = self.__alive(key)
+            if item is None or item[0] != value:
+                return False
+            del self.__values[key]
+            return True
+
+# Скрипты сервера для блокировки лидера - проверка владельца и изменение ключа выполняются атомарно
+COMPARE_EXPIRE_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('pexpire', KEYS[1], ARGV[2]) else return 0 end"
+COMPARE_DELETE_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) else return 0 end"
+
+class RespBackend(StateBackend):
+    """
+    Хранилище в Redis-совместимом сервере по протоколу RESP2
+    При ошибке соединения запрос повторяется один раз с новым соединением
+    Запросы синхронные и выполняются в вызывающем потоке: ограничение частоты и кеш сообщений вызываются
+    из обработчиков, поэтому каждый запрос задерживает цикл событий на время обмена с сервером -
+    доли миллисекунды для сервера в той же сети, а при недоступном сервере до двух timeout
+    (с повторным подключением). Поэтому timeout небольшой, а сервер должен быть рядом с репликами
+    """
+    shared: bool = True
+
+    def __init__(self, host: str, port: int = 6379, db: int = 0, password: str = None, timeout: float = cfg.STATE_BACKEND_TIMEOUT):
+        """
+        Конструктор класса
+        """
+        self.__address: tuple = (host, port)
+        self.__db: int = db
+        self.__password: str = password
+        self.__timeout: float = timeout
+        self.__socket: socket.socket = None
+        self.__file = None
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def from_url(url: str) -> "RespBackend":
+        """ Хранилище по url вида redis://[:password@]host[:port][/db] """
+        parsed = urlparse(url)
+        db = int(parsed.path[1:]) if parsed.path[1:].isdigit() else 0
+        return RespBackend(parsed.hostname or "localhost", parsed.port or 6379, db, parsed.password)
+
+    def __connect(self) -> None:
+        """ Подключение к серверу """
+        self.__socket = socket.create_connection(self.__address, self.__timeout)
+        self.__file = self.__socket.makefile("rb")
+        if self.__password:
+            self.__call("AUTH", self.__password)
+        if self.__db:
+            self.__call("SELECT", self.__db)
+
+    def close(self) -> None:
+        with self.__lock:
+            if self.__socket is not None:
+                self.__file.close()
+                self.__socket.close()
+                self.__socket = None
+                self.__file = None
+
+    @staticmethod
+    def __encode(args: tuple) -> bytes:
+        """ Команда в формате RESP - массив строк байт """
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        return b"".join(parts)
+
+    def __read(self) -> any:
+        """ Чтение ответа сервера """
+        line = self.__file.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("Connection closed by server")
+        kind, data = line[:1], line[1:-2]
+        if kind == b"+":
+            return data.decode("utf-8")
+        if kind == b"-":
+            raise RespError(data.decode("utf-8"))
+        if kind == b":":
+            return int(data)
+        if kind == b"$":
+            length = int(data)
+            if length < 0:
+                return None
+            value = self.__file.read(length + 2)
+            return value[:-2]
+        if kind == b"*":
+            length = int(data)
+            return None if length < 0 else [self.__read() for _ in range(length)]
+        raise ConnectionError(f"Unknown reply {line!r}")
+
+    def __call(self, *args) -> any:
+        """ Выполнение команды на открытом соединении """
+        self.__socket.sendall(self.__encode(args))
+        return self.__read()
+
+    def execute(self, *args) -> any:
+        """
+        Выполнение команды сервера
+        """
+        with self.__lock:
+            for attempt in range(2):
+                try:
+                    if self.__socket is None:
+                        self.__connect()
+                    return self.__call(*args)
+                except (OSError, ConnectionError) as e:
+                    if self.__socket is not None:
+                        self.__file.close()
+                        self.__socket.close()
+                        self.__socket = None
+                        self.__file = None
+                    if attempt == 1:
+                        raise
+                    logging.warning(f"State backend reconnect after {e}")
+
+    def get(self, key: str) -> bytes:
+        return self.execute("GET", key)
+
+    def set(self, key: str, value: bytes, ttl: float = None, only_new: bool = False) -> bool:
+        args = ["SET", key, value]
+        if ttl is not None:
+            args += ["PX", int(ttl * 1000)]
+        if only_new:
+            args.append("NX")
+        return self.execute(*args) is not None
+
+    def expire(self, key: str, ttl: float) -> bool:
+        return self.execute("PEXPIRE", key, int(ttl * 1000)) == 1
+
+    def delete(self, key: str) -> None:
+        self.execute("DEL", key)
+
+    def hset(self, name: str, field: bytes, value: bytes) -> None:
+        self.execute("HSET", name, field, value)
+
+    def hget(self, name: str, field: bytes) -> bytes:
+        return self.execute("HGET", name, field)
+
+    def hdel(self, name: str, field: bytes) -> None:
+        self.execute("HDEL", name, field)
+
+    def hgetall(self, name: str) -> dict:
+        items = self.execute("HGETALL", name) or []
+        return dict(zip(items[0::2], items[1::2]))
+
+    def compare_expire(self, key: str, value: bytes, ttl: float) -> bool:
+        return self.execute("EVAL", COMPARE_EXPIRE_SCRIPT, 1, key, value, int(ttl * 1000)) == 1
+
+    def compare_delete(self, key: str, value: bytes) -> bool:
+        return self.execute("EVAL", COMPARE_DELETE_SCRIPT, 1, key, value) == 1
+
+class LeaderLock:
+    """
+    Блокировка лидера - обновлять расписания и выполнять рассылки должна только одна реплика бота
+    Блокировка захватывается на ttl секунд и должна продлеваться чаще, чем истекает
+    Продление и освобождение проверяют владельца атомарно на сервере - реплика не может продлить
+    или удалить блокировку, захваченную другой репликой после истечения ее блокировки
+    """
+    def __init__(self, backend: StateBackend, name: str, ttl: float):
+        """
+        Конструктор класса
+        """
+        self.__backend: StateBackend = backend
+        self.__key: str = f"lock:{name}"
+        self.__ttl: float = ttl
+        self.__owner: bytes = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}".encode("utf-8")
+        self.__is_leader: bool = False
+
+    @property
+    def is_leader(self) -> bool:
+        """ Реплика является лидером """
+        return self.__is_leader
+
+    def acquire(self) -> bool:
+        """
+        Захват или продление блокировки
+        Возвращает True если реплика является лидером
+        """
+        was_leader = self.__is_leader
+        try:
+            if self.__backend.set(self.__key, self.__owner, self.__ttl, only_new=True):
+                self.__is_leader = True
+            else:
+                self.__is_leader = self.__backend.compare_expire(self.__key, self.__owner, self.__ttl)
+        except BACKEND_ERRORS as e:
+            logging.error(f"Leader lock error {e}")
+            self.__is_leader = False
+        if was_leader != self.__is_leader:
+            logging.info(f"Leader lock {'acquired' if self.__is_leader else 'lost'}")
+        return self.__is_leader
+
+    def release(self) -> None:
+        """
+        Освобождение блокировки при остановке, если она принадлежит реплике
+        """
+        if not self.__is_leader:
+            return
+        self.__is_leader = False
+        try:
+            self.__backend.compare_delete(self.__key, self.__owner)
+        except BACKEND_ERRORS as e:
+            logging.error(f"Leader lock release error {e}")
+
+def create_backend(url: str) -> StateBackend:
+    """
+    Хранилище по url: пустая строка - в памяти процесса, redis://... - Redis-совместимый сервер
+    """
+    if not url:
+        return MemoryBackend()
+    if urlparse(url).scheme in ("redis", "resp"):
+        return RespBackend.from_url(url)
+    raise ValueError(f"Unknown state backend {url}")
+
+# Хранилище состояния бота
+state_backend = create_backend(cfg.STATE_BACKEND_URL)
+# Блокировка лидера реплик бота
+leader_lock = LeaderLock(state_backend, "leader", cfg.LEADER_LOCK_TTL)
+
+def main():
+    raise SystemError("This file cannot be operable")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Модуль хранения данных telegram бота (PicklePersistence) в общем хранилище состояния реплик
+"""
+import pickle
+from telegram.ext import BasePersistence, PersistenceInput
+from state_backend import StateBackend
+
+class BackendPersistence(BasePersistence):
+    """
+    Данные пользователей, чатов и бота в хранилище состояния
+    Каждый пользователь/чат - поле словаря хранилища, запись не переписывает данные других реплик
+    Состояния диалогов не хранятся: PTB читает их только при запуске, поэтому общими для реплик они быть не могут -
+    меню бота не использует ConversationHandler
+    """
+    def __init__(self, backend: StateBackend, prefix: str = "persistence", update_interval: float = 60):
+        """
+        Конструктор класса
+        backend: хранилище состояния
+        prefix: префикс ключей хранилища
+        """
+        super().__init__(store_data=PersistenceInput(callback_data=False), update_interval=update_interval)
+        self.__backend: StateBackend = backend
+        self.__prefix: str = prefix
+
+    def __key(self, name: str) -> str:
+        """ Ключ словаря хранилища """
+        return f"{self.__prefix}:{name}"
+
+    @staticmethod
+    def __dumps(value: any) -> bytes:
+        """ Объект в pickle """
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def __load_dict(self, name: str) -> dict:
+        """ Словарь id -> данные """
+        return {int(field): pickle.loads(value) for field, value in self.__backend.hgetall(self.__key(name)).items()}
+
+    def __load_item(self, name: str, item_id: int) -> dict:
+        """ Данные одного пользователя/чата """
+        value = self.__backend.hget(self.__key(name), str(item_id).encode("utf-8"))
+        return None if value is None else pickle.loads(value)
+
+    async def get_user_data(self) -> dict:
+        return self.__load_dict("user_data")
+
+    async def get_chat_data(self) -> dict:
+        return self.__load_dict("chat_data")
+
+    async def get_bot_data(self) -> dict:
+        data = self.__backend.get(self.__key("bot_data"))
+        return {} if data is None else pickle.loads(data)
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name: str, key: tuple, new_state: object) -> None:
+        pass
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self.__backend.hset(self.__key("user_data"), str(user_id).encode("utf-8"), self.__dumps(data))
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        self.__backend.hset(self.__key("chat_data"), str(chat_id).encode("utf-8"), self.__dumps(data))
+
+    async def update_bot_data(self, data: dict) -> None:
+        self.__backend.set(self.__key("bot_data"), self.__dumps(data))
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self.__backend.hdel(self.__key("chat_data"), str(chat_id).encode("utf-8"))
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self.__backend.hdel(self.__key("user_data"), str(user_id).encode("utf-8"))
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        """ Данные пользователя могли измениться другой репликой """
+        stored = self.__load_item("user_data", user_id)
+        if stored is not None:
+            user_data.update(stored)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        """ Данные чата могли измениться другой репликой """
+        stored = self.__load_item("chat_data", chat_id)
+        if stored is not None:
+            chat_data.update(stored)
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        """ Данные записываются в хранилище сразу при обновлении """
+
+def main():
+    raise SystemError("This file cannot be operable")
+
+if __name__ == "__main__":
+    main()
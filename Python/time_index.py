@@ -0,0 +1,145 @@
+"""
+Модуль индекса уроков класса по времени
+"""
+import re
+from bisect import bisect_left, bisect_right
+import config as cfg
+
+def time_to_minutes(value: str) -> int:
+    """
+    Перевод времени ЧЧ:ММ в минуты от начала суток
+    """
+    hours, minutes = re.split(R"[:.]", value)
+    return int(hours) * 60 + int(minutes)
+
+def lesson_minutes(hour_start, hour_end) -> tuple:
+    """
+    Время начала и окончания урока в минутах от начала суток
+    hour_start/hour_end: номер урока или строка заголовка таблицы со временем урока
+    Возвращает (None, None) если время урока определить не удалось
+    """
+    def parse(value) -> tuple:
+        if value is None:
+            return None, None
+        value = str(value)
+        times = re.findall(R"\d{1,2}[:.]\d{2}", value)
+        if len(times) >= 2:
+            return time_to_minutes(times[0]), time_to_minutes(times[-1])
+        if len(times) == 1:
+            start = time_to_minutes(times[0])
+            return start, start + cfg.LESSON_DURATION
+        match = re.match(R"\s*(\d{1,2})", value)
+        if match and int(match.group(1)) in cfg.LESSON_TIMES:
+            start, end = cfg.LESSON_TIMES[int(match.group(1))]
+            return time_to_minutes(start), time_to_minutes(end)
+        return None, None
+
+    start, end = parse(hour_start)
+    if hour_end is not None and hour_end != hour_start:
+        end = parse(hour_end)[1] or end
+    return start, end
+
+def lesson_number(hour) -> int:
+    """
+    Номер урока по номеру или строке заголовка таблицы со временем урока
+    """
+    if hour is None:
+        return None
+    if isinstance(hour, int):
+        return hour
+    match = re.match(R"\s*(\d{1,2})(?![:.\d])", str(hour))
+    if match:
+        return int(match.group(1))
+    start, _ = lesson_minutes(hour, None)
+    if start is not None:
+        for number, (begin, end) in cfg.LESSON_TIMES.items():
+            if time_to_minutes(begin) <= start < time_to_minutes(end):
+                return number
+    return None
+
+def current_lesson_number(minutes: int) -> int:
+    """
+    Номер текущего урока, а на перемене - следующего
+    """
+    for number, (_, end) in sorted(cfg.LESSON_TIMES.items()):
+        if minutes < time_to_minutes(end):
+            return number
+    return None
+
+class ClassTimeIndex:
+    """
+    Индекс уроков класса по (номер дня недели, начало урока)
+    """
+    def __init__(self, week_schedule):
+        """
+        Конструктор класса
+        week_schedule: расписание класса
+        """
+        self.__hash: str = week_schedule.hash
+        # неделя -> отсортированный список ключей (номер дня недели, начало урока)
+        self.__keys: dict = {}
+        # неделя -> список (окончание урока, урок) в порядке ключей
+        self.__items: dict = {}
+        entries = {}
+        for week in week_schedule.week_list():
+            for day_of_week in week_schedule.day_of_week_list(week):
+                for lesson in week_schedule.lesson_list(week, day_of_week):
+                    start, end = lesson_minutes(lesson.ident.hour_start, lesson.hour_end)
+                    if start is None:
+                        continue
+                    entries.setdefault(week, []).append((lesson.ident.day_of_week_number, start, end, lesson))
+        for week, week_entries in entries.items():
+            week_entries.sort(key=lambda entry: (entry[0], entry[1]))
+            self.__keys[week] = [(entry[0], entry[1]) for entry in week_entries]
+            self.__items[week] = [(entry[2], entry[3]) for entry in week_entries]
+
+    @property
+    def hash(self) -> str:
+        """ hash расписания по которому построен индекс """
+        return self.__hash
+
+    def day_lessons(self, week: int, day_number: int) -> list:
+        """
+        Уроки дня day_number
+        """
+        keys = self.__keys.get(week, [])
+        first = bisect_left(keys, (day_number, -1))
+        last = bisect_left(keys, (day_number + 1, -1))
+        return [item[1] for item in self.__items[week][first:last]]
+
+    def current_and_next(self, week: int, day_number: int, minutes: int) -> tuple:
+        """
+        Текущий и следующий урок на момент minutes дня day_number
+        Следующий урок может быть в другой день недели
+        """
+        keys = self.__keys.get(week, [])
+        if len(keys) == 0:
+            return None, None
+        items = self.__items[week]
+        position = bisect_right(keys, (day_number, minutes))
+        current = None
+        if position > 0 and keys[position - 1][0] == day_number and items[position - 1][0] > minutes:
+            current = items[position - 1][1]
+        # следующий урок - первый начинающийся позже, с переходом на начало недели
+        next_lesson = items[position % len(items)][1]
+        return current, next_lesson
+
+# Индексы классов class_id -> ClassTimeIndex
+_time_indexes: dict = {}
+
+def get_time_index(week_schedule) -> ClassTimeIndex:
+    """
+    Индекс расписания класса - перестраивается только при изменении hash расписания
+    """
+    class_id = week_schedule.school_class.id
+    time_index: ClassTimeIndex = _time_indexes.get(class_id)
+    if time_index is None or time_index.hash != week_schedule.hash:
+        time_index = ClassTimeIndex(week_schedule)
+        _time_indexes[class_id] = time_index
+    return time_index
+
+def main():
+    raise SystemError("This file cannot be operable")
+
+if __name__ == "__main__":
+    main()
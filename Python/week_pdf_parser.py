@@ -9,20 +9,58 @@ from datetime import datetime
 from hashlib import md5
 from urllib.parse import unquote
 import random
+import time
+from enum import Enum
 import requests
-from PyPDF2 import PdfReader
-from pdfminer.high_level import extract_pages
-from pdfminer.layout import LTTextContainer, LTPage, LTFigure
 from telegram.constants import ParseMode
-import pdfplumber
-from cache_func import timed_lru_cache, hash_string
+from cache_func import timed_lru_cache, stable_id, intern_str, restore_slots
 import config as cfg
-from database import load_pdf_from_db, save_pdf_to_db
+from metrics import metrics
+from database import init_db, load_pdf_from_db, get_last_week_schedule_hash, save_pdf_to_db, save_schedule_changes, add_parse_record
+from schedule_diff import diff_lessons
+from state_backend import state_backend, leader_lock
+
+# Общая сессия http - соединения с сайтом школы используются повторно
+_http_session: requests.Session = None
+
+def get_http_session() -> requests.Session:
+    """
+    Общая сессия http, создается при первом обращении
+    """
+    global _http_session
+    if _http_session is None:
+        _http_session = requests.Session()
+    return _http_session
+
+def close_http_session() -> None:
+    """
+    Закрытие соединений общей сессии http
+    """
+    global _http_session
+    if _http_session is not None:
+        _http_session.close()
+        _http_session = None
+
+def download(url: str, timeouts: tuple = (6, 20)) -> requests.models.Response:
+    """
+    Загрузка файла по url
+    timeouts: (conn_timeout, read_timeout)
+    """
+    user_agents = [
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36",
+        "Mozilla/5.0 (Windows NT 10.0; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/56.0.2924.87 Safari/537.36 OPR/43.0.2442.991"
+        "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_13_2) AppleWebKit/604.4.7 (KHTML, like Gecko) Version/11.0.2 Safari/604.4.7"
+    ]
+    headers = {"User-Agent": random.choice(user_agents)}
+    logging.info(f"Get from {url}. Use agent {headers}")
+    return get_http_session().get(url, timeout = timeouts, headers=headers)
 
 class LessonIdent:
     """
     Идентификатор урока
     """
+    __slots__ = ("__week", "__hour_start", "__day_of_week", "__day_of_week_number", "__id")
+
     def __init__(self, week: int, hour_start: str, day_of_week: str, day_of_week_number: int):
         """
         Конструктор класса
@@ -31,20 +69,29 @@ class LessonIdent:
         day_of_week: день недели
         """
         self.__week: int = week
-        self.__hour_start: str = hour_start
-        self.__day_of_week: str = day_of_week
+        self.__hour_start: str = intern_str(hour_start) if isinstance(hour_start, str) else hour_start
+        self.__day_of_week: str = intern_str(day_of_week)
         self.__day_of_week_number: int = day_of_week_number
         # идентификатор
-        self.__id = hash(self)
+        self.__id: int = self.__make_id()
+
+    def __make_id(self) -> int:
+        """ Вычисление идентификатора """
+        return stable_id(f"{self.__week}_{self.__hour_start}_{self.__day_of_week}")
 
     def __hash__(self) -> int:
         """ Вычисление хеша """
-        return hash_string(f"{self.__week}_{self.__hour_start}_{self.__day_of_week}")
+        return self.__id
 
     def __eq__(self, other) -> bool:
         """ Функция сравнения """
         return (self.__week == other.week) and (self.__hour_start == other.hour_start) and (self.__day_of_week == other.day_of_week)
 
+    def __setstate__(self, state) -> None:
+        """ Восстановление из pickle - идентификатор пересчитывается, он мог быть сохранен старой схемой """
+        restore_slots(self, state)
+        self.__id = self.__make_id()
+
     @property
     def week(self) -> int:
         """ Свойство чередование по неделям """
@@ -79,6 +126,7 @@ class Lesson:
     PRINT_GROUP = 4
     PRINT_TEACHER = 8
     PRINT_ALL: set = {PRINT_HOURS, PRINT_OFFICE, PRINT_GROUP, PRINT_TEACHER}
+    __slots__ = ("__ident", "__hour_end", "__name", "__office", "__group", "__teacher", "__class_name", "__row_data", "__groups", "__id")
 
     def __init__(self, ident: LessonIdent, name: str, office: str, group: str, teacher: str, class_name: str, row_data: str):
         """
@@ -89,16 +137,27 @@ class Lesson:
         group: разделение классы на группы
         teacher: учитель
         """
+        # Строки повторяются в уроках всех классов и недель - храним одну копию
         self.__ident: LessonIdent = ident
         self.__hour_end: str = ident.hour_start
-        self.__name: str = name
-        self.__office: str = office
-        self.__group: str = group
-        self.__teacher: str = teacher
-        self.__class_name: str = class_name
-        self.__row_data: str = row_data
+        self.__name: str = intern_str(name)
+        self.__office: str = intern_str(office)
+        self.__group: str = intern_str(group)
+        self.__teacher: str = intern_str(teacher)
+        self.__class_name: str = intern_str(class_name)
+        # текст ячейки pdf (урок, кабинет, учитель) повторяется в неделях класса и у классов одного учителя
+        self.__row_data: str = intern_str(row_data)
         self.__groups: list = []
-        self.__id: int = hash_string(f"{self.__name}_{self.ident.week}_{self.ident.hour_start}_{self.ident.day_of_week}_{self.__office}_{self.__group}_{self.__teacher}_{self.__class_name}")
+        self.__id: int = self.__make_id()
+
+    def __make_id(self) -> int:
+        """ Вычисление идентификатора """
+        return stable_id(f"{self.__name}_{self.ident.week}_{self.ident.hour_start}_{self.ident.day_of_week}_{self.__office}_{self.__group}_{self.__teacher}_{self.__class_name}")
+
+    def __setstate__(self, state) -> None:
+        """ Восстановление из pickle - идентификатор пересчитывается, он мог быть сохранен старой схемой """
+        restore_slots(self, state)
+        self.__id = self.__make_id()
 
     @property
     def ident(self) -> LessonIdent:
@@ -313,10 +372,74 @@ class DayOfWeek:
         row = next(iter(self.__week_name_indexes.values()))[0]
         return row
 
+class ParseSource(Enum):
+    """
+    Источник расписания при разборе
+    """
+    MEMORY = "memory"       # hash не изменился - используются данные в памяти
+    DB = "db"               # расписание загружено из базы
+    URL = "url"             # pdf разобран заново
+    SHARED = "shared"       # расписание, разобранное репликой-лидером, из общего хранилища
+
+class ParseOutcome(Enum):
+    """
+    Результат разбора расписания
+    """
+    UNCHANGED = "unchanged"             # hash pdf не изменился
+    LOADED = "loaded"                   # расписание загружено из базы
+    PARSED = "parsed"                   # pdf успешно разобран
+    DOWNLOAD_ERROR = "download_error"   # ошибка загрузки pdf
+    PARSE_ERROR = "parse_error"         # ошибка разбора pdf
+
+class ParseRecord:
+    """
+    Запись о разборе расписания класса - источник, объем и время загрузки, время этапов разбора, результат
+    """
+    __slots__ = ("class_id", "url", "hash", "source", "outcome", "download_bytes", "download_ms",
+                 "stage_ms", "lesson_count", "parse_path", "created")
+
+    def __init__(self, class_id: int, url: str):
+        """
+        Конструктор класса
+        """
+        self.class_id: int = class_id
+        self.url: str = url
+        self.hash: str = None
+        self.source: ParseSource = None
+        self.outcome: ParseOutcome = None
+        self.download_bytes: int = None
+        self.download_ms: float = None
+        # этап разбора (db/fast/full/save) -> время (мс)
+        self.stage_ms: dict = {}
+        self.lesson_count: int = 0
+        self.parse_path: str = None
+        self.created: datetime = datetime.now()
+
+    def stage(self, name: str, start: float) -> None:
+        """ Добавить время этапа name, начавшегося в момент start (time.perf_counter) """
+        self.stage_ms[name] = self.stage_ms.get(name, 0.0) + (time.perf_counter() - start) * 1000
+
+    def total_ms(self) -> float:
+        """ Общее время загрузки и разбора """
+        return (self.download_ms or 0.0) + sum(self.stage_ms.values())
+
+    def __str__(self) -> str:
+        """ Преобразование в строку """
+        return f"{self.outcome.value if self.outcome else None} from {self.source.value if self.source else None} " \
+            f"{self.download_bytes} bytes {self.total_ms():.0f} ms {self.lesson_count} lessons"
+
 class WeekSchedule:
     """
     Расписание класса на неделю/две недели
     """
+    # Способ разбора pdf файла
+    PARSE_PATH_FAST = "fast"
+    PARSE_PATH_FULL = "full"
+    # Словарь версий расписаний в общем хранилище: id класса -> hash pdf, опубликованного лидером
+    SHARED_VERSIONS = "week_schedule_versions"
+    # Расписание проверено по сети после запуска
+    __revalidated: bool = False
+
     def __init__(self, school_class = None):
         """
         Конструктор класса
@@ -331,6 +454,138 @@ class WeekSchedule:
         self.__last_parse_result = False
         self.__last_parse_error = None
         self.__lesson_dict = {}
+        self.__parse_path: str = None
+        # время этапов последнего разбора pdf (мс)
+        self.__parse_ms: dict = {}
+        self.__revalidated: bool = False
+        self.__last_parse_record: ParseRecord = None
+
+    def __setstate__(self, state) -> None:
+        """
+        Восстановление из pickle - после запуска расписание требует проверки по сети
+        Расписания, сохраненные до записи способа и времени разбора, получают значения по умолчанию
+        """
+        state.setdefault("_WeekSchedule__parse_path", None)
+        state.setdefault("_WeekSchedule__parse_ms", {})
+        state.setdefault("_WeekSchedule__last_parse_record", None)
+        self.__dict__.update(state)
+        self.__revalidated = False
+
+    def load_cached(self) -> bool:
+        """
+        Загрузка расписания из базы без обращения к сети, пока оно не проверено в фоне
+        Возвращает False если расписание уже проверено или в базе его нет
+        """
+        if self.__revalidated or self.__school_class is None:
+            return False
+        if self.__hash == "":
+            record = ParseRecord(self.__school_class.id, self.__school_class.link)
+            if not self.__load_last_from_db(record):
+                return False
+        return self.__last_parse_result
+
+    def __load_last_from_db(self, record: ParseRecord) -> bool:
+        """
+        Загрузка из базы последнего разобранного расписания класса для текущего расписания школы
+        Возвращает False если в базе его нет
+        """
+        school_hash = self.__school_class.department.school.hash
+        week_hash = get_last_week_schedule_hash(self.__school_class.id, school_hash)
+        start = time.perf_counter()
+        if week_hash is None or not load_pdf_from_db(self, week_hash):
+            return False
+        record.stage("db", start)
+        self.__last_parse_error = "Lessons loaded from Db without network"
+        logging.info(self.__last_parse_error)
+        self.__finish_record(record, ParseSource.DB, ParseOutcome.LOADED)
+        return True
+
+    def load(self) -> bool:
+        """
+        Загрузка расписания - до фоновой проверки из базы без обращения к сети, после нее по сети
+        """
+        if not (cfg.LAZY_STARTUP and self.load_cached()):
+            self.parse()
+        return self.__last_parse_result
+
+    def expire(self) -> None:
+        """
+        Расписание требует повторной проверки по сети - его проверит фоновое задание, обработчики читают прежнее
+        """
+        self.__revalidated = False
+
+    def detach(self):
+        """
+        Копия расписания для загрузки в пуле потоков - у копии свой словарь уроков,
+        поэтому расписание, которое читают обработчики, не меняется до замены копией
+        """
+        week_schedule = WeekSchedule.__new__(WeekSchedule)
+        week_schedule.__dict__.update(self.__dict__)
+        week_schedule.__lesson_dict = dict(self.__lesson_dict)
+        return week_schedule
+
+    def lesson_count(self) -> int:
+        """
+        Количество уроков расписания с учетом групп
+        """
+        return sum(1 + len(lesson.groups) for lesson in self.__lesson_dict.values())
+
+    def __shared_key(self) -> str:
+        """ Ключ разобранного расписания класса в общем хранилище """
+        return f"week_schedule:{self.__school_class.id}"
+
+    def __publish(self) -> None:
+        """
+        Запись разобранного расписания в общее хранилище для остальных реплик
+        """
+        if self.__school_class is not None and state_backend.shared and leader_lock.is_leader:
+            if state_backend.set_object(self.__shared_key(), (self.__hash, self.__created, self.__parse_path, self.__lesson_dict)):
+                state_backend.set_version(self.SHARED_VERSIONS, str(self.__school_class.id), self.__hash)
+
+    def load_shared(self) -> bool:
+        """
+        Загрузка расписания, опубликованного репликой-лидером, без обращения к сети и мимо кеша parse -
+        так реплика-последователь получает расписания, которые лидер разобрал после ее запуска
+        Возвращает False если лидер еще не опубликовал расписание класса
+        """
+        if self.__school_class is None:
+            return False
+        return self.__load_shared(ParseRecord(self.__school_class.id, self.__school_class.link))
+
+    def __load_shared(self, record: ParseRecord) -> bool:
+        """
+        Загрузка расписания, разобранного репликой-лидером, из общего хранилища
+        Возвращает False если лидер еще не разобрал расписание класса
+        """
+        shared = state_backend.get_object(self.__shared_key())
+        if shared is None:
+            return False
+        shared_hash, created, parse_path, lesson_dict = shared
+        if shared_hash == self.__hash:
+            outcome = ParseOutcome.UNCHANGED
+        else:
+            self.__hash, self.__created, self.__parse_path, self.__lesson_dict = shared_hash, created, parse_path, lesson_dict
+            outcome = ParseOutcome.LOADED
+        self.__last_parse_result = True
+        self.__last_parse_error = "Lessons loaded from shared state"
+        logging.info(self.__last_parse_error)
+        self.__finish_record(record, ParseSource.SHARED, outcome)
+        return True
+
+    def __finish_record(self, record: ParseRecord, source: ParseSource, outcome: ParseOutcome) -> None:
+        """
+        Завершение записи о разборе - сохранение в базе и в метриках
+        """
+        record.source = source
+        record.outcome = outcome
+        record.hash = self.__hash
+        if outcome in (ParseOutcome.LOADED, ParseOutcome.PARSED) and source != ParseSource.SHARED:
+            self.__publish()
+        record.lesson_count = self.lesson_count()
+        record.parse_path = self.__parse_path if source == ParseSource.URL else None
+        self.__last_parse_record = record
+        metrics.inc("parse_outcome", source=source.value, outcome=outcome.value)
+        add_parse_record(record)
 
     def add_lesson(self, lesson_ident: LessonIdent, new_lesson: Lesson):
         """
@@ -524,6 +779,7 @@ class WeekSchedule:
         return self.__last_parse_result
 
     @timed_lru_cache(60*60*24)
+    @metrics.timed("parse")
     def parse(self, url = None, use_db_cash: bool = True) -> bool:
         """
         Процедура разбора url расписания
@@ -532,22 +788,32 @@ class WeekSchedule:
         if self.__school_class is not None:
             url = self.__school_class.link
         logging.info(f"get {url}")
+        record = ParseRecord(None if self.__school_class is None else self.__school_class.id, url)
+        # попытка проверки по сети - даже неудачная, чтобы фоновая проверка не повторяла ее
+        self.__revalidated = True
+        # pdf скачивает и разбирает только реплика-лидер, остальные берут результат из общего хранилища,
+        # а пока лидер его не записал - из базы или оставляют расписание, которое уже есть в памяти
+        if self.__school_class is not None and not leader_lock.is_leader:
+            if not self.__load_shared(record) and not (self.__hash == "" and self.__load_last_from_db(record)):
+                if self.__hash == "":
+                    self.__last_parse_error = "Schedule is not parsed by the leader replica yet"
+                    logging.info(self.__last_parse_error)
+                self.__finish_record(record, ParseSource.MEMORY, ParseOutcome.UNCHANGED)
+            return self.__last_parse_result
         try:
-            timeouts = (6, 20) # (conn_timeout, read_timeout)
-            user_agents = [
-                "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36",
-                "Mozilla/5.0 (Windows NT 10.0; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/56.0.2924.87 Safari/537.36 OPR/43.0.2442.991"
-                "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_13_2) AppleWebKit/604.4.7 (KHTML, like Gecko) Version/11.0.2 Safari/604.4.7"
-            ]
-            headers = {"User-Agent": random.choice(user_agents)}
-            logging.info(f"Get from {url}. Use agent {headers}")
-            response = requests.get(url, timeout = timeouts, headers=headers)
+            start = time.perf_counter()
+            with metrics.span("download", source="week_schedule"):
+                response = download(url)
+            record.download_ms = (time.perf_counter() - start) * 1000
+            record.download_bytes = len(response.content)
             if response.status_code != 200:
-                self.__last_parse_error = f"Error get {url}. error code {url}"
+                self.__last_parse_error = f"Error get {url}. error code {response.status_code}"
                 logging.error(self.__last_parse_error)
+                self.__finish_record(record, ParseSource.URL, ParseOutcome.DOWNLOAD_ERROR)
                 return False
         except requests.exceptions.RequestException as e:
             logging.error(f"Error {type(e)} {e}")
+            self.__finish_record(record, ParseSource.URL, ParseOutcome.DOWNLOAD_ERROR)
             return False
 
         # Вычисление хэша
@@ -556,36 +822,133 @@ class WeekSchedule:
         if self.__hash == new_hash and use_db_cash:
             self.__last_parse_error = "Hash not changed - used saved data"
             logging.info(self.__last_parse_error)
+            self.__finish_record(record, ParseSource.MEMORY, ParseOutcome.UNCHANGED)
             return self.__last_parse_result
 
         if use_db_cash:
+            start = time.perf_counter()
             self.__last_parse_result = load_pdf_from_db(self, new_hash)
+            record.stage("db", start)
             if self.__last_parse_result:
                 self.__last_parse_error = "Lessons successful loaded from Db"
                 logging.info(self.__last_parse_error)
+                self.__finish_record(record, ParseSource.DB, ParseOutcome.LOADED)
         else:
             self.__last_parse_result = False
         if not self.__last_parse_result and new_hash is not None:
             # Данных в базе данных нет - разбираем данные страницы
+            old_hash = self.__hash
+            old_lesson_dict = self.__lesson_dict
             self.__last_parse_result = self.load_pdf_from_url(new_hash, url, response)
+            record.stage_ms.update(self.__parse_ms)
             if self.__last_parse_result:
                 self.__last_parse_error = "Lessons successful loaded from url"
+                start = time.perf_counter()
                 # записываем созданные объекты в базу
                 save_pdf_to_db(self)
+                # сохраняем изменения относительно предыдущей версии расписания
+                if self.__school_class is not None and len(old_lesson_dict) > 0 and old_hash != new_hash:
+                    changes = diff_lessons(old_lesson_dict, self.__lesson_dict)
+                    logging.info(f"Schedule of {self.__school_class.name} changed: {len(changes)} changes")
+                    save_schedule_changes(self.__school_class.id, old_hash, new_hash, changes)
+                record.stage("save", start)
+            outcome = ParseOutcome.PARSED if self.__last_parse_result else ParseOutcome.PARSE_ERROR
+            self.__finish_record(record, ParseSource.URL, outcome)
 
         return self.__last_parse_result
 
-    def load_pdf_from_url(self, new_hash: str, url: str, response: requests.models.Response) -> bool:
+    def __parse_created(self, text: str) -> None:
         """
-        Процедура разбора pdf расписания
+        Поиск даты составления расписания в тексте
         """
-        self.__hash = new_hash
-        self.__lesson_dict = {}
-        self.__created = None
-        self.__last_parse_result = False
-        self.__last_parse_error = None
+        if text.find("Составлено:") >= 0:
+            match = re.search(R"\d{1,2}\.\d{1,2}\.\d{4}", text)
+            if match:
+                self.__created = datetime.strptime(text[match.start():match.end()], "%d.%m.%Y")
 
-        mem_obj = io.BytesIO(response.content)
+    def __parse_table(self, table: list, day_of_wek: DayOfWeek, class_name: str) -> bool:
+        """
+        Разбор таблицы расписания в зависимости от расположения дней недели
+        Возвращает None если расположение дней недели не определено
+        """
+        if day_of_wek.row_index >= 0 and day_of_wek.column_index == -1:
+            logging.info(f"week indexes by row {day_of_wek.row_index}")
+            result = self.__parse_week_by_row(table, day_of_wek, class_name)
+        elif day_of_wek.column_index >= 0 and day_of_wek.row_index == -1:
+            logging.info(f"week indexes by column {day_of_wek.column_index}")
+            result = self.__parse_week_by_column(table, day_of_wek, class_name)
+        else:
+            return None
+        if result:
+            self.__last_parse_error = None
+        return result
+
+    @staticmethod
+    def __table_area(table_page):
+        """
+        Область страницы с линиями таблиц - поиск таблиц в ней не обрабатывает текст и рисунки вне сетки
+        Возвращает None если линий на странице нет
+        """
+        from pdfplumber.utils import objects_to_bbox
+        edges = table_page.edges
+        if len(edges) == 0:
+            return None
+        x0, top, x1, bottom = objects_to_bbox(edges)
+        # запас, чтобы линии на границе области не отбрасывались при обрезке, но не за пределами страницы
+        page_x0, page_top, page_x1, page_bottom = table_page.bbox
+        x0, top = max(x0 - 1, page_x0), max(top - 1, page_top)
+        x1, bottom = min(x1 + 1, page_x1), min(bottom + 1, page_bottom)
+        if x0 >= x1 or top >= bottom:
+            return None
+        return table_page.crop((x0, top, x1, bottom))
+
+    def __load_fast(self, pdf, class_name: str) -> bool:
+        """
+        Быстрый разбор pdf - просмотр страниц до первой таблицы с днями недели,
+        поиск таблиц только в области линий страницы, а если таблица с днями недели там не найдена - на всей странице,
+        извлечение данных только в границах найденной таблицы
+        """
+        for table_page in pdf.pages:
+            grid_found = False
+            table_area = self.__table_area(table_page)
+            for search_page in [table_page] if table_area is None else [table_area, table_page]:
+                for found_table in search_page.find_tables():
+                    table = found_table.extract()
+                    if len(table) == 0:
+                        continue
+                    day_of_wek: DayOfWeek = DayOfWeek([table])
+                    if not day_of_wek.has_week:
+                        continue
+                    grid_found = True
+                    # Дата составления ищется только вне области таблицы - координаты обрезанной страницы
+                    # совпадают с координатами всей страницы
+                    x0, top, x1, bottom = found_table.bbox
+                    regions = []
+                    if bottom < table_page.height:
+                        regions.append((0, bottom, table_page.width, table_page.height))
+                    if top > 0:
+                        regions.append((0, 0, table_page.width, top))
+                    for region in regions:
+                        if self.__created is None:
+                            self.__parse_created(table_page.crop(region).extract_text() or "")
+                    result = self.__parse_table(table, day_of_wek, class_name)
+                    if result is not None:
+                        return result
+                if grid_found:
+                    break
+            if grid_found:
+                # Страница с сеткой расписания найдена, но разобрать ее не удалось
+                break
+        return False
+
+    def __load_full(self, mem_obj: io.BytesIO, class_name: str) -> bool:
+        """
+        Полный разбор pdf - анализ структуры всех страниц и всех таблиц
+        """
+        from PyPDF2 import PdfReader
+        from pdfminer.high_level import extract_pages
+        from pdfminer.layout import LTTextContainer, LTPage, LTFigure
+        import pdfplumber
         pdfReader = PdfReader(mem_obj)
         # printing number of pages in pdf file
         pages = len(pdfReader.pages)
@@ -598,12 +961,6 @@ class WeekSchedule:
         layouts = extract_pages(mem_obj)
         pages_num = 0
         element_num = 0
-        if self.__school_class is not None:
-            class_name = self.__school_class.name
-        else:
-            class_name = url[url.rfind('/') + 1:]
-            class_name = unquote(class_name)
-            class_name = class_name.replace(".pdf", "")
         for page_layout in layouts:
             if isinstance(page_layout, LTPage):
                 pages_num += 1
@@ -611,11 +968,7 @@ class WeekSchedule:
             for element in page_layout:
                 element_num += 1
                 if isinstance(element, LTTextContainer):
-                    s = element.get_text()
-                    if s.find("Составлено:") >= 0:
-                        match = re.search(R"\d{1,2}\.\d{1,2}\.\d{4}", s)
-                        if match:
-                            self.__created = datetime.strptime(s[match.start():match.end()], "%d.%m.%Y")
+                    self.__parse_created(element.get_text())
                 elif isinstance(element, LTFigure):
                     self.__last_parse_error = "PDF содержит сканированное изображение - распознавание не возможно"
                     logging.warning(self.__last_parse_error)
@@ -631,17 +984,8 @@ class WeekSchedule:
                     # Получение индексов дней недели
                     day_of_wek: DayOfWeek = DayOfWeek(tables)
                     if day_of_wek.has_week:
-                        if day_of_wek.row_index >= 0 and day_of_wek.column_index == -1:
-                            logging.info(f"week indexes by row {day_of_wek.row_index}")
-                            result = self.__parse_week_by_row(table, day_of_wek, class_name)
-                            if result:
-                                self.__last_parse_error = None
-                            return result
-                        elif day_of_wek.column_index >= 0 and day_of_wek.row_index == -1:
-                            logging.info(f"week indexes by column {day_of_wek.column_index}")
-                            result = self.__parse_week_by_column(table, day_of_wek, class_name)
-                            if result:
-                                self.__last_parse_error = None
+                        result = self.__parse_table(table, day_of_wek, class_name)
+                        if result is not None:
                             return result
                     else:
                         self.__last_parse_error = "Не возможно найти в таблице дни недели"
@@ -649,6 +993,56 @@ class WeekSchedule:
                         return False
         return self.__last_parse_result
 
+    def load_pdf_from_url(self, new_hash: str, url: str, response: requests.models.Response, fast_path: bool = True) -> bool:
+        """
+        Процедура разбора pdf расписания
+        fast_path: сначала пробовать быстрый разбор, полный разбор - только при его неудаче
+        """
+        self.__hash = new_hash
+        self.__lesson_dict = {}
+        self.__created = None
+        self.__last_parse_result = False
+        self.__last_parse_error = None
+        self.__parse_path = None
+        self.__parse_ms = {}
+
+        mem_obj = io.BytesIO(response.content)
+        if self.__school_class is not None:
+            class_name = self.__school_class.name
+        else:
+            class_name = url[url.rfind('/') + 1:]
+            class_name = unquote(class_name)
+            class_name = class_name.replace(".pdf", "")
+
+        if fast_path:
+            import pdfplumber
+            start = time.perf_counter()
+            try:
+                with pdfplumber.open(mem_obj) as pdf:
+                    if self.__load_fast(pdf, class_name):
+                        self.__parse_ms[self.PARSE_PATH_FAST] = (time.perf_counter() - start) * 1000
+                        self.__parse_path = self.PARSE_PATH_FAST
+                        metrics.inc("parse_path", path=self.__parse_path)
+                        logging.info(f"class={class_name} created={self.__created} parse path={self.__parse_path}")
+                        return True
+            except Exception as e:
+                logging.warning(f"Fast parse pdf failed {type(e)} {e}")
+            self.__parse_ms[self.PARSE_PATH_FAST] = (time.perf_counter() - start) * 1000
+            # Быстрый разбор не удался - возвращаемся к полному разбору
+            self.__lesson_dict = {}
+            self.__created = None
+            self.__last_parse_result = False
+            self.__last_parse_error = None
+            mem_obj.seek(0)
+
+        self.__parse_path = self.PARSE_PATH_FULL
+        metrics.inc("parse_path", path=self.__parse_path)
+        start = time.perf_counter()
+        result = self.__load_full(mem_obj, class_name)
+        self.__parse_ms[self.PARSE_PATH_FULL] = (time.perf_counter() - start) * 1000
+        logging.info(f"class={class_name} parse path={self.__parse_path} result={result}")
+        return result
+
     def week_list(self) -> list:
         """
         Список чередования по неделям
@@ -675,6 +1069,16 @@ class WeekSchedule:
             result.append(day[1])
         return result
 
+    def day_of_week_by_number(self, week: int, day_of_week_number: int) -> str:
+        """
+        Название учебного дня недели по его номеру (0 - понедельник)
+        """
+        key: LessonIdent
+        for key in self.__lesson_dict:
+            if key.week == week and key.day_of_week_number == day_of_week_number:
+                return key.day_of_week
+        return None
+
     def lesson_list(self, week: int, day_of_week: str) -> list:
         """
         Список уроков дня
@@ -722,6 +1126,21 @@ class WeekSchedule:
         """ Setter Был ли разбор успешен """
         self.__last_parse_result = value
 
+    @property
+    def revalidated(self) -> bool:
+        """ Расписание проверено по сети после запуска """
+        return self.__revalidated
+
+    @property
+    def last_parse_record(self) -> ParseRecord:
+        """ Запись о последнем разборе расписания """
+        return self.__last_parse_record
+
+    @property
+    def parse_path(self) -> str:
+        """ Способ которым был разобран pdf (PARSE_PATH_FAST/PARSE_PATH_FULL) """
+        return self.__parse_path
+
     @property
     def last_parse_error(self) -> str:
         """ Ошибка разбора """
@@ -742,6 +1161,7 @@ def main():
     if not logging.getLogger().hasHandlers():
         logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
     cfg.disable_logger(["pdfminer.psparser", "pdfminer.pdfparser", "pdfminer.pdfinterp", "pdfminer.cmapdb", "pdfminer.pdfdocument", "pdfminer.pdfpage"])
+    init_db()
     #url = "https://1502.mskobr.ru//files/rasp/alpha/8Ж.pdf"
     #url = "https://1502.mskobr.ru/files/rasp/alpha/7%D0%95.pdf"
     #url = "https://1502.mskobr.ru//files/rasp/delta3/2%D0%BE.pdf"